@@ -0,0 +1,28 @@
+"""Add token count to messages
+
+Revision ID: 3d7b9e2c5a14
+Revises: 8c2f4e1a9b37
+Create Date: 2026-10-18 13:40:05.218734
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3d7b9e2c5a14'
+down_revision: Union[str, Sequence[str], None] = '8c2f4e1a9b37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('token_count', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('messages', 'token_count')
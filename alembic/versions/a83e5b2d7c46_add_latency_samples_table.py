@@ -0,0 +1,34 @@
+"""Add latency samples table
+
+Revision ID: a83e5b2d7c46
+Revises: f47a1d9c3e25
+Create Date: 2026-10-18 17:41:08.526731
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a83e5b2d7c46'
+down_revision: Union[str, Sequence[str], None] = 'f47a1d9c3e25'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('latency_samples',
+    sa.Column('series', sa.String(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('samples', sa.JSON(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('series', 'kind')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('latency_samples')
@@ -0,0 +1,32 @@
+"""Add rolling summary to chat sessions
+
+Revision ID: b51e0c7d2f68
+Revises: 3d7b9e2c5a14
+Create Date: 2026-10-18 15:02:47.630915
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b51e0c7d2f68'
+down_revision: Union[str, Sequence[str], None] = '3d7b9e2c5a14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chat_sessions', sa.Column('summary', sa.String(), nullable=True))
+    op.add_column('chat_sessions', sa.Column('summary_until_id', sa.Integer(), nullable=True))
+    op.add_column('chat_sessions', sa.Column('summary_tokens', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('chat_sessions', 'summary_tokens')
+    op.drop_column('chat_sessions', 'summary_until_id')
+    op.drop_column('chat_sessions', 'summary')
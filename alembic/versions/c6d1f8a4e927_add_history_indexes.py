@@ -0,0 +1,30 @@
+"""Add indexes for chat history queries
+
+Revision ID: c6d1f8a4e927
+Revises: a83e5b2d7c46
+Create Date: 2026-10-18 18:32:54.117206
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c6d1f8a4e927'
+down_revision: Union[str, Sequence[str], None] = 'a83e5b2d7c46'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_messages_session_id_created_at', 'messages', ['session_id', 'created_at'], unique=False)
+    op.create_index('ix_chat_sessions_user_id_updated_at', 'chat_sessions', ['user_id', 'updated_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chat_sessions_user_id_updated_at', table_name='chat_sessions')
+    op.drop_index('ix_messages_session_id_created_at', table_name='messages')
@@ -0,0 +1,30 @@
+"""Add prompt cache tokens to messages
+
+Revision ID: d9e3b7a15c42
+Revises: c6d1f8a4e927
+Create Date: 2026-10-18 21:12:37.504219
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd9e3b7a15c42'
+down_revision: Union[str, Sequence[str], None] = 'c6d1f8a4e927'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('cached_tokens', sa.Integer(), nullable=True))
+    op.add_column('messages', sa.Column('cache_write_tokens', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('messages', 'cache_write_tokens')
+    op.drop_column('messages', 'cached_tokens')
@@ -0,0 +1,28 @@
+"""Add serving provider to messages
+
+Revision ID: e2a6c4f81b03
+Revises: b51e0c7d2f68
+Create Date: 2026-10-18 16:27:19.804512
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2a6c4f81b03'
+down_revision: Union[str, Sequence[str], None] = 'b51e0c7d2f68'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('provider', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('messages', 'provider')
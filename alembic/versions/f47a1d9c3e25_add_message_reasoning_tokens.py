@@ -0,0 +1,28 @@
+"""Add reasoning tokens to messages
+
+Revision ID: f47a1d9c3e25
+Revises: e2a6c4f81b03
+Create Date: 2026-10-18 17:05:42.318907
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f47a1d9c3e25'
+down_revision: Union[str, Sequence[str], None] = 'e2a6c4f81b03'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('reasoning_tokens', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('messages', 'reasoning_tokens')
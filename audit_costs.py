@@ -0,0 +1,60 @@
+"""
+Аудит стоимости: пересчет всех ответов из таблицы messages по текущим ценам каталога
+
+Запуск:
+    python audit_costs.py                        # все время
+    python audit_costs.py --days 30              # последние 30 дней
+    python audit_costs.py --price claude=1.5,7.5  # симуляция: своя цена (USD за 1M input,output)
+
+Токены из кэша провайдера и записанные в него считаются по своим ценам (как при
+списании); при --price цены кэша меняются в той же пропорции, что и input.
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from database import get_message_usage
+from pricing import reprice_summary, format_cost, np
+
+
+def parse_overrides(values: list[str]) -> dict:
+    overrides = {}
+    for value in values:
+        model_key, prices = value.split("=", 1)
+        input_price, output_price = prices.split(",", 1)
+        overrides[model_key.strip()] = (float(input_price), float(output_price))
+    return overrides
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Пересчет стоимости ответов по ценам каталога")
+    parser.add_argument("--days", type=int, default=None, help="только последние N дней")
+    parser.add_argument("--price", action="append", default=[], help="model_key=input,output (USD за 1M)")
+    args = parser.parse_args()
+
+    since = datetime.utcnow() - timedelta(days=args.days) if args.days else None
+    columns = await get_message_usage(since)
+
+    start = time.perf_counter()
+    summary = reprice_summary(
+        columns["model_used"], columns["input_tokens"], columns["output_tokens"],
+        columns["cost_usd"], parse_overrides(args.price),
+        columns["cached_tokens"], columns["cache_write_tokens"],
+    )
+    elapsed = time.perf_counter() - start
+
+    print(f"📊 Строк: {len(columns['model_used'])} | расчет {elapsed:.3f}с ({'NumPy' if np is not None else 'без NumPy'})")
+    total_recorded = total_repriced = 0.0
+    for model_key, row in sorted(summary.items()):
+        total_recorded += row["recorded"]
+        total_repriced += row["repriced"]
+        print(f"  {model_key:<12} {row['rows']:>8} | списано {format_cost(row['recorded']):>12} | "
+              f"по ценам {format_cost(row['repriced']):>12}")
+    print(f"  {'ИТОГО':<12} {'':>8} | списано {format_cost(total_recorded):>12} | "
+          f"по ценам {format_cost(total_repriced):>12}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
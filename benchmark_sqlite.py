@@ -0,0 +1,161 @@
+"""
+Бенчмарк профилей SQLite (SQLITE_PROFILES в config.py): конкурентные чтения и записи
+
+Каждый профиль получает свою свежую базу с одинаковыми данными. Читатели
+запрашивают историю чата (get_conversation_history), писатели делают ход
+диалога (load_request_context + два сообщения + счетчики токенов, commit);
+каждый NEW_USER_SHARE-й ход - от нового пользователя (создание юзера и первого чата).
+Кэши в памяти выключены - меряется сама база.
+
+Запуск:
+    python benchmark_sqlite.py                                  # все профили, по 10 с
+    python benchmark_sqlite.py --profile default --profile wal --seconds 30
+    python benchmark_sqlite.py --readers 16 --writers 4
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from config import SQLITE_PROFILES
+import database
+
+
+USERS = 500
+CHATS_PER_USER = 3
+MESSAGES_PER_CHAT = 30
+NEW_USER_SHARE = 10  # каждый 10-й ход - новый пользователь
+
+_new_users = itertools.count(USERS + 1)
+
+
+def seed(path: str):
+    """Одинаковые данные для всех профилей"""
+    random.seed(1)
+    start = datetime.utcnow() - timedelta(hours=1)
+    users, chats, messages = [], [], []
+    for telegram_id in range(1, USERS + 1):
+        sessions = [f"s-{telegram_id}-{n}" for n in range(CHATS_PER_USER)]
+        users.append((telegram_id, "mimo", sessions[0], start, "free", 0, 100_000, start, 0.0))
+        for session_id in sessions:
+            chats.append((telegram_id, session_id, "Чат", start, start, True))
+            for i in range(MESSAGES_PER_CHAT):
+                content = "слово " * random.randint(5, 80)
+                messages.append((
+                    telegram_id, "user" if i % 2 == 0 else "assistant", content, session_id,
+                    start + timedelta(seconds=i), len(content) // 4,
+                ))
+
+    with sqlite3.connect(path) as conn:
+        conn.executemany(
+            "INSERT INTO users (telegram_id, selected_model, current_session_id, created_at, subscription_tier,"
+            " tokens_used_month, tokens_limit_month, last_token_reset, total_spent_usd) VALUES (?,?,?,?,?,?,?,?,?)",
+            users,
+        )
+        conn.executemany(
+            "INSERT INTO chat_sessions (user_id, session_id, title, created_at, updated_at, is_auto_titled)"
+            " VALUES (?,?,?,?,?,?)",
+            chats,
+        )
+        conn.executemany(
+            "INSERT INTO messages (telegram_id, role, content, session_id, created_at, token_count)"
+            " VALUES (?,?,?,?,?,?)",
+            messages,
+        )
+
+
+async def read_once():
+    await database.get_conversation_history(random.randint(1, USERS), 15)
+
+
+async def write_once():
+    new_user = random.randrange(NEW_USER_SHARE) == 0
+    context = await database.load_request_context(next(_new_users) if new_user else random.randint(1, USERS))
+    context.add_message("user", "вопрос " * 20)
+    context.add_message("assistant", "ответ " * 200, model_used="mimo", usage={"tokens_used": 300})
+    context.add_token_usage(300, 0.0)
+    await context.commit()
+
+
+async def worker(operation, deadline: float, timings: list, errors: list):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            await operation()
+        except Exception as e:
+            errors.append(type(e).__name__)
+            continue
+        timings.append(time.perf_counter() - start)
+
+
+def p95(timings: list) -> float:
+    if not timings:
+        return 0.0
+    ordered = sorted(timings)
+    return ordered[min(int(0.95 * len(ordered)), len(ordered) - 1)]
+
+
+async def run_profile(profile: str, seconds: float, readers: int, writers: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        engine = database.make_engine(f"sqlite+aiosqlite:///{path}", profile)
+        async with engine.begin() as conn:
+            await conn.run_sync(database.Base.metadata.create_all)
+        seed(path)
+
+        database.engine = engine
+        database.async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+        reads, writes, errors = [], [], []
+        deadline = time.perf_counter() + seconds
+        # Логи database.py ("✅ Токены обновлены ...") в отчет не нужны
+        with contextlib.redirect_stdout(io.StringIO()):
+            await asyncio.gather(
+                *(worker(read_once, deadline, reads, errors) for _ in range(readers)),
+                *(worker(write_once, deadline, writes, errors) for _ in range(writers)),
+            )
+        await engine.dispose()
+
+    return {
+        "reads": len(reads) / seconds,
+        "writes": len(writes) / seconds,
+        "read_p95": p95(reads) * 1000,
+        "write_p95": p95(writes) * 1000,
+        "errors": len(errors),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Сравнение профилей SQLite под конкурентной нагрузкой")
+    parser.add_argument("--profile", action="append", choices=sorted(SQLITE_PROFILES),
+                        help="профиль из SQLITE_PROFILES (по умолчанию все)")
+    parser.add_argument("--seconds", type=float, default=10, help="длительность на профиль")
+    parser.add_argument("--readers", type=int, default=8, help="параллельных читателей")
+    parser.add_argument("--writers", type=int, default=2, help="параллельных писателей")
+    args = parser.parse_args()
+
+    # Меряем базу, а не кэши в памяти
+    database._user_cache.enabled = False
+    database._history_cache.enabled = False
+
+    print(f"📊 {USERS} юзеров, {USERS * CHATS_PER_USER * MESSAGES_PER_CHAT} сообщений | "
+          f"{args.readers} читателей, {args.writers} писателей, {args.seconds:.0f}с на профиль")
+    print(f"  {'профиль':<10} {'чтений/с':>10} {'p95 чт.':>10} {'записей/с':>10} {'p95 зап.':>10} {'ошибок':>7}")
+    for profile in args.profile or list(SQLITE_PROFILES):
+        row = await run_profile(profile, args.seconds, args.readers, args.writers)
+        print(f"  {profile:<10} {row['reads']:>10.0f} {row['read_p95']:>8.1f}мс "
+              f"{row['writes']:>10.0f} {row['write_p95']:>8.1f}мс {row['errors']:>7}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,7 @@
 print("🔍 Начинаю загрузку bot.py...")
 
 import asyncio
+import contextlib
 import logging
 import re
 import html
@@ -24,7 +25,10 @@ print("✅ aiogram и типы загружены")
 
 # Импорты конфигурации
 try:
-    from config import TELEGRAM_BOT_TOKEN, MODELS, DAILY_LIMIT
+    from config import (
+        TELEGRAM_BOT_TOKEN, MODELS, DAILY_LIMIT, ADMIN_IDS,
+        STREAMING_ENABLED, STREAM_EDIT_INTERVAL, STREAM_EDIT_INTERVAL_GROUP
+    )
     print("✅ config загружен")
 except ImportError:
     logger.error("❌ Ошибка: Не найден файл config.py!")
@@ -33,6 +37,9 @@ except ImportError:
 # Импорты ценообразования
 try:
     from pricing import calculate_cost, estimate_tokens, format_cost, is_free_model
+    from context_builder import build_context
+    from summarizer import schedule as schedule_summary
+    from response_cache import hit_charge, cache_stats
     print("✅ pricing загружен")
 except ImportError:
     logger.error("❌ Ошибка: Не найден файл pricing.py!")
@@ -41,7 +48,7 @@ except ImportError:
 # Импорты базы данных - ВОЗВРАЩАЕМ ПОЛНЫЙ СПИСОК
 try:
     from database import (
-        init_db, get_or_create_user, check_and_update_limit, 
+        init_db, close_db, get_or_create_user, check_and_update_limit, 
         update_selected_model, get_user_info,
         save_message, get_conversation_history, clear_conversation_history,
         create_new_session, get_user_sessions, switch_session, get_current_session,
@@ -49,7 +56,8 @@ try:
         save_previous_session, set_system_prompt, clear_system_prompt, 
         get_system_prompt,
         async_session, ChatSession, Message as DBMessage,
-        check_token_limit, update_token_usage, get_user_stats, check_model_access
+        check_token_limit, update_token_usage, get_user_stats, check_model_access,
+        load_request_context, RequestContext, prewarm_history
     )
     print("✅ database загружен")
 except ImportError:
@@ -58,7 +66,16 @@ except ImportError:
 
 # Импорты OpenRouter
 try:
-    from openrouter import send_message, get_model_name
+    from openrouter import (
+        send_message, stream_message, get_model_name, warm_up, close as close_openrouter,
+        get_model_health, is_chain_available, get_busy_retry_after
+    )
+    import key_pool
+    import latency
+    import prompt_cache
+    import scheduler
+    import singleflight
+    import token_estimator
     print("✅ openrouter загружен")
 except ImportError:
     logger.error("❌ Ошибка: Не найден файл openrouter.py!")
@@ -138,13 +155,201 @@ def markdown_to_html(text: str) -> str:
     return text
 
 
+MAX_MSG_LEN = 4000  # Чуть меньше 4096 для безопасности
+
+
+def _split_index(text: str, limit: int = MAX_MSG_LEN) -> int:
+    """Где резать длинный текст: по последнему переносу строки до limit"""
+    split_idx = text.rfind('\n', 0, limit)
+    if split_idx <= 0:
+        split_idx = limit
+    return split_idx
+
+
+def split_long_text(text: str, limit: int = MAX_MSG_LEN) -> list[str]:
+    """
+    Разбивает длинный ответ на куски для Telegram
+    Разбиваем ИСХОДНЫЙ текст (Markdown/Text), а не HTML, чтобы не рвать теги
+    """
+    parts = []
+    while len(text) > 0:
+        if len(text) <= limit:
+            parts.append(text)
+            break
+        
+        split_idx = _split_index(text, limit)
+        parts.append(text[:split_idx])
+        text = text[split_idx:].lstrip()
+    return parts
+
+
+async def send_long_message(message: Message, text: str, footer: str = ""):
+    """Отправляет ответ модели (при необходимости несколькими сообщениями)"""
+    parts = split_long_text(text)
+    
+    for i, part in enumerate(parts):
+        part_html = markdown_to_html(part)
+        
+        # Футер только в последнем
+        current_footer = footer if (i == len(parts) - 1) else ""
+        
+        try:
+            await message.answer(part_html + current_footer, parse_mode="HTML")
+            if len(parts) > 1:
+                await asyncio.sleep(0.3) # Анти-спам задержка
+        except TelegramBadRequest:
+            # Если HTML битый, шлем plain text
+            await message.answer(part + current_footer, parse_mode=None)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            await message.answer(part + current_footer, parse_mode=None)
+
+
+class StreamRenderer:
+    """
+    Показывает ответ модели по мере генерации
+    
+    Сначала отправляет заглушку, потом редактирует ее не чаще чем раз в
+    STREAM_EDIT_INTERVAL секунд (Telegram ограничивает частоту правок).
+    Когда текст вылезает за MAX_MSG_LEN - фиксирует сообщение и продолжает в новом.
+    Во время генерации текст показывается без разметки (Markdown еще не дописан),
+    финальная версия рендерится в HTML.
+    """
+    
+    CURSOR = " ▌"
+    
+    def __init__(self, message: Message):
+        self.message = message
+        self.interval = STREAM_EDIT_INTERVAL if message.chat.type == "private" else STREAM_EDIT_INTERVAL_GROUP
+        self.current = None     # сообщение бота, которое сейчас дописывается
+        self.buffer = ""        # текст текущего сообщения
+        self.shown = ""         # что сейчас видно пользователю
+        self.next_edit_at = 0.0
+    
+    async def start(self):
+        """Отправляет заглушку - пользователь сразу видит, что бот работает"""
+        self.current = await self._send("⏳ Думаю...")
+        self.next_edit_at = time.monotonic() + self.interval
+    
+    async def feed(self, delta: str):
+        """Добавляет кусок ответа и, если пора, обновляет сообщение"""
+        self.buffer += delta
+        
+        # Переносим хвост в новое сообщение на границе MAX_MSG_LEN
+        while len(self.buffer) > MAX_MSG_LEN:
+            split_idx = _split_index(self.buffer)
+            part, self.buffer = self.buffer[:split_idx], self.buffer[split_idx:].lstrip()
+            await self._finalize(self.current, part)
+            self.current = await self._send(self.buffer + self.CURSOR if self.buffer else "⏳ ...")
+            self.shown = self.buffer
+            self.next_edit_at = time.monotonic() + self.interval
+        
+        if time.monotonic() >= self.next_edit_at and self.buffer != self.shown:
+            await self._edit_progress(self.buffer + self.CURSOR)
+    
+    async def finish(self, footer: str = ""):
+        """Финальная версия последнего сообщения: HTML-разметка + футер"""
+        await self._finalize(self.current, self.buffer, footer)
+    
+    async def fail(self, error_html: str):
+        """Показывает ошибку: вместо заглушки или после уже полученного текста"""
+        if self.buffer:
+            await self._finalize(self.current, self.buffer)
+            await self._send(error_html, parse_mode="HTML")
+        else:
+            await self._finalize_html(self.current, error_html, error_html)
+    
+    async def _send(self, text: str, parse_mode: str = None) -> Message:
+        """Новое сообщение (обязательно доходит, ждем RetryAfter)"""
+        while True:
+            try:
+                return await self.message.answer(text, parse_mode=parse_mode)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+    
+    async def _edit_progress(self, text: str):
+        """Промежуточная правка: при лимите Telegram просто пропускаем ее"""
+        try:
+            await self.current.edit_text(text, parse_mode=None)
+            self.shown = self.buffer
+            self.next_edit_at = time.monotonic() + self.interval
+        except TelegramRetryAfter as e:
+            # Не спим - продолжаем читать стрим, правим позже
+            self.next_edit_at = time.monotonic() + e.retry_after
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e):
+                logger.warning(f"Не удалось обновить стрим-сообщение: {e}")
+            self.next_edit_at = time.monotonic() + self.interval
+    
+    async def _finalize(self, target: Message, text: str, footer: str = ""):
+        """Фиксирует кусок ответа в сообщении target с HTML-разметкой"""
+        await self._finalize_html(target, markdown_to_html(text) + footer, text + footer)
+    
+    async def _finalize_html(self, target: Message, html_text: str, plain_text: str):
+        """Финальная правка (обязательно доходит): HTML, а если он битый - plain text"""
+        while True:
+            try:
+                try:
+                    await target.edit_text(html_text, parse_mode="HTML")
+                except TelegramBadRequest as e:
+                    if "not modified" in str(e):
+                        return
+                    # Если HTML битый, шлем plain text
+                    await target.edit_text(plain_text, parse_mode=None)
+                return
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                logger.warning(f"Не удалось зафиксировать стрим-сообщение: {e}")
+                return
+
+
+def billed_usage(result: dict) -> tuple[int, float]:
+    """
+    Сколько токенов и денег списать с пользователя за результат send_message
+    
+    Цена - по модели, которая реально ответила (могла сработать запасная).
+    Токены из кэша промпта провайдера стоят дешевле, запись в кэш - дороже (см. prompt_cache).
+    Ответ из кэша или от склеенного одинакового запроса стоит по hit_charge.
+    """
+    tokens_usage = result["tokens"]
+    cost = calculate_cost(
+        result["model_key"], result.get("input_tokens", 0), result.get("output_tokens", 0),
+        result.get("cached_tokens", 0), result.get("cache_write_tokens", 0)
+    )
+    if result.get("cached") or result.get("coalesced"):
+        tokens_usage, cost = hit_charge(tokens_usage, cost)
+    return tokens_usage, cost
+
+
+def build_footer(result: dict, cost: float) -> str:
+    """Инфо-футер под ответом модели (модель - та, что реально ответила)"""
+    model_key = result["model_key"]
+    model_name = get_model_name(model_key)
+    if result.get("fallback_from"):
+        model_name += f" (вместо {get_model_name(result['fallback_from'])})"
+    time_spent = result.get("response_time") or 0
+    
+    if is_free_model(model_key):
+        return f"\n\n<i>🤖 {model_name} • ⏱ {time_spent:.1f}s</i>"
+    return f"\n\n<i>🤖 {model_name} • 💰 {result['tokens']} tok • 💵 {format_cost(cost)}</i>"
+
+
+
+# Пометки на кнопках моделей по данным circuit breaker
+HEALTH_MARKS = {
+    "degraded": " ⚠️ сбоит",
+    "down": " ⛔ недоступна",
+}
+
+
 def get_models_keyboard() -> InlineKeyboardMarkup:
     """Создает клавиатуру выбора модели из конфига"""
     buttons = []
     for key, model in MODELS.items():
         # Добавляем эмодзи в зависимости от типа (бесплатная/платная)
         emoji = "🆓" if model.get("free") else "💎"
-        btn_text = f"{emoji} {model['name']}"
+        btn_text = f"{emoji} {model['name']}{HEALTH_MARKS.get(get_model_health(key), '')}"
         
         buttons.append([
             InlineKeyboardButton(
@@ -394,6 +599,103 @@ async def cmd_system_clear(message: Message):
         await message.answer("❌ Ошибка при удалении.")
 
 
+@dp.message(Command("latency"))
+async def cmd_latency(message: Message):
+    """Задержки моделей по нашему трафику (только для админов)"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ Команда доступна только админам.")
+        return
+    
+    report = latency.latency_report()
+    queues = scheduler.scheduler_stats()
+    if not report and not queues:
+        await message.answer("⏱ Замеров задержек пока нет.")
+        return
+    
+    def line(title: str, values: dict | None) -> str:
+        if not values:
+            return f"   {title}: —"
+        p50, p95, p99 = (values[q] for q in latency.REPORT_PERCENTILES)
+        return f"   {title}: {p50:.1f} / {p95:.1f} / {p99:.1f}с (n={values['count']})"
+    
+    lines = ["⏱ <b>Задержки моделей</b> (p50 / p95 / p99)\n"]
+    for model_key in sorted(set(report) | set(queues), key=get_model_name):
+        kinds = report.get(model_key, {})
+        lines.append(f"<b>{html.escape(get_model_name(model_key))}</b>")
+        lines.append(line("До 1-го токена", kinds.get(latency.TTFT)))
+        lines.append(line("Весь ответ", kinds.get(latency.TOTAL)))
+        per_token = kinds.get(latency.PER_TOKEN)
+        if per_token:
+            lines.append(f"   На токен: {per_token[0.5] * 1000:.0f} / {per_token[0.99] * 1000:.0f}мс (p50 / p99)")
+        queue = queues.get(model_key)
+        if queue:
+            # Очередь планировщика: ожидание слота и сброс нагрузки по тарифам
+            lines.append(
+                f"   Слоты: {queue['in_flight']} из {queue['limit']} (макс. {queue['max_limit']}), "
+                f"в очереди {sum(queue['queued'].values())}"
+            )
+            for tier in sorted(set(queue["wait"]) | set(queue["shed"])):
+                wait = queue["wait"].get(tier)
+                waited = f"{wait['p50']:.1f} / {wait['p99']:.1f}с (n={wait['count']})" if wait else "—"
+                lines.append(f"   Ожидание {tier}: {waited}, отклонено {queue['shed'].get(tier, 0)}")
+        lines.append(
+            f"   Таймауты: 1-й токен {latency.get_timeout(model_key, latency.TTFT):.0f}с / "
+            f"ответ на 1000 токенов {latency.get_request_timeout(model_key, 1000):.0f}с\n"
+        )
+    
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
+@dp.message(Command("admin_stats"))
+async def cmd_admin_stats(message: Message):
+    """Счетчики ключей OpenRouter и кэшей (только для админов)"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ Команда доступна только админам.")
+        return
+    
+    lines = ["🔑 <b>Ключи OpenRouter</b>"]
+    for key in key_pool.key_pool_stats():
+        line = (
+            f"   {html.escape(key['key'])}: в работе {key['in_flight']}, запросов {key['requests']}, "
+            f"ошибок {key['errors']} (429: {key['rate_limited']}), токенов {key['tokens']}"
+        )
+        if key["remaining"] is not None:
+            line += f", остаток лимита {key['remaining']}"
+        if key["quarantine_reason"]:
+            line += f"\n   🔒 карантин еще {key['quarantined_for']:.0f}с: {html.escape(key['quarantine_reason'])}"
+        lines.append(line)
+    
+    prompt_stats = prompt_cache.prompt_cache_stats()
+    lines.append("\n💾 <b>Кэш промпта у провайдера</b> (доля prompt-токенов из кэша)")
+    if not prompt_stats:
+        lines.append("   —")
+    for model_key in sorted(prompt_stats, key=get_model_name):
+        stats = prompt_stats[model_key]
+        lines.append(
+            f"   {html.escape(get_model_name(model_key))}: {stats['hit_ratio']:.0%}, "
+            f"попаданий {stats['hits']} из {stats['requests']}, записано {stats['cache_write_tokens']} токенов"
+        )
+    
+    response_stats = cache_stats()
+    lines.append(
+        f"\n📦 <b>Кэш ответов /ask</b>: попаданий {response_stats['hit_ratio']:.0%} "
+        f"(память {response_stats['hits_memory']}, БД {response_stats['hits_persistent']}, "
+        f"промахов {response_stats['misses']})\n"
+        f"   Записей {response_stats['entries']} ({response_stats['bytes'] / 1024:.0f} КБ), "
+        f"сохранено {response_stats['stores']}, вытеснено {response_stats['evictions']}, "
+        f"ошибок БД {response_stats['errors']}"
+    )
+    
+    flight_stats = singleflight.singleflight_stats()
+    lines.append(
+        f"\n🔗 <b>Склейка одинаковых запросов</b>: отправлено {flight_stats['leaders']}, "
+        f"склеено {flight_stats['followers']}, брошено {flight_stats['abandoned']}, "
+        f"летит сейчас {flight_stats['inflight']}"
+    )
+    
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
 @dp.message(Command("ask"))
 async def cmd_ask(message: Message):
     """Быстрый запрос к конкретной модели без переключения"""
@@ -432,24 +734,40 @@ async def cmd_ask(message: Message):
         await message.answer(f"🚫 {error_msg}")
         return
 
-    # Отправляем "Typing..."
-    await bot.send_chat_action(message.chat.id, "typing")
-    
     # Формируем разовый запрос
     messages = [{"role": "user", "content": question}]
     
-    result = await send_message(model_key, messages)
+    can_request, remaining, tier = await check_token_limit(message.from_user.id, estimate_tokens(question, model_key))
+    if not can_request:
+        await message.answer(f"⏳ Лимит токенов для тарифа {tier} исчерпан.")
+        return
+    
+    retry_after = get_busy_retry_after(model_key, tier)
+    if retry_after:
+        await message.answer(f"⏳ Модель сейчас перегружена. Повторите через {retry_after} с.")
+        return
+    
+    # Отправляем "Typing..."
+    await bot.send_chat_action(message.chat.id, "typing")
+    
+    # Вопрос без контекста - одинаковые вопросы можно отдавать из кэша
+    result = await send_message(
+        model_key, messages, tier=tier, use_cache=True, user_id=message.from_user.id,
+        max_tokens=remaining - estimate_tokens(question, model_key)
+    )
     
     if result["success"]:
         # Считаем деньги и токены, но не сохраняем в историю чата (т.к. это разовый /ask)
-        cost = calculate_cost(model_key, result.get("input_tokens", 0), result.get("output_tokens", 0))
-        await update_token_usage(message.from_user.id, result["tokens"], cost)
+        answered_key = result["model_key"]
+        tokens_usage, cost = billed_usage(result)
+        await update_token_usage(message.from_user.id, tokens_usage, cost)
         
         response = markdown_to_html(result["response"])
-        model_name = get_model_name(model_key)
+        model_name = get_model_name(answered_key)
+        source = "One-shot, из кэша" if result.get("cached") else "One-shot"
         
         await message.answer(
-            f"{response}\n\n<i>⚡️ Ответ от {model_name} (One-shot)</i>",
+            f"{response}\n\n<i>⚡️ Ответ от {model_name} ({source})</i>",
             parse_mode="HTML"
         )
     else:
@@ -518,6 +836,8 @@ async def callback_chat_select(callback: CallbackQuery):
     if target:
         await save_previous_session(callback.from_user.id, target.session_id)
         await switch_session(callback.from_user.id, target.session_id)
+        # История чата понадобится на первом же сообщении - грузим в память сейчас
+        await prewarm_history(target.session_id)
         await callback.answer(f"✅ Загружен: {target.title}")
         await callback.message.edit_text(
             f"📂 <b>Чат открыт:</b> {target.title}\n\n"
@@ -532,24 +852,22 @@ async def callback_chat_select(callback: CallbackQuery):
 
 @dp.message(F.text)
 async def handle_message(message: Message):
-    # 1. Получаем инфо о юзере
-    user = await get_user_info(message.from_user.id)
-    if not user:
-        # Если юзер пишет, но его нет в базе (перезагрузка бота стерла кэш, но база на месте)
-        user = await get_or_create_user(message.from_user.id, message.from_user.username)
+    # 1. Юзер и его текущий чат - одним запросом (юзер создается, если его нет в базе);
+    # дальше все читаем и меняем в памяти, в базу пишем одной транзакцией в конце
+    context = await load_request_context(message.from_user.id, message.from_user.username)
     
-    model_key = user.selected_model
+    model_key = context.user.selected_model
     model_name = get_model_name(model_key)
     
     # 2. Проверка доступа (Tier)
-    has_access, error_msg = await check_model_access(message.from_user.id, model_key)
+    has_access, error_msg = context.check_model_access(model_key)
     if not has_access:
         await message.answer(f"🚫 <b>Доступ запрещен</b>\n\n{error_msg}", parse_mode="HTML")
         return
     
     # 3. Проверка лимитов токенов
-    estimated = estimate_tokens(message.text)
-    can_request, remaining, tier = await check_token_limit(message.from_user.id, estimated)
+    estimated = estimate_tokens(message.text, model_key)
+    can_request, remaining, tier = context.check_token_limit(estimated)
     
     if not can_request:
         await message.answer(
@@ -560,111 +878,133 @@ async def handle_message(message: Message):
         )
         return
     
-    # 4. Сохраняем сообщение User
-    await save_message(message.from_user.id, "user", message.text)
+    # Если модель и все ее запасные сейчас отключены - не ставим запрос в очередь зря
+    if not is_chain_available(model_key, tier):
+        await message.answer(
+            f"⛔ <b>{model_name} временно недоступна</b>\n\n"
+            f"Модель сейчас сбоит. Выберите другую (/model) или повторите через минуту.",
+            reply_markup=get_models_keyboard(),
+            parse_mode="HTML"
+        )
+        return
+    
+    # Очередь к модели слишком длинная - сразу говорим, когда повторить (только дешевые тарифы)
+    retry_after = get_busy_retry_after(model_key, tier)
+    if retry_after:
+        await message.answer(
+            f"⏳ <b>{model_name} сейчас перегружена</b>\n\n"
+            f"Слишком много запросов. Повторите через {retry_after} с или выберите другую модель (/model).",
+            parse_mode="HTML"
+        )
+        return
     
-    # 5. Авто-название чата (если это первое сообщение)
-    await auto_title_session(message.from_user.id, message.text)
+    # 4. Собираем историю (Контекст)
+    # Столько свежих сообщений, сколько помещается в окно модели, тариф и остаток лимита
+    history, prompt_tokens = await build_context(
+        context, model_key, message.text, context.system_prompt, tier, remaining
+    )
+    if history is None:
+        await message.answer(
+            f"⏳ <b>Не хватает токенов</b>\n\n"
+            f"Запрос - около {prompt_tokens} токенов, осталось {remaining}.\n"
+            f"Сократите сообщение или системный промпт.",
+            parse_mode="HTML"
+        )
+        return
     
-    # 6. Собираем историю (Контекст)
-    # Берем последние 15 сообщений для хорошего контекста
-    history = await get_conversation_history(message.from_user.id, limit=15)
+    # Ответ не должен съесть больше, чем осталось после промпта
+    max_tokens = remaining - prompt_tokens
     
-    # Добавляем системный промпт (если есть)
-    system_prompt = await get_system_prompt(message.from_user.id)
-    if system_prompt:
-        history.insert(0, {"role": "system", "content": system_prompt})
+    # 5. Сообщение User (запишется вместе с ответом)
+    context.add_message("user", message.text)
     
-    # Визуальный эффект "печатает..."
-    await bot.send_chat_action(message.chat.id, "typing")
+    # 6. Авто-название чата (если это первое сообщение)
+    context.auto_title(message.text)
     
+    try:
+        await _answer_message(message, context, model_key, history, tier, max_tokens)
+    finally:
+        # Вопрос пользователя сохраняем, даже если модель не ответила (повторный commit - пустой)
+        await context.commit()
+
+
+async def _answer_message(message: Message, context: RequestContext, model_key: str, history: list, tier: str, max_tokens: int):
+    """Запрос к модели и ответ пользователю (шаги 7-9 handle_message)"""
     # 7. Запрос к API
-    result = await send_message(model_key, history)
+    renderer = None
+    if STREAMING_ENABLED:
+        # Показываем ответ по мере генерации
+        renderer = StreamRenderer(message)
+        await renderer.start()
+        result = None
+        # aclosing: если рендер упадет, стрим сразу отдаст слот модели, ключ и HTTP-поток
+        events = stream_message(model_key, history, tier=tier, user_id=message.from_user.id, max_tokens=max_tokens)
+        async with contextlib.aclosing(events):
+            async for event in events:
+                if event["type"] == "delta":
+                    await renderer.feed(event["content"])
+                else:
+                    result = event["result"]
+    else:
+        # Визуальный эффект "печатает..."
+        await bot.send_chat_action(message.chat.id, "typing")
+        result = await send_message(model_key, history, tier=tier, user_id=message.from_user.id,
+                                    max_tokens=max_tokens)
     
     if result["success"]:
         response_text = result["response"]
-        tokens_usage = result["tokens"]
-        input_tokens = result.get("input_tokens", 0)
-        output_tokens = result.get("output_tokens", 0)
+        # Если выбранная модель не ответила - ответила запасная, ей и платим
+        answered_key = result["model_key"]
         
         # Обновляем статистику
-        cost = calculate_cost(model_key, input_tokens, output_tokens)
-        await update_token_usage(message.from_user.id, tokens_usage, cost)
+        tokens_usage, cost = billed_usage(result)
+        context.add_token_usage(tokens_usage, cost)
         
-        # Сохраняем ответ Assistant
-        await save_message(
-            message.from_user.id, 
+        # Сохраняем ответ Assistant (вместе с вопросом и счетчиками - одной транзакцией)
+        context.add_message(
             "assistant", 
             response_text, 
-            model_used=model_key
+            model_used=answered_key,
+            usage={
+                "tokens_used": tokens_usage,
+                "input_tokens": result.get("input_tokens") or 0,
+                "output_tokens": result.get("output_tokens") or 0,
+                "cost_usd": cost,
+                "response_time": result.get("response_time") or 0.0,
+                "provider": result.get("provider"),
+                "reasoning_tokens": result.get("reasoning_tokens") or 0,
+                "cached_tokens": result.get("cached_tokens") or 0,
+                "cache_write_tokens": result.get("cache_write_tokens") or 0,
+            }
         )
+        await context.commit()
         
         # 8. Отправка ответа
-        html_response = markdown_to_html(response_text)
-        
-        # Инфо-футер
-        is_free = is_free_model(model_key)
-        time_spent = result.get("response_time", 0)
+        footer = build_footer(result, cost)
         
-        if is_free:
-            footer = f"\n\n<i>🤖 {model_name} • ⏱ {time_spent:.1f}s</i>"
+        if renderer:
+            await renderer.finish(footer)
         else:
-            footer = f"\n\n<i>🤖 {model_name} • 💰 {tokens_usage} tok • 💵 {format_cost(cost)}</i>"
+            await send_long_message(message, response_text, footer)
         
-        MAX_MSG_LEN = 4000 # Чуть меньше 4096 для безопасности
-        
-        # Если сообщение короткое
-        if len(html_response) <= MAX_MSG_LEN:
-            try:
-                await message.answer(html_response + footer, parse_mode="HTML")
-            except TelegramBadRequest:
-                # Если HTML битый, шлем plain text
-                await message.answer(response_text + footer, parse_mode=None)
-        else:
-            # Разбиение длинного сообщения
-            # Разбиваем ИСХОДНЫЙ текст (Markdown/Text), а не HTML, чтобы не рвать теги
-            parts = []
-            source_text = response_text
-            
-            while len(source_text) > 0:
-                if len(source_text) <= MAX_MSG_LEN:
-                    parts.append(source_text)
-                    break
-                
-                # Ищем перенос строки
-                split_idx = source_text.rfind('\n', 0, MAX_MSG_LEN)
-                if split_idx == -1: split_idx = MAX_MSG_LEN
-                
-                parts.append(source_text[:split_idx])
-                source_text = source_text[split_idx:].lstrip()
-            
-            # Отправляем куски
-            for i, part in enumerate(parts):
-                part_html = markdown_to_html(part)
-                
-                # Футер только в последнем
-                current_footer = footer if (i == len(parts) - 1) else ""
-                
-                try:
-                    await message.answer(part_html + current_footer, parse_mode="HTML")
-                    await asyncio.sleep(0.3) # Анти-спам задержка
-                except TelegramBadRequest:
-                    await message.answer(part + current_footer, parse_mode=None)
-                except TelegramRetryAfter as e:
-                    await asyncio.sleep(e.retry_after)
-                    await message.answer(part + current_footer, parse_mode=None)
+        # 9. Длинный чат - сжимаем старую часть в фоне (пользователь уже получил ответ)
+        schedule_summary(context)
                     
     else:
         # Ошибка API
         error_msg = result.get("error", "Неизвестная ошибка")
         logger.error(f"API Error for {message.from_user.id}: {error_msg}")
+        await context.commit()
         
-        await message.answer(
+        error_text = (
             f"❌ <b>Ошибка нейросети</b>\n\n"
-            f"<code>{error_msg}</code>\n\n"
-            f"Попробуйте сменить модель (/model) или повторите позже.",
-            parse_mode="HTML"
+            f"<code>{html.escape(error_msg)}</code>\n\n"
+            f"Попробуйте сменить модель (/model) или повторите позже."
         )
+        if renderer:
+            await renderer.fail(error_text)
+        else:
+            await message.answer(error_text, parse_mode="HTML")
 
 
 # --- ЗАПУСК ---
@@ -672,13 +1012,25 @@ async def handle_message(message: Message):
 async def main():
     print("🚀 Запуск инициализации БД...")
     await init_db()
+    await latency.load()
+    latency_task = asyncio.create_task(latency.run_persistence())
+    
+    print("🔌 Прогрев соединений с OpenRouter...")
+    await warm_up()
+    await asyncio.to_thread(token_estimator.load_tokenizers)
     
     print("🤖 Бот запускается...")
     # Удаляем вебхук, чтобы не было конфликтов с предыдущими запусками
     await bot.delete_webhook(drop_pending_updates=True)
     
     print("✅ Polling запущен!")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        latency_task.cancel()
+        await latency.persist()
+        await close_openrouter()
+        await close_db()
 
 
 if __name__ == "__main__":
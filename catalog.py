@@ -0,0 +1,204 @@
+"""
+Каталог моделей OpenRouter (openrouter_models.json)
+
+Файл большой (сотни моделей с описаниями), поэтому:
+- читается один раз и только когда каталог впервые понадобился;
+- от каждой модели остаются только нужные боту поля (ModelInfo со __slots__);
+- разобранный каталог сохраняется в бинарный снимок рядом с файлом, и пока
+  JSON не менялся (mtime и размер те же), при старте читается снимок.
+
+Индексы: по id, по провайдеру (часть id до "/"), по входной модальности
+и по цене prompt-токена (для выборок "не дороже X").
+"""
+
+import json
+import os
+import pickle
+from array import array
+from bisect import bisect_right
+
+from config import MODELS, CATALOG_PATH, CATALOG_SNAPSHOT_PATH
+
+
+# Меняется при изменении формата ModelInfo - старые снимки игнорируются
+SNAPSHOT_VERSION = 1
+
+
+class ModelInfo:
+    """Модель из каталога (цены - USD за один токен)"""
+
+    __slots__ = (
+        "id", "name", "provider", "context_length", "max_completion_tokens",
+        "prompt_price", "completion_price", "cache_read_price", "cache_write_price",
+        "modality", "input_modalities", "tokenizer", "supported_parameters",
+    )
+
+    def __init__(self, raw: dict):
+        architecture = raw.get("architecture") or {}
+        pricing = raw.get("pricing") or {}
+        top_provider = raw.get("top_provider") or {}
+
+        self.id = raw["id"]
+        self.name = raw.get("name") or self.id
+        self.provider = self.id.split("/", 1)[0]
+        self.context_length = raw.get("context_length") or top_provider.get("context_length") or 0
+        self.max_completion_tokens = top_provider.get("max_completion_tokens")  # None - лимита нет
+        self.prompt_price = _price(pricing.get("prompt"))
+        self.completion_price = _price(pricing.get("completion"))
+        self.cache_read_price = _price(pricing.get("input_cache_read"), None)
+        self.cache_write_price = _price(pricing.get("input_cache_write"), None)
+        self.modality = architecture.get("modality") or "text->text"
+        self.input_modalities = tuple(architecture.get("input_modalities") or ("text",))
+        self.tokenizer = architecture.get("tokenizer") or "Other"
+        self.supported_parameters = frozenset(raw.get("supported_parameters") or ())
+
+    @property
+    def is_free(self) -> bool:
+        return self.prompt_price == 0 and self.completion_price == 0
+
+    def supports(self, parameter: str) -> bool:
+        """Принимает ли модель параметр запроса (reasoning, tools, ...)"""
+        return parameter in self.supported_parameters
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"<ModelInfo {self.id}>"
+
+
+def _price(value, default=0.0):
+    """Цена из каталога: строка "0.00000175" -> float; "-1" (динамическая цена) -> default"""
+    if value is None:
+        return default
+    try:
+        price = float(value)
+    except (TypeError, ValueError):
+        return default
+    return price if price >= 0 else default
+
+
+class Catalog:
+    """Все модели каталога и индексы по ним"""
+
+    def __init__(self, models: list[ModelInfo]):
+        self.models = models
+        self._by_id = {}
+        self._by_provider = {}
+        self._by_modality = {}
+
+        for i, model in enumerate(models):
+            self._by_id[model.id] = i
+            self._by_provider.setdefault(model.provider, []).append(i)
+            for modality in model.input_modalities:
+                self._by_modality.setdefault(modality, []).append(i)
+
+        # Индекс по цене: номера моделей, отсортированные по цене prompt, и сами цены
+        order = sorted(range(len(models)), key=lambda i: models[i].prompt_price)
+        self._price_order = array("I", order)
+        self._prices = array("d", (models[i].prompt_price for i in order))
+
+    def __len__(self):
+        return len(self.models)
+
+    def __contains__(self, model_id: str):
+        return model_id in self._by_id
+
+    def get(self, model_id: str) -> ModelInfo | None:
+        """Модель по id OpenRouter ("openai/gpt-4o")"""
+        i = self._by_id.get(model_id)
+        return self.models[i] if i is not None else None
+
+    def by_provider(self, provider: str) -> list[ModelInfo]:
+        """Модели провайдера ("openai", "google", ...)"""
+        return [self.models[i] for i in self._by_provider.get(provider, ())]
+
+    def with_modality(self, modality: str) -> list[ModelInfo]:
+        """Модели, принимающие на вход модальность ("image", "audio", ...)"""
+        return [self.models[i] for i in self._by_modality.get(modality, ())]
+
+    def cheaper_than(self, max_prompt_price: float) -> list[ModelInfo]:
+        """Модели с ценой prompt-токена не выше заданной, от дешевых к дорогим"""
+        end = bisect_right(self._prices, max_prompt_price)
+        return [self.models[i] for i in self._price_order[:end]]
+
+    def free(self) -> list[ModelInfo]:
+        """Бесплатные модели"""
+        return [m for m in self.cheaper_than(0.0) if m.is_free]
+
+    def providers(self) -> list[str]:
+        return sorted(self._by_provider)
+
+
+def _source_stamp(path: str) -> tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _load_snapshot(path: str, stamp: tuple[int, int]) -> list[ModelInfo] | None:
+    """Снимок, если он есть и сделан с того же JSON"""
+    try:
+        with open(path, "rb") as f:
+            version, snapshot_stamp, models = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"⚠️ Снимок каталога поврежден, перечитываем JSON: {e}")
+        return None
+    if version != SNAPSHOT_VERSION or tuple(snapshot_stamp) != stamp:
+        return None
+    return models
+
+
+def _save_snapshot(path: str, stamp: tuple[int, int], models: list[ModelInfo]):
+    # Пишем во временный файл и подменяем: параллельный запуск не прочитает половину
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump((SNAPSHOT_VERSION, stamp, models), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить снимок каталога: {e}")
+
+
+def load_catalog(path: str = CATALOG_PATH, snapshot_path: str | None = CATALOG_SNAPSHOT_PATH) -> Catalog:
+    """Читает каталог (из снимка, если JSON не менялся)"""
+    if not os.path.exists(path):
+        print(f"⚠️ Каталог моделей не найден: {path}")
+        return Catalog([])
+
+    stamp = _source_stamp(path)
+    models = _load_snapshot(snapshot_path, stamp) if snapshot_path else None
+
+    if models is None:
+        with open(path, encoding="utf-8") as f:
+            raw = json.load(f)
+        models = [ModelInfo(item) for item in raw.get("data", [])]
+        if snapshot_path:
+            _save_snapshot(snapshot_path, stamp, models)
+        print(f"📚 Каталог моделей разобран из JSON: {len(models)} моделей")
+
+    return Catalog(models)
+
+
+_catalog: Catalog | None = None
+
+
+def get_catalog() -> Catalog:
+    """Каталог, загруженный при первом обращении"""
+    global _catalog
+    if _catalog is None:
+        _catalog = load_catalog()
+    return _catalog
+
+
+def model_info(model_key: str) -> ModelInfo | None:
+    """Данные каталога для модели бота (ключ из config.MODELS)"""
+    model = MODELS.get(model_key)
+    if model is None:
+        return None
+    return get_catalog().get(model["id"])
@@ -30,9 +30,176 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "YOUR_BOT_TOKEN")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "YOUR_BOT_TOKEN")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "YOUR_OPENROUTER_KEY")
 
+# Пул ключей OpenRouter: "key1,key2,key3" (лимиты бесплатных моделей - на ключ)
+# Если не задан - работаем с одним OPENROUTER_API_KEY
+OPENROUTER_API_KEYS = [
+    x.strip()
+    for x in os.getenv("OPENROUTER_API_KEYS", "").split(",")
+    if x.strip()
+] or [OPENROUTER_API_KEY]
+KEY_POOL_STRATEGY = os.getenv("KEY_POOL_STRATEGY", "least_loaded")  # least_loaded или round_robin
+KEY_QUARANTINE_SECONDS = float(os.getenv("KEY_QUARANTINE_SECONDS", "60"))  # после 429 без Retry-After
+KEY_QUOTA_QUARANTINE_SECONDS = float(os.getenv("KEY_QUOTA_QUARANTINE_SECONDS", "3600"))  # 402/401
+
+# ===== HTTP-ТРАНСПОРТ OPENROUTER =====
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+OPENROUTER_TIMEOUT = float(os.getenv("OPENROUTER_TIMEOUT", "60"))  # секунд на запрос
+
+# Общий пул соединений для всех запросов к OpenRouter
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "200"))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "50"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))  # секунд
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1"  # нужен пакет h2
+HTTP_WARMUP_CONNECTIONS = int(os.getenv("HTTP_WARMUP_CONNECTIONS", "4"))  # прогрев при старте
+
+# Сколько запросов к одной модели может идти одновременно (если не задано в MODELS)
+DEFAULT_MODEL_CONCURRENCY = int(os.getenv("DEFAULT_MODEL_CONCURRENCY", "32"))
+# Сколько запросов к одной модели может одновременно держать один пользователь
+SCHEDULER_MAX_PER_USER = int(os.getenv("SCHEDULER_MAX_PER_USER", "2"))
+
+# Адаптивный лимит: max_concurrency модели - потолок, реальный лимит подстраивается под ответы API
+ADAPTIVE_CONCURRENCY_ENABLED = os.getenv("ADAPTIVE_CONCURRENCY_ENABLED", "1") == "1"
+ADAPTIVE_MIN_CONCURRENCY = int(os.getenv("ADAPTIVE_MIN_CONCURRENCY", "2"))
+ADAPTIVE_BACKOFF = float(os.getenv("ADAPTIVE_BACKOFF", "0.7"))  # во сколько раз режем лимит при перегрузке
+ADAPTIVE_LATENCY_TOLERANCE = float(os.getenv("ADAPTIVE_LATENCY_TOLERANCE", "3.0"))  # рост задержки = перегрузка
+ADAPTIVE_DECREASE_COOLDOWN = float(os.getenv("ADAPTIVE_DECREASE_COOLDOWN", "2.0"))  # секунд между снижениями
+
+# Сброс нагрузки: эти тарифы получают "занято, повторите через N с" вместо долгой очереди
+SHED_TIERS = ["free"]
+SHED_MAX_WAIT = float(os.getenv("SHED_MAX_WAIT", "20"))  # секунд ожидания слота
+
+# ===== ПОВТОРЫ И ЗАПАСНЫЕ МОДЕЛИ =====
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))  # попыток на одну модель
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1.0"))  # секунд, растет x2 с каждой попыткой
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "15.0"))  # дольше ждать не будем - идем к запасной модели
+RETRY_TOTAL_BUDGET = float(os.getenv("RETRY_TOTAL_BUDGET", "120.0"))  # секунд на все попытки вместе
+
+# ===== CIRCUIT BREAKER (по каждой модели) =====
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "60"))  # окно статистики
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "5"))  # меньше - не судим
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))  # доля ошибок для размыкания
+BREAKER_SLOW_CALL = float(os.getenv("BREAKER_SLOW_CALL", "30"))  # секунд - дольше считается ошибкой
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))  # сколько модель отключена
+BREAKER_HALF_OPEN_MAX = int(os.getenv("BREAKER_HALF_OPEN_MAX", "1"))  # пробных запросов после паузы
+
+# ===== ЗАДЕРЖКИ МОДЕЛЕЙ И ХЕДЖИРОВАНИЕ =====
+LATENCY_SAMPLES = int(os.getenv("LATENCY_SAMPLES", "500"))  # последних замеров на модель
+LATENCY_MIN_SAMPLES = int(os.getenv("LATENCY_MIN_SAMPLES", "20"))  # меньше - перцентилям не верим
+LATENCY_PERSIST_INTERVAL = float(os.getenv("LATENCY_PERSIST_INTERVAL", "300"))  # секунд между сохранениями в БД
+# Таймаут запроса = перцентиль задержки модели * множитель (пока замеров мало - OPENROUTER_TIMEOUT)
+LATENCY_TIMEOUT_PERCENTILE = float(os.getenv("LATENCY_TIMEOUT_PERCENTILE", "0.99"))
+LATENCY_TIMEOUT_FACTOR = float(os.getenv("LATENCY_TIMEOUT_FACTOR", "2.0"))
+LATENCY_TIMEOUT_MIN = float(os.getenv("LATENCY_TIMEOUT_MIN", "15"))  # секунд - быстрее не обрываем
+LATENCY_TIMEOUT_MAX = float(os.getenv("LATENCY_TIMEOUT_MAX", "120"))  # секунд - дольше не ждем
+# Дублировать медленный запрос в другую бесплатную модель (см. hedging.py)
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "0") == "1"
+HEDGE_TIERS = ["free"]  # тарифы, для которых включено хеджирование
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))  # ждем "обычное" время модели
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "8.0"))  # секунд, пока нет статистики
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "2.0"))  # секунд - раньше не дублируем
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.1"))  # не больше 10% запросов дублируются
+HEDGE_BURST = float(os.getenv("HEDGE_BURST", "5"))  # запас хеджей на всплеск
+
+# ===== КЭШ ПОЛЬЗОВАТЕЛЕЙ =====
+# Строки users в памяти процесса (см. database.py): команды и кнопки не ходят в БД
+USER_CACHE_ENABLED = os.getenv("USER_CACHE_ENABLED", "1") == "1"
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))  # секунд
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))  # пользователей в памяти
+# Несколько процессов бота на одной БД: записи другого процесса этот не видит,
+# поэтому кэш живет USER_CACHE_SHARED_TTL, запись сбрасывает его, а лимиты читаются из БД
+USER_CACHE_MULTIPROCESS = os.getenv("USER_CACHE_MULTIPROCESS", "0") == "1"
+USER_CACHE_SHARED_TTL = float(os.getenv("USER_CACHE_SHARED_TTL", "5"))  # секунд
+
+# ===== КЭШ ИСТОРИИ ЧАТОВ =====
+# Последние сообщения активных чатов в памяти (см. database.py): обычный ход диалога не читает историю из БД.
+# При USER_CACHE_MULTIPROCESS выключен - сообщения, записанные другим процессом, этот не видит
+HISTORY_CACHE_ENABLED = os.getenv("HISTORY_CACHE_ENABLED", "1") == "1"
+HISTORY_CACHE_MESSAGES = int(os.getenv("HISTORY_CACHE_MESSAGES", "200"))  # сообщений на чат (не меньше CONTEXT_MAX_MESSAGES)
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))  # текста на все чаты
+
+# ===== КЭШ ОТВЕТОВ ДЛЯ /ask =====
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))  # секунд
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))  # записей в памяти
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(20 * 1024 * 1024)))  # текста в памяти
+RESPONSE_CACHE_PERSISTENT = os.getenv("RESPONSE_CACHE_PERSISTENT", "1") == "1"  # второй уровень в SQLite
+RESPONSE_CACHE_PERSISTENT_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_PERSISTENT_MAX_ENTRIES", "50000"))
+# Доля от обычной цены, которую списываем за ответ из кэша (0 - бесплатно, 1 - как за новый)
+RESPONSE_CACHE_HIT_CHARGE = float(os.getenv("RESPONSE_CACHE_HIT_CHARGE", "0"))
+
+# Одинаковые одновременные запросы отправляются в API один раз (см. singleflight.py);
+# кто получил чужой ответ, платит как за попадание в кэш (RESPONSE_CACHE_HIT_CHARGE)
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "1") == "1"
+
+# ===== СТРИМИНГ ОТВЕТОВ =====
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "1") == "1"
+# Telegram режет частые правки: ~1 в секунду в личке, ~20 в минуту в группах
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # секунд, личные чаты
+STREAM_EDIT_INTERVAL_GROUP = float(os.getenv("STREAM_EDIT_INTERVAL_GROUP", "3.0"))  # секунд, группы
+
+# ===== КАТАЛОГ МОДЕЛЕЙ OPENROUTER =====
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CATALOG_PATH = os.getenv("CATALOG_PATH", os.path.join(_BASE_DIR, "openrouter_models.json"))
+# Разобранный каталог (пересоздается, когда меняется JSON); пусто - не сохранять
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", os.path.join(_BASE_DIR, "openrouter_models.cache")) or None
+
+# ===== ОЦЕНКА ТОКЕНОВ =====
+TOKEN_ESTIMATE_CACHE_SIZE = int(os.getenv("TOKEN_ESTIMATE_CACHE_SIZE", "20000"))  # запомненных текстов
+TOKEN_CALIBRATION_WEIGHT = float(os.getenv("TOKEN_CALIBRATION_WEIGHT", "0.1"))  # скорость подстройки по usage
+
+# ===== КОНТЕКСТ ДИАЛОГА =====
+CONTEXT_DEFAULT_LENGTH = int(os.getenv("CONTEXT_DEFAULT_LENGTH", "32000"))  # если модели нет в каталоге
+CONTEXT_OUTPUT_RESERVE = int(os.getenv("CONTEXT_OUTPUT_RESERVE", "4096"))  # токенов окна оставляем на ответ
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", "200"))  # сообщений истории, даже если влезает больше
+
+# Сжатие старой части длинных чатов (см. summarizer.py)
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "1") == "1"
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "mimo")  # дешевая бесплатная модель
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "6000"))  # несжатой истории - пора сжимать
+SUMMARY_KEEP_TOKENS = int(os.getenv("SUMMARY_KEEP_TOKENS", "2000"))  # последние сообщения остаются как есть
+SUMMARY_FOLD_MAX_TOKENS = int(os.getenv("SUMMARY_FOLD_MAX_TOKENS", "12000"))  # сжимаем за раз (длинный старый чат - по частям)
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "300"))
+SUMMARY_MESSAGE_MAX_CHARS = int(os.getenv("SUMMARY_MESSAGE_MAX_CHARS", "4000"))  # длинные ответы режем
+
+# Длина ответа: реальный max_tokens на запрос считается по модели и остатку лимита (см. openrouter.get_max_tokens)
+MAX_COMPLETION_TOKENS = int(os.getenv("MAX_COMPLETION_TOKENS", "16384"))
+MIN_COMPLETION_TOKENS = int(os.getenv("MIN_COMPLETION_TOKENS", "256"))  # меньше ответу не оставляем
+
+# Кэш промпта у провайдера: метки cache_control для Anthropic/Gemini (см. prompt_cache.py)
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "1") == "1"
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))  # короче провайдеры не кэшируют
+
 # База данных
 DATABASE_URL = "sqlite+aiosqlite:///./ai_bot.db"
 
+# Профиль SQLite: PRAGMA на каждом новом соединении + пул соединений (см. database.make_engine)
+#   journal_mode=WAL - читатели не ждут писателя; synchronous=NORMAL - fsync на checkpoint, а не на каждый commit
+#   (в WAL это не портит базу, при сбое питания теряются только последние транзакции);
+#   busy_timeout - мс ждать блокировку вместо "database is locked"; cache_size < 0 - в КиБ;
+#   pool - None: без пула (NullPool, новое соединение и поток aiosqlite на каждую сессию)
+SQLITE_PROFILES = {
+    # Настройки SQLite по умолчанию (rollback journal, synchronous=FULL) - для сравнения
+    "default": {
+        "pragmas": {},
+        "pool": None,
+    },
+    "wal": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": 5000,
+            "cache_size": -64000,        # 64 МБ страничного кэша на соединение
+            "mmap_size": 268435456,      # 256 МБ файла базы читаются через mmap
+            "temp_store": "MEMORY",
+        },
+        # В WAL писатель один, а читателей много - держим несколько открытых соединений.
+        # Функция database.py держит не больше одного соединения (вложенных сессий нет,
+        # см. test_db_pool.py), так что pool_size + max_overflow = одновременных операций с БД
+        "pool": {"pool_size": 5, "max_overflow": 5, "pool_timeout": 30, "pool_recycle": 3600},
+    },
+}
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "wal")
+
 # Лимиты
 DAILY_LIMIT = 5  # Запросов в день для бесплатных юзеров
 
@@ -41,40 +208,66 @@ MODELS = {
         "id": "xiaomi/mimo-v2-flash:free",
         "name": "🆓 Xiaomi Mimo",
         "description": "Быстрая бесплатная модель от Xiaomi",
-        "free": True
+        "free": True,
+        "max_concurrency": 16,
+        "fallback": ["devstral", "chimera", "gemini"]  # запасные модели (с учетом тарифа)
     },
     "chimera": {
         "id": "tngtech/deepseek-r1t2-chimera:free",
         "name": "🆓 DeepSeek Chimera",
         "description": "Бесплатная reasoning модель",
-        "free": True
+        "free": True,
+        "max_concurrency": 16,
+        "fallback": ["mimo", "devstral", "gemini"],
+        "reasoning": {"effort": "low", "exclude": True}  # думает долго - ограничиваем
     },
     "devstral": {
         "id": "mistralai/devstral-2512:free",
         "name": "🆓 Devstral",
         "description": "Бесплатная модель Mistral для кода",
-        "free": True
+        "free": True,
+        "max_concurrency": 16,
+        "fallback": ["mimo", "chimera", "gemini"]
     },
     "gemini": {
         "id": "google/gemini-2.5-flash",
         "name": "⚡ Gemini 2.5 Flash",
         "description": "Быстрая и дешевая ($0.003)",
-        "free": False
+        "free": False,
+        "max_concurrency": 64,
+        "fallback": ["gpt4", "mimo"],
+        "provider": {"sort": "throughput"}  # быстрая модель - важна скорость генерации
     },
     "claude": {
         "id": "anthropic/claude-sonnet-4.5",
         "name": "🧠 Claude Sonnet 4.5",
         "description": "Баланс качества и цены",
-        "free": False
+        "free": False,
+        "max_concurrency": 64,
+        "fallback": ["gpt4", "gemini"],
+        "provider": {"order": ["Anthropic", "Amazon Bedrock", "Google"], "allow_fallbacks": True}
     },
     "gpt4": {
         "id": "openai/gpt-4o",
         "name": "🚀 GPT-4o",
         "description": "Топовая модель OpenAI",
-        "free": False
+        "free": False,
+        "max_concurrency": 64,
+        "fallback": ["claude", "gemini"],
+        "provider": {"only": ["OpenAI", "Azure"]}
     }
 }
 
+# "provider" у модели и тарифа - предпочтения маршрутизации OpenRouter (поле provider в запросе):
+#   sort: "latency" | "throughput" | "price" - как выбирать провайдера
+#   order: [...] - в каком порядке пробовать, only / ignore: [...] - разрешенные / запрещенные
+#   allow_fallbacks: можно ли уходить к другим провайдерам, если выбранные недоступны
+# Настройки модели важнее настроек тарифа
+# "reasoning" только у модели - для моделей, которые думают всегда (см. reasoning.py):
+#   effort: "low" | "medium" | "high" - сколько думать, exclude: True - не присылать сами рассуждения
+#   У Claude/Gemini этот параметр ВКЛЮЧАЕТ платное мышление (больше токенов, цена и задержка,
+#   у Anthropic еще и бюджет от 1024 токенов) - им его не задаем
+
 # ===== ТАРИФНЫЕ ПЛАНЫ =====
 
 SUBSCRIPTION_TIERS = {
@@ -83,6 +276,9 @@ SUBSCRIPTION_TIERS = {
         "monthly_tokens": 100_000,      # ~30-50 запросов средней длины
         "allowed_models": ["mimo", "chimera", "devstral"],  # только бесплатные
         "price_rub": 0,
+        "scheduler_weight": 1,          # доля слотов в очереди к моделям
+        "context_tokens": 8_000,        # потолок контекста на запрос (история + промпт)
+        "provider": {"sort": "throughput"},  # маршрутизация OpenRouter (см. MODELS)
         "description": "Базовый тариф с доступом к бесплатным моделям"
     },
     "pro": {
@@ -90,6 +286,9 @@ SUBSCRIPTION_TIERS = {
         "monthly_tokens": 2_000_000,   # ~600-1000 запросов
         "allowed_models": "all",        # все модели
         "price_rub": 299,
+        "scheduler_weight": 4,
+        "context_tokens": 32_000,
+        "provider": {"sort": "latency"},
         "description": "Доступ ко всем моделям с большим лимитом"
     },
     "unlimited": {
@@ -97,6 +296,9 @@ SUBSCRIPTION_TIERS = {
         "monthly_tokens": 50_000_000,  # практически безлимит
         "allowed_models": "all",
         "price_rub": 999,
+        "scheduler_weight": 8,
+        "context_tokens": 128_000,
+        "provider": {"sort": "latency"},
         "description": "Максимальный тариф для профессионалов"
     }
 }
@@ -0,0 +1,65 @@
+"""
+Сборка контекста для запроса к модели в пределах бюджета токенов
+
+Вместо фиксированных "последних 15 пар" в запрос идет столько свежих
+сообщений чата, сколько помещается в бюджет:
+- окно контекста модели (context_length из каталога) минус запас на ответ;
+- потолок тарифа (SUBSCRIPTION_TIERS[...]["context_tokens"]);
+- остаток месячного лимита пользователя.
+Системный промпт и новое сообщение входят в бюджет первыми, затем
+summary старой части чата (если есть), затем свежие сообщения.
+"""
+
+from config import (
+    SUBSCRIPTION_TIERS, CONTEXT_DEFAULT_LENGTH, CONTEXT_OUTPUT_RESERVE, CONTEXT_MAX_MESSAGES,
+    MIN_COMPLETION_TOKENS
+)
+from catalog import model_info
+from database import RequestContext
+from summarizer import SUMMARY_PREFIX
+from token_estimator import estimate_text_tokens, MESSAGE_OVERHEAD, REPLY_OVERHEAD
+
+
+def get_context_budget(model_key: str, tier: str, remaining_tokens: int) -> int:
+    """Сколько токенов может занять весь запрос (системный промпт + история + новое сообщение)"""
+    info = model_info(model_key)
+    context_length = info.context_length if info is not None and info.context_length else CONTEXT_DEFAULT_LENGTH
+
+    reserve = CONTEXT_OUTPUT_RESERVE
+    if info is not None and info.max_completion_tokens:
+        reserve = min(reserve, info.max_completion_tokens)
+
+    tier_limit = SUBSCRIPTION_TIERS.get(tier, SUBSCRIPTION_TIERS["free"]).get("context_tokens", context_length)
+    # Из остатка лимита часть оставляем на ответ
+    return min(context_length - reserve, tier_limit, remaining_tokens - MIN_COMPLETION_TOKENS)
+
+
+async def build_context(context: RequestContext, model_key: str, user_text: str, system_prompt: str | None,
+                        tier: str, remaining_tokens: int) -> tuple[list | None, int]:
+    """
+    Собирает messages для запроса
+
+    Returns:
+        tuple: (messages, оценка токенов запроса);
+               messages = None, если даже новое сообщение с системным промптом не помещается
+    """
+    budget = get_context_budget(model_key, tier, remaining_tokens)
+
+    # Обязательная часть: новое сообщение, системный промпт, служебные токены
+    required = REPLY_OVERHEAD + MESSAGE_OVERHEAD + estimate_text_tokens(user_text, model_key)
+    if system_prompt:
+        required += MESSAGE_OVERHEAD + estimate_text_tokens(system_prompt, model_key)
+    if required > budget:
+        return None, required
+
+    history, history_tokens, summary = await context.load_history(budget - required, CONTEXT_MAX_MESSAGES)
+
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    if summary:
+        # Старая часть чата - сжатым пересказом (см. summarizer)
+        messages.append({"role": "system", "content": f"{SUMMARY_PREFIX}\n{summary}"})
+    messages.extend(history)
+    messages.append({"role": "user", "content": user_text})
+    return messages, required + history_tokens
@@ -1,14 +1,59 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Float, JSON
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Float, JSON, Index, event
+from sqlalchemy.pool import NullPool, AsyncAdaptedQueuePool
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+import time
 import uuid
-from config import DATABASE_URL
+from config import (
+    DATABASE_URL, SQLITE_PROFILES, SQLITE_PROFILE,
+    USER_CACHE_ENABLED, USER_CACHE_TTL, USER_CACHE_MAX_ENTRIES, USER_CACHE_MULTIPROCESS, USER_CACHE_SHARED_TTL,
+    HISTORY_CACHE_ENABLED, HISTORY_CACHE_MESSAGES, HISTORY_CACHE_MAX_BYTES
+)
+from token_estimator import estimate_text_tokens, MESSAGE_OVERHEAD
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from sqlalchemy import JSON
 
 
 Base = declarative_base()
-engine = create_async_engine(DATABASE_URL, echo=False)
+
+# Строк за одну выборку при выгрузке всей таблицы messages (get_message_usage)
+USAGE_BATCH_ROWS = 50_000
+
+
+def make_engine(url: str = DATABASE_URL, profile: str = SQLITE_PROFILE):
+    """
+    Движок БД; для SQLite - с профилем из SQLITE_PROFILES (PRAGMA на каждом соединении и пул)
+    """
+    if not url.startswith("sqlite"):
+        return create_async_engine(url, echo=False)
+    
+    settings = SQLITE_PROFILES[profile]
+    pool = settings.get("pool")
+    if pool:
+        # Для aiosqlite SQLAlchemy по умолчанию берет NullPool - пул задаем явно
+        new_engine = create_async_engine(url, echo=False, poolclass=AsyncAdaptedQueuePool, **pool)
+    else:
+        new_engine = create_async_engine(url, echo=False, poolclass=NullPool)
+    
+    pragmas = settings.get("pragmas") or {}
+    if pragmas:
+        @event.listens_for(new_engine.sync_engine, "connect")
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+    
+    return new_engine
+
+
+engine = make_engine()
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
@@ -55,6 +100,17 @@ class Message(Base):
     output_tokens = Column(Integer, default=0)       # выходных токенов
     cost_usd = Column(Float, default=0.0)            # стоимость запроса
     response_time = Column(Float, default=0.0)       # время ответа в секундах
+    token_count = Column(Integer, nullable=True)     # оценка токенов content (для бюджета контекста)
+    provider = Column(String, nullable=True)         # провайдер OpenRouter, который ответил
+    reasoning_tokens = Column(Integer, default=0)    # из output_tokens - на рассуждения модели
+    cached_tokens = Column(Integer, default=0)       # из input_tokens - прочитано из кэша провайдера
+    cache_write_tokens = Column(Integer, default=0)  # из input_tokens - записано в кэш провайдера
+    
+    # session_id - UUID конкретного юзера, поэтому telegram_id в индекс не нужен:
+    # история чата, удаление чата и поиск по telegram_id + session_id идут по нему
+    __table_args__ = (
+        Index("ix_messages_session_id_created_at", "session_id", "created_at"),
+    )
 
 class ChatSession(Base):
     __tablename__ = "chat_sessions"
@@ -66,7 +122,315 @@ class ChatSession(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow)
     is_auto_titled = Column(Boolean, default=True)  # Автоматическое название
+    
+    # Сжатое содержание старой части чата (см. summarizer.py)
+    summary = Column(String, nullable=True)
+    summary_until_id = Column(Integer, nullable=True)  # последнее сообщение, вошедшее в summary
+    summary_tokens = Column(Integer, nullable=True)
+    
+    # Список чатов юзера (/chats) - по user_id, свежие сверху
+    __table_args__ = (
+        Index("ix_chat_sessions_user_id_updated_at", "user_id", "updated_at"),
+    )
+
+
+class CachedResponse(Base):
+    """Постоянный уровень кэша ответов (/ask), см. response_cache.py"""
+    __tablename__ = "response_cache"
+    
+    id = Column(Integer, primary_key=True)
+    cache_key = Column(String, unique=True, nullable=False)  # sha256 от модели + сообщений + параметров
+    model_used = Column(String, nullable=False)
+    response = Column(String, nullable=False)
+    tokens_used = Column(Integer, default=0)
+    input_tokens = Column(Integer, default=0)
+    output_tokens = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    hits = Column(Integer, default=0)
+
+
+class LatencySamples(Base):
+    """Последние замеры задержек моделей (переживают перезапуск), см. latency.py"""
+    __tablename__ = "latency_samples"
+    
+    series = Column(String, primary_key=True)   # модель или модель@провайдер
+    kind = Column(String, primary_key=True)     # ttft / total / per_token
+    samples = Column(JSON, nullable=False)      # секунды, от старых к новым
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+# ===== КЭШ ПОЛЬЗОВАТЕЛЕЙ =====
+
+class _UserCache:
+    """
+    Строки users в памяти: LRU с TTL, ключ - telegram_id
+    
+    Кэшируется сам объект User (отсоединенный от сессии), поэтому функции,
+    которые меняют пользователя, после записи в БД меняют и его (write-through):
+    update() - присваивание полей, add() - приращение счетчиков.
+    
+    В режиме USER_CACHE_MULTIPROCESS записи других процессов не видны:
+    запись только сбрасывает кэш, а запись живет USER_CACHE_SHARED_TTL.
+    """
+    
+    def __init__(self):
+        self.enabled = USER_CACHE_ENABLED
+        self.shared = USER_CACHE_MULTIPROCESS
+        self.ttl = min(USER_CACHE_TTL, USER_CACHE_SHARED_TTL) if self.shared else USER_CACHE_TTL
+        self._entries: OrderedDict[int, tuple[float, User]] = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+    
+    def get(self, telegram_id: int) -> User | None:
+        entry = self._entries.get(telegram_id)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(telegram_id)
+            self.stats["hits"] += 1
+            return entry[1]
+        if entry:
+            del self._entries[telegram_id]
+        self.stats["misses"] += 1
+        return None
+    
+    def peek(self, telegram_id: int) -> User | None:
+        """Запись без учета в статистике и без проверки TTL"""
+        entry = self._entries.get(telegram_id)
+        return entry[1] if entry else None
+    
+    def put(self, user: User):
+        if not self.enabled or user is None:
+            return
+        self._entries[user.telegram_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user.telegram_id)
+        while len(self._entries) > USER_CACHE_MAX_ENTRIES:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+    
+    def update(self, telegram_id: int, **fields):
+        """Write-through: то же присваивание, что ушло в БД"""
+        user = self.peek(telegram_id)
+        if user is None:
+            return
+        if self.shared:
+            self.invalidate(telegram_id)
+            return
+        for name, value in fields.items():
+            setattr(user, name, value)
+    
+    def add(self, telegram_id: int, **deltas):
+        """Write-through для счетчиков: то же приращение, что ушло в БД"""
+        user = self.peek(telegram_id)
+        if user is None:
+            return
+        if self.shared:
+            self.invalidate(telegram_id)
+            return
+        for name, delta in deltas.items():
+            setattr(user, name, (getattr(user, name) or 0) + delta)
+    
+    def invalidate(self, telegram_id: int = None):
+        if telegram_id is None:
+            self.stats["invalidations"] += len(self._entries)
+            self._entries.clear()
+        elif self._entries.pop(telegram_id, None) is not None:
+            self.stats["invalidations"] += 1
+
+
+_user_cache = _UserCache()
+
+
+def invalidate_user_cache(telegram_id: int = None):
+    """Сбросить кэш пользователя (или всех) - например, после правки users в обход этих функций"""
+    _user_cache.invalidate(telegram_id)
+
+
+def user_cache_stats() -> dict:
+    """Счетчики кэша пользователей для логов и админки"""
+    total = _user_cache.stats["hits"] + _user_cache.stats["misses"]
+    return dict(
+        _user_cache.stats,
+        size=len(_user_cache._entries),
+        hit_ratio=_user_cache.stats["hits"] / total if total else 0.0,
+        mode="multiprocess" if _user_cache.shared else "process",
+    )
+
+
+# ===== КЭШ ИСТОРИИ ЧАТОВ =====
+
+# Примерный расход памяти на сообщение сверх текста (кортеж, строки, числа)
+_HISTORY_ENTRY_OVERHEAD = 200
+
+
+def _message_tokens(content: str, token_count: int | None) -> int:
+    """Токены сообщения в истории - как в SQL-запросе get_context_history"""
+    return (token_count if token_count is not None else len(content) // 3 + 1) + MESSAGE_OVERHEAD
+
+
+class _SessionHistory:
+    """Кольцевой буфер последних сообщений одного чата: (id, role, content, токены)"""
+    
+    __slots__ = ("messages", "complete", "size")
+    
+    def __init__(self, rows: list, complete: bool):
+        self.messages = deque()
+        self.complete = complete   # в буфере весь чат (старше сообщений в БД нет)
+        self.size = 0
+        for row in rows:
+            self.append(*row)
+    
+    def append(self, message_id: int, role: str, content: str, tokens: int):
+        if len(self.messages) >= HISTORY_CACHE_MESSAGES:
+            _, _, old, _ = self.messages.popleft()
+            self.size -= len(old.encode("utf-8")) + _HISTORY_ENTRY_OVERHEAD
+            self.complete = False
+        self.messages.append((message_id, role, content, tokens))
+        self.size += len(content.encode("utf-8")) + _HISTORY_ENTRY_OVERHEAD
+    
+    def pick(self, budget_tokens: int, max_messages: int, after_id: int) -> tuple[list, int] | None:
+        """
+        Самые новые сообщения с id > after_id в пределах бюджета
+        
+        Returns:
+            tuple | None: (история от старых к новым, токены) или None, если буфера не хватило
+        """
+        picked = []
+        total = 0
+        for message_id, role, content, tokens in reversed(self.messages):
+            if message_id <= after_id or len(picked) >= max_messages or total + tokens > budget_tokens:
+                break
+            picked.append({"role": role, "content": content})
+            total += tokens
+        else:
+            if not self.complete and len(picked) < max_messages:
+                return None
+        picked.reverse()
+        return picked, total
+    
+    def last(self, count: int) -> list | None:
+        """Последние count сообщений (None, если в буфере их меньше, а в БД могут быть еще)"""
+        if len(self.messages) < count and not self.complete:
+            return None
+        return [{"role": role, "content": content} for _, role, content, _ in list(self.messages)[-count:]]
+
+
+class _HistoryCache:
+    """
+    Последние сообщения активных чатов в памяти, ключ - session_id
+    
+    Буфер чата заполняется одним запросом при первом обращении (или заранее -
+    prewarm_history при переключении чата) и дальше пополняется при каждой
+    записи сообщения. Чаты, к которым давно не обращались, вытесняются,
+    когда суммарный объем текста превышает HISTORY_CACHE_MAX_BYTES.
+    """
+    
+    def __init__(self):
+        self.enabled = HISTORY_CACHE_ENABLED and not USER_CACHE_MULTIPROCESS
+        self._sessions: OrderedDict[str, _SessionHistory] = OrderedDict()
+        self._bytes = 0
+        self._loading: dict[str, bool] = {}   # session_id -> пришли ли новые сообщения, пока грузили
+        self.stats = {"hits": 0, "misses": 0, "fallbacks": 0, "evictions": 0}
+    
+    def _touch(self, session_id: str) -> _SessionHistory | None:
+        history = self._sessions.get(session_id)
+        if history is not None:
+            self._sessions.move_to_end(session_id)
+        return history
+    
+    def peek(self, session_id: str) -> _SessionHistory | None:
+        """Буфер чата, если он уже в памяти (без загрузки и без счета попаданий)"""
+        return self._sessions.get(session_id) if self.enabled else None
+    
+    def _store(self, session_id: str, history: _SessionHistory):
+        self.drop(session_id)
+        self._sessions[session_id] = history
+        self._bytes += history.size
+        self._evict()
+    
+    def _evict(self):
+        while self._sessions and self._bytes > HISTORY_CACHE_MAX_BYTES:
+            _, history = self._sessions.popitem(last=False)
+            self._bytes -= history.size
+            self.stats["evictions"] += 1
+    
+    async def get(self, session_id: str) -> _SessionHistory | None:
+        """Буфер чата; при первом обращении загружается из БД"""
+        if not self.enabled:
+            return None
+        history = self._touch(session_id)
+        if history is not None:
+            self.stats["hits"] += 1
+            return history
+        
+        self.stats["misses"] += 1
+        self._loading[session_id] = False
+        try:
+            async with async_session() as session:
+                from sqlalchemy import select
+                
+                result = await session.execute(
+                    select(Message.id, Message.role, Message.content, Message.token_count)
+                    .where(Message.session_id == session_id)
+                    .order_by(Message.created_at.desc(), Message.id.desc())
+                    .limit(HISTORY_CACHE_MESSAGES + 1)
+                )
+                rows = result.all()
+        finally:
+            changed = self._loading.pop(session_id, False)
+        
+        complete = len(rows) <= HISTORY_CACHE_MESSAGES
+        history = _SessionHistory(
+            [(row.id, row.role, row.content, _message_tokens(row.content, row.token_count))
+             for row in reversed(rows[:HISTORY_CACHE_MESSAGES])],
+            complete,
+        )
+        # Пока грузили, в чат записали сообщение - этот снимок мог его не застать, не храним
+        if not changed:
+            self._store(session_id, history)
+        return history
+    
+    def create_empty(self, session_id: str):
+        """Новый чат: сообщений точно нет, грузить нечего"""
+        if self.enabled:
+            self._store(session_id, _SessionHistory([], complete=True))
+    
+    def append(self, message: Message):
+        """Сообщение записано в БД - дописываем в буфер чата (если он загружен)"""
+        if message.session_id in self._loading:
+            self._loading[message.session_id] = True
+        history = self._sessions.get(message.session_id)
+        if history is None:
+            return
+        self._bytes -= history.size
+        history.append(message.id, message.role, message.content,
+                       _message_tokens(message.content, message.token_count))
+        self._bytes += history.size
+        self._evict()
+    
+    def drop(self, session_id: str):
+        if session_id in self._loading:
+            self._loading[session_id] = True
+        history = self._sessions.pop(session_id, None)
+        if history is not None:
+            self._bytes -= history.size
+
+
+_history_cache = _HistoryCache()
+
 
+async def prewarm_history(session_id: str):
+    """Загружает историю чата в память заранее (например, при переключении на него)"""
+    await _history_cache.get(session_id)
+
+
+def history_cache_stats() -> dict:
+    """Счетчики кэша истории для логов и админки"""
+    total = _history_cache.stats["hits"] + _history_cache.stats["misses"]
+    return dict(
+        _history_cache.stats,
+        sessions=len(_history_cache._sessions),
+        bytes=_history_cache._bytes,
+        hit_ratio=_history_cache.stats["hits"] / total if total else 0.0,
+    )
 
 
 # Инициализация БД
@@ -76,8 +440,17 @@ async def init_db():
     print("✅ База данных инициализирована")
 
 
+async def close_db():
+    """Закрывает соединения пула при остановке бота"""
+    await engine.dispose()
+
+
 # Получить или создать юзера
 async def get_or_create_user(telegram_id: int, username: str = None):
+    user = _user_cache.get(telegram_id)
+    if user:
+        return user
+    
     async with async_session() as session:
         from sqlalchemy import select
         
@@ -93,6 +466,7 @@ async def get_or_create_user(telegram_id: int, username: str = None):
             await session.refresh(user)
             print(f"✅ Новый юзер создан: {telegram_id}")
         
+        _user_cache.put(user)
         return user
 
 
@@ -138,6 +512,9 @@ async def check_and_update_limit(telegram_id: int) -> tuple[bool, int]:
             can_request = True
         
         await session.commit()
+        _user_cache.update(
+            telegram_id, requests_today=user.requests_today, last_request_date=user.last_request_date
+        )
         return can_request, remaining
 
 
@@ -154,55 +531,80 @@ async def update_selected_model(telegram_id: int, model_key: str):
         if user:
             user.selected_model = model_key
             await session.commit()
+            _user_cache.update(telegram_id, selected_model=model_key)
             print(f"✅ Модель обновлена для {telegram_id}: {model_key}")
 
 
 # Получить инфо о юзере
-async def get_user_info(telegram_id: int):
+async def get_user_info(telegram_id: int, fresh: bool = False):
+    """fresh=True - мимо кэша (нужны точные данные, например счетчики в мультипроцессном режиме)"""
+    if not fresh:
+        user = _user_cache.get(telegram_id)
+        if user:
+            return user
+    
     async with async_session() as session:
         from sqlalchemy import select
         
         result = await session.execute(
             select(User).where(User.telegram_id == telegram_id)
         )
-        return result.scalar_one_or_none()
+        user = result.scalar_one_or_none()
+    
+    if user and not (fresh and _user_cache.shared):
+        _user_cache.put(user)
+    return user
 
 
 # Сохранить сообщение в историю
-async def save_message(telegram_id: int, role: str, content: str, model_used: str = None):
+async def save_message(telegram_id: int, role: str, content: str, model_used: str = None,
+                       usage: dict = None):
+    """
+    usage: для ответа модели - {"tokens_used", "input_tokens", "output_tokens",
+           "cost_usd", "response_time", "provider", "reasoning_tokens", "cached_tokens",
+           "cache_write_tokens"} (нужно для аудита цен, см. get_message_usage)
+    """
+    # Получаем текущую сессию пользователя (до своей сессии БД - не держим два соединения пула)
+    user = await get_user_info(telegram_id)
+    
+    # Если у юзера нет активной сессии - создаем первую
+    if not user.current_session_id:
+        session_id = await create_new_session(telegram_id, "Чат 1")
+    else:
+        session_id = user.current_session_id
+    
     async with async_session() as session:
-        # Получаем текущую сессию пользователя
-        user = await get_user_info(telegram_id)
-        
-        # Если у юзера нет активной сессии - создаем первую
-        if not user.current_session_id:
-            session_id = await create_new_session(telegram_id, "Чат 1")
-        else:
-            session_id = user.current_session_id
-        
         message = Message(
             telegram_id=telegram_id,
             role=role,
             content=content,
             model_used=model_used,
-            session_id=session_id  # Привязываем к чату!
+            session_id=session_id,  # Привязываем к чату!
+            token_count=estimate_text_tokens(content),
+            **(usage or {})
         )
         session.add(message)
         await session.commit()
+        _history_cache.append(message)
 
 # Получить последние N сообщений юзера из ТЕКУЩЕГО чата
 async def get_conversation_history(telegram_id: int, limit: int = 10):
     """
     Возвращает последние N пар сообщений (user + assistant) из текущего чата
     """
+    # Получаем текущую сессию
+    user = await get_user_info(telegram_id)
+    if not user or not user.current_session_id:
+        return []
+    
+    cached = await _history_cache.get(user.current_session_id)
+    history = cached.last(limit * 2) if cached is not None else None
+    if history is not None:
+        return history
+    
     async with async_session() as session:
         from sqlalchemy import select
         
-        # Получаем текущую сессию
-        user = await get_user_info(telegram_id)
-        if not user or not user.current_session_id:
-            return []
-        
         result = await session.execute(
             select(Message)
             .where(
@@ -225,15 +627,155 @@ async def get_conversation_history(telegram_id: int, limit: int = 10):
         return history
 
 
+# Последние сообщения текущего чата, которые помещаются в бюджет токенов
+async def get_context_history(telegram_id: int, budget_tokens: int, max_messages: int = 200):
+    """
+    Возвращает самые новые сообщения текущего чата, суммарно не больше budget_tokens
+    
+    Returns:
+        tuple: (история от старых к новым, сколько токенов она занимает вместе с summary, summary или None)
+    """
+    context = await load_request_context(telegram_id)
+    return await context.load_history(budget_tokens, max_messages)
+
+
+async def _select_context_history(telegram_id: int, chat: ChatSession | None, session_id: str,
+                                  budget_tokens: int, max_messages: int):
+    """
+    Если у чата есть summary, сообщения, вошедшие в него, не выбираются,
+    а summary занимает бюджет первым.
+    
+    Сообщения берутся из кэша истории чата. Если его не хватило, отбор делает сама
+    база одним запросом: нарастающая сумма token_count от новых к старым
+    (оконная функция), берутся строки, где она в пределах бюджета.
+    Для старых сообщений без token_count - оценка по длине текста.
+    """
+    from sqlalchemy import select, func
+    
+    summary = chat.summary if chat else None
+    summary_until_id = chat.summary_until_id if chat else None
+    
+    used = 0
+    if summary:
+        used = (chat.summary_tokens or estimate_text_tokens(summary)) + MESSAGE_OVERHEAD
+        if used > budget_tokens:
+            # Не влезает даже summary - отдаем только свежие сообщения
+            summary, used = None, 0
+    
+    cached = await _history_cache.get(session_id)
+    picked = cached.pick(budget_tokens - used, max_messages, summary_until_id or 0) if cached else None
+    if picked is not None:
+        history, history_tokens = picked
+        return history, used + history_tokens, summary
+    if cached is not None:
+        _history_cache.stats["fallbacks"] += 1
+    
+    tokens = func.coalesce(Message.token_count, func.length(Message.content) / 3 + 1) + MESSAGE_OVERHEAD
+    newest = (
+        select(
+            Message.role,
+            Message.content,
+            func.sum(tokens).over(order_by=(Message.created_at.desc(), Message.id.desc())).label("running"),
+        )
+        .where(
+            Message.telegram_id == telegram_id,
+            Message.session_id == session_id,
+            Message.id > (summary_until_id or 0)
+        )
+        .subquery()
+    )
+    async with async_session() as session:
+        result = await session.execute(
+            select(newest.c.role, newest.c.content, newest.c.running)
+            .where(newest.c.running <= budget_tokens - used)
+            .order_by(newest.c.running)
+            .limit(max_messages)
+        )
+        rows = result.all()
+    
+    history = [{"role": row.role, "content": row.content} for row in reversed(rows)]
+    return history, used + (rows[-1].running if rows else 0), summary
+
+
+# Сообщения текущего чата, еще не вошедшие в summary
+async def get_unsummarized_messages(session_id: str, max_tokens: int = None):
+    """
+    max_tokens - только самые старые сообщения, начавшиеся в пределах бюджета
+    (нарастающая сумма токенов в SQL, как в get_context_history): длинный
+    чат целиком не читается
+    
+    Returns:
+        tuple: (summary или None, summary_until_id или None,
+                [строки id, role, content, tokens от старых к новым], токенов во всей несжатой части)
+    """
+    async with async_session() as session:
+        from sqlalchemy import select, func
+        
+        result = await session.execute(
+            select(ChatSession).where(ChatSession.session_id == session_id)
+        )
+        chat_session = result.scalar_one_or_none()
+        if not chat_session:
+            return None, None, [], 0
+        
+        tokens = func.coalesce(Message.token_count, func.length(Message.content) / 3 + 1) + MESSAGE_OVERHEAD
+        pending = (Message.session_id == session_id, Message.id > (chat_session.summary_until_id or 0))
+        
+        result = await session.execute(select(func.sum(tokens)).where(*pending))
+        total = result.scalar() or 0
+        
+        oldest = (
+            select(
+                Message.id,
+                Message.role,
+                Message.content,
+                tokens.label("tokens"),
+                func.sum(tokens).over(order_by=(Message.created_at, Message.id)).label("running"),
+            )
+            .where(*pending)
+            .subquery()
+        )
+        query = select(oldest.c.id, oldest.c.role, oldest.c.content, oldest.c.tokens).order_by(oldest.c.running)
+        if max_tokens is not None:
+            query = query.where(oldest.c.running - oldest.c.tokens < max_tokens)
+        result = await session.execute(query)
+        return chat_session.summary, chat_session.summary_until_id, result.all(), int(total)
+
+
+# Сохранить новое summary чата
+async def save_session_summary(session_id: str, summary: str, until_id: int, expected_until_id: int = None) -> bool:
+    """
+    Сохраняет summary, только если его никто не обновил параллельно
+    (summary_until_id все еще равен expected_until_id)
+    
+    Returns:
+        bool: сохранено ли
+    """
+    async with async_session() as session:
+        from sqlalchemy import update
+        
+        result = await session.execute(
+            update(ChatSession)
+            .where(
+                ChatSession.session_id == session_id,
+                ChatSession.summary_until_id.is_(None) if expected_until_id is None
+                else ChatSession.summary_until_id == expected_until_id
+            )
+            .values(summary=summary, summary_until_id=until_id, summary_tokens=estimate_text_tokens(summary))
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+
 # Очистить историю текущего чата
 async def clear_conversation_history(telegram_id: int):
+    # Получаем текущую сессию
+    user = await get_user_info(telegram_id)
+    if not user or not user.current_session_id:
+        return
+    
     async with async_session() as session:
-        from sqlalchemy import delete
-        
-        # Получаем текущую сессию
-        user = await get_user_info(telegram_id)
-        if not user or not user.current_session_id:
-            return
+        from sqlalchemy import delete, update
         
         await session.execute(
             delete(Message).where(
@@ -241,7 +783,14 @@ async def clear_conversation_history(telegram_id: int):
                 Message.session_id == user.current_session_id  # Только текущий чат!
             )
         )
+        # Вместе с историей забываем и ее summary
+        await session.execute(
+            update(ChatSession)
+            .where(ChatSession.session_id == user.current_session_id)
+            .values(summary=None, summary_until_id=None, summary_tokens=None)
+        )
         await session.commit()
+        _history_cache.create_empty(user.current_session_id)
         print(f"✅ История чата {user.current_session_id} очищена для {telegram_id}")
 
 # === ФУНКЦИИ ДЛЯ РАБОТЫ С ЧАТАМИ ===
@@ -271,6 +820,8 @@ async def create_new_session(telegram_id: int, title: str = "Новый чат")
             user.current_session_id = new_session_id
         
         await session.commit()
+        _user_cache.update(telegram_id, current_session_id=new_session_id)
+        _history_cache.create_empty(new_session_id)
         print(f"✅ Создан новый чат для {telegram_id}: {new_session_id}")
         return new_session_id
 
@@ -301,6 +852,7 @@ async def switch_session(telegram_id: int, session_id: str):
         if user:
             user.current_session_id = session_id
             await session_obj.commit()
+            _user_cache.update(telegram_id, current_session_id=session_id)
             print(f"✅ Юзер {telegram_id} переключился на чат {session_id}")
 
 
@@ -322,13 +874,13 @@ async def get_current_session(telegram_id: int):
 # Переименовать чат
 async def rename_session(telegram_id: int, new_title: str):
     """Переименовывает текущий активный чат"""
+    user = await get_user_info(telegram_id)
+    if not user or not user.current_session_id:
+        return False
+    
     async with async_session() as session:
         from sqlalchemy import select
         
-        user = await get_user_info(telegram_id)
-        if not user or not user.current_session_id:
-            return False
-        
         result = await session.execute(
             select(ChatSession).where(ChatSession.session_id == user.current_session_id)
         )
@@ -347,13 +899,23 @@ async def rename_session(telegram_id: int, new_title: str):
 
 # Удалить чат
 async def delete_session(telegram_id: int, session_id: str):
-    """Удаляет чат и все его сообщения"""
+    """
+    Удаляет чат и все его сообщения
+    
+    Все чтения - в этой же сессии: вложенная сессия посреди транзакции удаления
+    заняла бы второе соединение пула (и не увидела бы еще не закоммиченное удаление)
+    """
     async with async_session() as session_obj:
         from sqlalchemy import select, delete
         
         # Проверяем что это не последний чат
-        sessions = await get_user_sessions(telegram_id)
-        if len(sessions) <= 1:
+        result = await session_obj.execute(
+            select(ChatSession.session_id)
+            .where(ChatSession.user_id == telegram_id)
+            .order_by(ChatSession.updated_at.desc())
+        )
+        session_ids = result.scalars().all()
+        if len(session_ids) <= 1:
             return False, "Нельзя удалить последний чат"
         
         # Удаляем все сообщения чата
@@ -367,19 +929,20 @@ async def delete_session(telegram_id: int, session_id: str):
         )
         
         # Если это был активный чат - переключаемся на другой
-        user = await get_user_info(telegram_id)
-        if user and user.current_session_id == session_id:
+        result = await session_obj.execute(
+            select(User).where(User.telegram_id == telegram_id)
+        )
+        user_obj = result.scalar_one_or_none()
+        switched_to = None
+        if user_obj and user_obj.current_session_id == session_id:
             # Берем первый доступный чат
-            remaining_sessions = await get_user_sessions(telegram_id)
-            if remaining_sessions:
-                result = await session_obj.execute(
-                    select(User).where(User.telegram_id == telegram_id)
-                )
-                user_obj = result.scalar_one_or_none()
-                if user_obj:
-                    user_obj.current_session_id = remaining_sessions[0].session_id
+            switched_to = next(s for s in session_ids if s != session_id)
+            user_obj.current_session_id = switched_to
         
         await session_obj.commit()
+        _history_cache.drop(session_id)
+        if switched_to:
+            _user_cache.update(telegram_id, current_session_id=switched_to)
         print(f"✅ Чат {session_id} удален")
         return True, "Чат удален"
 
@@ -387,13 +950,13 @@ async def delete_session(telegram_id: int, session_id: str):
 # Автоназвание чата по первому сообщению
 async def auto_title_session(telegram_id: int, first_message: str):
     """Автоматически называет чат по первому сообщению"""
+    user = await get_user_info(telegram_id)
+    if not user or not user.current_session_id:
+        return
+    
     async with async_session() as session:
         from sqlalchemy import select
         
-        user = await get_user_info(telegram_id)
-        if not user or not user.current_session_id:
-            return
-        
         result = await session.execute(
             select(ChatSession).where(ChatSession.session_id == user.current_session_id)
         )
@@ -425,6 +988,7 @@ async def save_previous_session(telegram_id: int, session_id: str):
         if user and user.current_session_id != session_id:
             user.previous_session_id = user.current_session_id
             await session.commit()
+            _user_cache.update(telegram_id, previous_session_id=user.previous_session_id)
 
 
 # Установить системный промпт
@@ -441,6 +1005,7 @@ async def set_system_prompt(telegram_id: int, prompt: str):
         if user:
             user.system_prompt = prompt[:1000]  # Ограничение 1000 символов
             await session.commit()
+            _user_cache.update(telegram_id, system_prompt=user.system_prompt)
             print(f"✅ Системный промпт установлен для {telegram_id}")
             return True
         return False
@@ -460,6 +1025,7 @@ async def clear_system_prompt(telegram_id: int):
         if user:
             user.system_prompt = None
             await session.commit()
+            _user_cache.update(telegram_id, system_prompt=None)
             print(f"✅ Системный промпт очищен для {telegram_id}")
             return True
         return False
@@ -484,41 +1050,59 @@ async def check_token_limit(telegram_id: int, estimated_tokens: int = 0) -> tupl
     Returns:
         tuple: (can_request, remaining_tokens, subscription_tier)
     """
-    from config import ADMIN_IDS, SUBSCRIPTION_TIERS
+    from config import ADMIN_IDS
     
     # Админы имеют безлимит
     if telegram_id in ADMIN_IDS:
         return True, 999_999_999, "unlimited"
     
-    async with async_session() as session:
-        from sqlalchemy import select
-        
-        result = await session.execute(
-            select(User).where(User.telegram_id == telegram_id)
-        )
-        user = result.scalar_one_or_none()
-        
-        if not user:
-            return False, 0, "free"
-        
-        # Проверяем нужно ли сбросить счетчик (новый месяц)
-        now = datetime.utcnow()
-        last_reset = user.last_token_reset
-        
-        # Если прошел месяц - сбрасываем
-        if last_reset.month != now.month or last_reset.year != now.year:
-            user.tokens_used_month = 0
-            user.last_token_reset = now
+    # Несколько процессов - счетчики берем из БД, а не из кэша
+    user = await get_user_info(telegram_id, fresh=_user_cache.shared)
+    
+    if not user:
+        return False, 0, "free"
+    
+    if _reset_month_if_needed(user):
+        async with async_session() as session:
+            from sqlalchemy import update
+            
+            await session.execute(
+                update(User).where(User.telegram_id == telegram_id)
+                .values(tokens_used_month=0, last_token_reset=user.last_token_reset)
+            )
             await session.commit()
-            print(f"✅ Токены сброшены для {telegram_id} (новый месяц)")
-        
-        # Проверяем лимит
-        remaining = user.tokens_limit_month - user.tokens_used_month
-        
-        if remaining < estimated_tokens:
-            return False, remaining, user.subscription_tier
-        
-        return True, remaining, user.subscription_tier
+        if _user_cache.shared:
+            _user_cache.invalidate(telegram_id)
+    
+    return _token_limit(telegram_id, user, estimated_tokens)
+
+
+def _reset_month_if_needed(user: User) -> bool:
+    """Обнуляет счетчик токенов, если начался новый месяц (только в памяти). Returns: был ли сброс"""
+    now = datetime.utcnow()
+    last_reset = user.last_token_reset
+    
+    if last_reset.month != now.month or last_reset.year != now.year:
+        user.tokens_used_month = 0
+        user.last_token_reset = now
+        print(f"✅ Токены сброшены для {user.telegram_id} (новый месяц)")
+        return True
+    return False
+
+
+def _token_limit(telegram_id: int, user: User, estimated_tokens: int) -> tuple[bool, int, str]:
+    """check_token_limit по уже загруженному пользователю"""
+    from config import ADMIN_IDS
+    
+    if telegram_id in ADMIN_IDS:
+        return True, 999_999_999, "unlimited"
+    
+    remaining = user.tokens_limit_month - user.tokens_used_month
+    
+    if remaining < estimated_tokens:
+        return False, remaining, user.subscription_tier
+    
+    return True, remaining, user.subscription_tier
 
 
 async def update_token_usage(telegram_id: int, tokens_used: int, cost_usd: float):
@@ -542,9 +1126,50 @@ async def update_token_usage(telegram_id: int, tokens_used: int, cost_usd: float
             user.tokens_used_month += tokens_used
             user.total_spent_usd += cost_usd
             await session.commit()
+            _user_cache.add(telegram_id, tokens_used_month=tokens_used, total_spent_usd=cost_usd)
             print(f"✅ Токены обновлены для {telegram_id}: +{tokens_used} (всего: {user.tokens_used_month})")
 
 
+async def get_message_usage(since: datetime = None) -> dict:
+    """
+    Токены и стоимость всех ответов моделей (для аудита цен и симуляции тарифов)
+    
+    Читаются только нужные колонки, без создания ORM-объектов, пачками по
+    USAGE_BATCH_ROWS строк. С NumPy каждая пачка сразу становится массивами -
+    списков Python на все строки не создается.
+    
+    Returns:
+        dict: колонки {"model_used", "input_tokens", "output_tokens", "cost_usd",
+              "cached_tokens", "cache_write_tokens"} - numpy.ndarray (с NumPy; пустые значения - nan) или списки
+    """
+    async with async_session() as session:
+        from sqlalchemy import select
+        
+        query = select(
+            Message.model_used, Message.input_tokens, Message.output_tokens, Message.cost_usd,
+            Message.cached_tokens, Message.cache_write_tokens
+        ).where(Message.role == "assistant", Message.model_used.is_not(None))
+        if since:
+            query = query.where(Message.created_at >= since)
+        
+        result = await session.stream(query.execution_options(yield_per=USAGE_BATCH_ROWS))
+        batches = []
+        async for partition in result.partitions():
+            columns = list(zip(*partition))
+            if np is not None:
+                columns = [np.array(columns[0], dtype=object)] + [np.array(c, dtype=np.float64) for c in columns[1:]]
+            batches.append(columns)
+    
+    names = ("model_used", "input_tokens", "output_tokens", "cost_usd", "cached_tokens", "cache_write_tokens")
+    if np is None:
+        return {name: [value for batch in batches for value in batch[i]] for i, name in enumerate(names)}
+    empty = [np.array([], dtype=object)] + [np.array([], dtype=np.float64)] * (len(names) - 1)
+    return {
+        name: np.concatenate([batch[i] for batch in batches]) if batches else empty[i]
+        for i, name in enumerate(names)
+    }
+
+
 async def get_user_stats(telegram_id: int) -> dict:
     """
     Возвращает статистику пользователя для отображения
@@ -576,6 +1201,17 @@ async def get_user_stats(telegram_id: int) -> dict:
     }
 
 
+async def get_user_tier(telegram_id: int) -> str:
+    """Тариф пользователя (админы всегда unlimited)"""
+    from config import ADMIN_IDS
+    
+    if telegram_id in ADMIN_IDS:
+        return "unlimited"
+    
+    user = await get_user_info(telegram_id)
+    return user.subscription_tier if user and user.subscription_tier else "free"
+
+
 async def check_model_access(telegram_id: int, model_key: str) -> tuple[bool, str]:
     """
     Проверяет есть ли доступ к модели на текущем тарифе
@@ -583,13 +1219,22 @@ async def check_model_access(telegram_id: int, model_key: str) -> tuple[bool, st
     Returns:
         tuple: (has_access, error_message)
     """
-    from config import ADMIN_IDS, SUBSCRIPTION_TIERS
+    from config import ADMIN_IDS
     
     # Админы имеют доступ ко всем моделям
     if telegram_id in ADMIN_IDS:
         return True, ""
     
     user = await get_user_info(telegram_id)
+    return _model_access(telegram_id, user, model_key)
+
+
+def _model_access(telegram_id: int, user: User, model_key: str) -> tuple[bool, str]:
+    """check_model_access по уже загруженному пользователю"""
+    from config import ADMIN_IDS, SUBSCRIPTION_TIERS
+    
+    if telegram_id in ADMIN_IDS:
+        return True, ""
     
     if not user:
         return False, "Пользователь не найден"
@@ -611,4 +1256,312 @@ async def check_model_access(telegram_id: int, model_key: str) -> tuple[bool, st
             tier_name = tier_info["name"]
             return False, f"❌ Модель недоступна на тарифе {tier_name}\n\nДоступные модели: {', '.join(allowed_models)}"
     
-    return False, "Неизвестная ошибка доступа"
\ No newline at end of file
+    return False, "Неизвестная ошибка доступа"
+
+
+# ===== КОНТЕКСТ ЗАПРОСА (UNIT OF WORK) =====
+
+class RequestContext:
+    """
+    Все, что нужно для ответа на одно сообщение пользователя
+    
+    Пользователь и его текущий чат читаются одним запросом (load_request_context),
+    история - из кэша истории чата или еще одним (load_history). Дальше обработчик читает и меняет данные
+    в памяти, а commit() записывает все изменения одной транзакцией.
+    """
+    
+    def __init__(self, telegram_id: int, user: User, chat: ChatSession | None):
+        self.telegram_id = telegram_id
+        self.user = user
+        self.chat = chat
+        self._new_chat = None            # чат, созданный в этом запросе
+        self._messages: list[Message] = []
+        self._tokens_used = 0
+        self._cost_usd = 0.0
+        self._title = None
+        self._month_reset = _reset_month_if_needed(user)
+    
+    @property
+    def session_id(self) -> str | None:
+        return self.user.current_session_id
+    
+    @property
+    def system_prompt(self) -> str | None:
+        return self.user.system_prompt
+    
+    def unsummarized_tokens(self) -> int | None:
+        """
+        Токены сообщений чата, еще не вошедших в summary - по кэшу истории, без запроса к БД
+        
+        Returns:
+            int | None: None - буфер чата не загружен или не доходит до summary
+        """
+        if not self.session_id:
+            return 0
+        history = _history_cache.peek(self.session_id)
+        if history is None:
+            return None
+        after_id = (self.chat.summary_until_id if self.chat else None) or 0
+        total = 0
+        for message_id, _, _, tokens in reversed(history.messages):
+            if message_id <= after_id:
+                return total
+            total += tokens
+        return total if history.complete else None
+    
+    def check_model_access(self, model_key: str) -> tuple[bool, str]:
+        """Как check_model_access, без запроса к БД"""
+        return _model_access(self.telegram_id, self.user, model_key)
+    
+    def check_token_limit(self, estimated_tokens: int = 0) -> tuple[bool, int, str]:
+        """Как check_token_limit, без запроса к БД"""
+        return _token_limit(self.telegram_id, self.user, estimated_tokens)
+    
+    async def load_history(self, budget_tokens: int, max_messages: int = 200):
+        """
+        История текущего чата в пределах бюджета (см. get_context_history)
+        
+        Returns:
+            tuple: (история от старых к новым, сколько токенов она занимает вместе с summary, summary или None)
+        """
+        if budget_tokens <= 0 or not self.session_id or self._new_chat:
+            return [], 0, None
+        
+        return await _select_context_history(
+            self.telegram_id, self.chat, self.session_id, budget_tokens, max_messages
+        )
+    
+    def add_message(self, role: str, content: str, model_used: str = None, usage: dict = None):
+        """Сообщение в текущий чат (usage - как у save_message); если чата нет - создается первый"""
+        if not self.session_id:
+            self._new_chat = ChatSession(
+                user_id=self.telegram_id, session_id=str(uuid.uuid4()), title="Чат 1", is_auto_titled=True
+            )
+            self.chat = self._new_chat
+            self.user.current_session_id = self._new_chat.session_id
+        
+        self._messages.append(Message(
+            telegram_id=self.telegram_id,
+            role=role,
+            content=content,
+            model_used=model_used,
+            session_id=self.session_id,
+            created_at=datetime.utcnow(),
+            token_count=estimate_text_tokens(content),
+            **(usage or {})
+        ))
+    
+    def auto_title(self, first_message: str):
+        """Как auto_title_session: чат без названия от пользователя называется по сообщению"""
+        if self.chat is not None and not self.chat.is_auto_titled:
+            return
+        self._title = first_message[:30] + ("..." if len(first_message) > 30 else "")
+    
+    def add_token_usage(self, tokens_used: int, cost_usd: float):
+        """Как update_token_usage"""
+        self._tokens_used += tokens_used
+        self._cost_usd += cost_usd
+        self.user.tokens_used_month += tokens_used
+        self.user.total_spent_usd += cost_usd
+    
+    async def commit(self):
+        """Записывает все изменения одной транзакцией"""
+        if not (self._messages or self._title or self._tokens_used or self._cost_usd or self._month_reset):
+            return
+        
+        try:
+            await self._write()
+        except Exception:
+            # self.user мог уже попасть в кэш с изменениями, которых нет в БД
+            _user_cache.invalidate(self.telegram_id)
+            raise
+        if _user_cache.shared:
+            _user_cache.invalidate(self.telegram_id)
+        
+        if self._new_chat:
+            print(f"✅ Создан новый чат для {self.telegram_id}: {self._new_chat.session_id}")
+        if self._tokens_used:
+            print(f"✅ Токены обновлены для {self.telegram_id}: +{self._tokens_used} (всего: {self.user.tokens_used_month})")
+        
+        self._new_chat = None
+        self._messages = []
+        self._tokens_used = 0
+        self._cost_usd = 0.0
+        self._title = None
+        self._month_reset = False
+    
+    async def _write(self):
+        async with async_session() as session:
+            from sqlalchemy import update
+            
+            values = {}
+            if self._new_chat:
+                session.add(self._new_chat)
+                values["current_session_id"] = self._new_chat.session_id
+            # Счетчики - приращением в SQL: параллельный запрос того же юзера не затрется
+            if self._month_reset:
+                values["tokens_used_month"] = self._tokens_used
+                values["last_token_reset"] = self.user.last_token_reset
+            elif self._tokens_used:
+                values["tokens_used_month"] = User.tokens_used_month + self._tokens_used
+            if self._cost_usd:
+                values["total_spent_usd"] = User.total_spent_usd + self._cost_usd
+            if values:
+                await session.execute(update(User).where(User.telegram_id == self.telegram_id).values(**values))
+            
+            if self._title and self.session_id:
+                await session.execute(
+                    update(ChatSession)
+                    .where(ChatSession.session_id == self.session_id, ChatSession.is_auto_titled.is_(True))
+                    .values(title=self._title, updated_at=datetime.utcnow())
+                )
+            
+            session.add_all(self._messages)
+            await session.commit()
+        
+        if self._new_chat:
+            _history_cache.create_empty(self._new_chat.session_id)
+        for message in self._messages:
+            _history_cache.append(message)
+
+
+async def load_request_context(telegram_id: int, username: str = None) -> RequestContext:
+    """
+    Пользователь (создается, если его нет) и его текущий чат - одним запросом
+    
+    Пользователь из кэша - только чат (в мультипроцессном режиме пользователь всегда из БД).
+    """
+    user = None if _user_cache.shared else _user_cache.get(telegram_id)
+    
+    async with async_session() as session:
+        from sqlalchemy import select
+        
+        if user is not None:
+            chat = None
+            if user.current_session_id:
+                result = await session.execute(
+                    select(ChatSession).where(ChatSession.session_id == user.current_session_id)
+                )
+                chat = result.scalar_one_or_none()
+        else:
+            result = await session.execute(
+                select(User, ChatSession)
+                .outerjoin(ChatSession, ChatSession.session_id == User.current_session_id)
+                .where(User.telegram_id == telegram_id)
+            )
+            row = result.first()
+            if row is None:
+                # Создаем в этой же сессии: вложенная сессия заняла бы второе соединение пула
+                user, chat = User(telegram_id=telegram_id, username=username), None
+                session.add(user)
+                await session.commit()
+                await session.refresh(user)
+                print(f"✅ Новый юзер создан: {telegram_id}")
+            else:
+                user, chat = row
+            if not _user_cache.shared:
+                _user_cache.put(user)
+    
+    context = RequestContext(telegram_id, user, chat)
+    if context._month_reset:
+        # Сброс счетчика за новый месяц пишем сразу, независимо от исхода запроса
+        await context.commit()
+    return context
+
+
+# ===== КЭШ ОТВЕТОВ (ПОСТОЯННЫЙ УРОВЕНЬ) =====
+
+async def get_cached_response(cache_key: str):
+    """Возвращает живую запись кэша ответов или None (и считает попадание)"""
+    async with async_session() as session:
+        from sqlalchemy import select
+        
+        result = await session.execute(
+            select(CachedResponse).where(
+                CachedResponse.cache_key == cache_key,
+                CachedResponse.expires_at > datetime.utcnow()
+            )
+        )
+        entry = result.scalar_one_or_none()
+        
+        if entry:
+            entry.hits += 1
+            await session.commit()
+        return entry
+
+
+async def save_cached_response(cache_key: str, model_key: str, result: dict, ttl_seconds: float):
+    """Сохраняет (или обновляет) ответ модели в постоянном кэше"""
+    async with async_session() as session:
+        from sqlalchemy import select
+        
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl_seconds)
+        existing = await session.execute(
+            select(CachedResponse).where(CachedResponse.cache_key == cache_key)
+        )
+        entry = existing.scalar_one_or_none()
+        
+        if not entry:
+            entry = CachedResponse(cache_key=cache_key)
+            session.add(entry)
+        
+        entry.model_used = model_key
+        entry.response = result["response"]
+        entry.tokens_used = result.get("tokens") or 0
+        entry.input_tokens = result.get("input_tokens") or 0
+        entry.output_tokens = result.get("output_tokens") or 0
+        entry.created_at = datetime.utcnow()
+        entry.expires_at = expires_at
+        await session.commit()
+
+
+async def purge_response_cache(max_entries: int) -> int:
+    """
+    Чистит постоянный кэш: удаляет просроченные записи и самые старые сверх max_entries
+    
+    Returns:
+        int: сколько записей удалено
+    """
+    async with async_session() as session:
+        from sqlalchemy import select, delete, func
+        
+        result = await session.execute(
+            delete(CachedResponse).where(CachedResponse.expires_at <= datetime.utcnow())
+        )
+        removed = result.rowcount or 0
+        
+        total = (await session.execute(select(func.count(CachedResponse.id)))).scalar_one()
+        if total > max_entries:
+            # Сначала истекают раньше - их и выкидываем
+            oldest = select(CachedResponse.id).order_by(CachedResponse.expires_at).limit(total - max_entries)
+            result = await session.execute(
+                delete(CachedResponse).where(CachedResponse.id.in_(oldest))
+            )
+            removed += result.rowcount or 0
+        
+        await session.commit()
+        return removed
+
+
+async def load_latency_samples() -> dict:
+    """
+    Сохраненные замеры задержек
+    
+    Returns:
+        dict: {(series, kind): [секунды, ...]}
+    """
+    async with async_session() as session:
+        from sqlalchemy import select
+        
+        result = await session.execute(select(LatencySamples))
+        return {(row.series, row.kind): row.samples for row in result.scalars()}
+
+
+async def save_latency_samples(samples: dict):
+    """Сохраняет замеры задержек ({(series, kind): [секунды, ...]}) одной транзакцией"""
+    async with async_session() as session:
+        for (series, kind), values in samples.items():
+            await session.merge(LatencySamples(
+                series=series, kind=kind, samples=list(values), updated_at=datetime.utcnow()
+            ))
+        await session.commit()
@@ -0,0 +1,225 @@
+"""
+Хеджирование запросов к бесплатным моделям
+
+У бесплатных моделей очень нестабильная задержка: медиана - секунды,
+хвост - минута. Если основная модель не ответила (или не прислала первый
+токен) за "обычное" для нее время (перцентиль HEDGE_PERCENTILE), параллельно
+запускается запасной запрос к другой бесплатной модели. Побеждает тот, кто
+ответит первым, проигравший отменяется.
+
+Доля хеджированных запросов ограничена HEDGE_MAX_RATE, чтобы лишняя нагрузка
+на API оставалась предсказуемой.
+"""
+
+import asyncio
+import contextlib
+
+from config import (
+    MODELS, SUBSCRIPTION_TIERS,
+    HEDGING_ENABLED, HEDGE_TIERS, HEDGE_PERCENTILE, HEDGE_DEFAULT_DELAY,
+    HEDGE_MIN_DELAY, HEDGE_MAX_RATE, HEDGE_BURST
+)
+import latency
+from resilience import get_breaker
+
+
+PRIMARY = "primary"
+BACKUP = "backup"
+
+_stats = {
+    "eligible": 0,   # запросов, которые можно было хеджировать
+    "hedged": 0,     # запущено запасных запросов
+    "backup_won": 0, # запасной ответил первым
+    "skipped": 0,    # хотели хеджировать, но кончился бюджет
+}
+
+
+class _HedgeBudget:
+    """Бюджет хеджей: каждый запрос добавляет HEDGE_MAX_RATE, каждый хедж тратит 1"""
+
+    def __init__(self):
+        self.tokens = HEDGE_BURST
+
+    def note_request(self):
+        self.tokens = min(self.tokens + HEDGE_MAX_RATE, HEDGE_BURST)
+
+    def try_take(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+_budget = _HedgeBudget()
+
+
+def enabled_for(tier: str) -> bool:
+    """Хеджировать ли запросы этого тарифа"""
+    return HEDGING_ENABLED and tier in HEDGE_TIERS
+
+
+def pick_backup(model_key: str, chain: list[str], tier: str) -> str | None:
+    """
+    Запасная бесплатная модель для хеджа
+
+    Сначала - из цепочки fallback основной модели, потом любая разрешенная
+    тарифом бесплатная; модели с разомкнутым circuit breaker пропускаются
+    """
+    allowed = SUBSCRIPTION_TIERS.get(tier, SUBSCRIPTION_TIERS["free"])["allowed_models"]
+    candidates = list(chain[1:]) + [key for key in MODELS if key not in chain]
+
+    for key in candidates:
+        if key == model_key or not MODELS.get(key, {}).get("free"):
+            continue
+        if allowed != "all" and key not in allowed:
+            continue
+        if get_breaker(key).available():
+            return key
+    return None
+
+
+def hedge_delay(model_key: str, kind: str) -> float:
+    """Через сколько секунд запускать запасной запрос (перцентиль задержки модели)"""
+    observed = latency.percentile(model_key, kind, HEDGE_PERCENTILE)
+    if observed is None:
+        return HEDGE_DEFAULT_DELAY
+    return max(observed, HEDGE_MIN_DELAY)
+
+
+def _start_backup() -> bool:
+    if _budget.try_take():
+        _stats["hedged"] += 1
+        return True
+    _stats["skipped"] += 1
+    return False
+
+
+async def race(primary, backup, delay: float) -> tuple[dict, str]:
+    """
+    Хедж для обычного (не потокового) запроса
+
+    Args:
+        primary, backup: функции без аргументов, возвращающие корутину с результатом send_message
+        delay: через сколько секунд без ответа запускать backup
+
+    Returns:
+        tuple: (результат, PRIMARY или BACKUP)
+    """
+    _stats["eligible"] += 1
+    _budget.note_request()
+
+    tasks = {PRIMARY: asyncio.create_task(primary())}
+    try:
+        done, _ = await asyncio.wait(tasks.values(), timeout=delay)
+        if done or not _start_backup():
+            return await tasks[PRIMARY], PRIMARY
+
+        tasks[BACKUP] = asyncio.create_task(backup())
+        names = {task: name for name, task in tasks.items()}
+        pending = set(tasks.values())
+        first_failure = None
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                if result.get("success"):
+                    if names[task] == BACKUP:
+                        _stats["backup_won"] += 1
+                    return result, names[task]
+                first_failure = first_failure or (result, names[task])
+
+        return first_failure
+    finally:
+        # Проигравший больше не нужен
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+
+
+async def race_streams(primary, backup, delay: float):
+    """
+    Хедж для стрима: побеждает тот, кто первым пришлет текст
+
+    Args:
+        primary, backup: функции без аргументов, возвращающие async-генератор событий stream_message
+        delay: через сколько секунд без первого токена запускать backup
+
+    Yields:
+        (PRIMARY или BACKUP, событие) - только события победителя
+    """
+    _stats["eligible"] += 1
+    _budget.note_request()
+
+    queue = asyncio.Queue()
+
+    async def pump(name, stream):
+        try:
+            async with contextlib.aclosing(stream):
+                async for event in stream:
+                    await queue.put((name, event))
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            # Ошибки стрима (кроме ModelCallError - те уже стали событием done) передаем
+            # потребителю: иначе он вечно ждет очередь, а второй запрос не отменяется
+            await queue.put((name, e))
+
+    tasks = {PRIMARY: asyncio.create_task(pump(PRIMARY, primary()))}
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + delay
+    may_hedge = True
+    winner = None
+    failures = {}
+
+    try:
+        while True:
+            timeout = None
+            if winner is None and may_hedge:
+                timeout = max(deadline - loop.time(), 0)
+            try:
+                name, event = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                may_hedge = False
+                if _start_backup():
+                    tasks[BACKUP] = asyncio.create_task(pump(BACKUP, backup()))
+                continue
+
+            if isinstance(event, BaseException):
+                if winner is None or name == winner:
+                    raise event
+                continue
+
+            if winner is None:
+                if event["type"] == "delta":
+                    # Первый текст - этот запрос и показываем, второй отменяем
+                    winner = name
+                    if name == BACKUP:
+                        _stats["backup_won"] += 1
+                    for other, task in tasks.items():
+                        if other != name:
+                            task.cancel()
+                else:
+                    # Упал, ничего не прислав: ждем второго, если он есть
+                    failures[name] = event
+                    if len(failures) < len(tasks):
+                        continue
+                    # Хедж еще не запускали, а основной уже упал - результат основного:
+                    # его собственная цепочка fallback уже перебрала запасные модели
+                    yield PRIMARY, failures[PRIMARY]
+                    return
+
+            if name != winner:
+                continue
+            yield name, event
+            if event["type"] == "done":
+                return
+    finally:
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+
+
+def hedging_stats() -> dict:
+    """Счетчики хеджирования для логов и админки"""
+    return dict(_stats, budget=round(_budget.tokens, 2))
@@ -0,0 +1,151 @@
+"""
+Пул API-ключей OpenRouter
+
+Лимиты бесплатных моделей считаются на ключ, поэтому несколько ключей
+дают кратно больше запросов. Для каждого запроса выбирается ключ
+(наименее загруженный или по кругу), по заголовкам X-RateLimit-* ответа
+отслеживается остаток лимита, а ключ, уперевшийся в лимит или квоту,
+временно убирается из ротации (карантин).
+"""
+
+import time
+from contextlib import asynccontextmanager
+
+from config import (
+    OPENROUTER_API_KEYS, KEY_POOL_STRATEGY,
+    KEY_QUARANTINE_SECONDS, KEY_QUOTA_QUARANTINE_SECONDS
+)
+from resilience import ModelCallError, RATE_LIMIT, UNAVAILABLE, CLIENT
+
+
+class ApiKey:
+    """Один ключ и его статистика"""
+
+    def __init__(self, key: str, index: int):
+        self.key = key
+        self.index = index
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.tokens = 0
+        self.remaining = None          # остаток лимита по X-RateLimit-Remaining
+        self.quarantined_until = 0.0
+        self.quarantine_reason = None
+        self.last_used = 0.0
+
+    @property
+    def label(self) -> str:
+        """Ключ для логов: только последние символы"""
+        return f"#{self.index}…{self.key[-4:]}"
+
+    def available(self, now: float) -> bool:
+        return now >= self.quarantined_until
+
+    def quarantine(self, seconds: float, reason: str):
+        until = time.monotonic() + seconds
+        if until > self.quarantined_until:
+            self.quarantined_until = until
+            self.quarantine_reason = reason
+            print(f"🔒 Ключ {self.label} в карантине на {seconds:.0f}с: {reason}")
+
+    def record_headers(self, headers):
+        """Читает остаток лимита из заголовков ответа; 0 - ключ отдыхает до сброса"""
+        if headers is None:
+            return
+        remaining = headers.get("x-ratelimit-remaining")
+        if remaining is None:
+            return
+        try:
+            self.remaining = int(float(remaining))
+        except ValueError:
+            return
+
+        if self.remaining <= 0:
+            reset = headers.get("x-ratelimit-reset")
+            try:
+                seconds = max(float(reset) / 1000 - time.time(), 1.0) if reset else KEY_QUARANTINE_SECONDS
+            except ValueError:
+                seconds = KEY_QUARANTINE_SECONDS
+            self.quarantine(seconds, "лимит запросов исчерпан")
+
+    def record_error(self, error: ModelCallError):
+        """Ошибки, которые касаются ключа, а не модели: лимит, квота, неверный ключ"""
+        self.errors += 1
+        if error.kind == RATE_LIMIT:
+            self.rate_limited += 1
+            self.quarantine(error.retry_after or KEY_QUARANTINE_SECONDS, "429 rate limit")
+        elif error.kind == UNAVAILABLE and error.status == 402:
+            self.quarantine(KEY_QUOTA_QUARANTINE_SECONDS, "закончились кредиты (402)")
+        elif error.kind == CLIENT and error.status == 401:
+            self.quarantine(KEY_QUOTA_QUARANTINE_SECONDS, "ключ отклонен (401)")
+
+    def snapshot(self, now: float) -> dict:
+        return {
+            "key": self.label,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "tokens": self.tokens,
+            "remaining": self.remaining,
+            "quarantined_for": max(self.quarantined_until - now, 0.0),
+            "quarantine_reason": self.quarantine_reason if not self.available(now) else None,
+        }
+
+
+_keys = [ApiKey(key, i + 1) for i, key in enumerate(OPENROUTER_API_KEYS)]
+_next = 0
+
+
+def primary_key() -> str:
+    """Первый ключ пула (для служебных запросов)"""
+    return _keys[0].key
+
+
+def _pick() -> ApiKey:
+    """Выбирает ключ по стратегии; если все в карантине - ошибка с Retry-After"""
+    global _next
+    now = time.monotonic()
+    alive = [k for k in _keys if k.available(now)]
+
+    if not alive:
+        wait = min(k.quarantined_until for k in _keys) - now
+        raise ModelCallError(RATE_LIMIT, "Все API-ключи уперлись в лимит, попробуйте позже", retry_after=wait)
+
+    if KEY_POOL_STRATEGY == "round_robin":
+        for _ in range(len(_keys)):
+            candidate = _keys[_next % len(_keys)]
+            _next += 1
+            if candidate.available(now):
+                return candidate
+
+    # least_loaded: меньше всего запросов в работе, потом больше остаток лимита, потом давно не использовался
+    return min(
+        alive,
+        key=lambda k: (k.in_flight, -(k.remaining if k.remaining is not None else 1_000_000), k.last_used),
+    )
+
+
+@asynccontextmanager
+async def lease():
+    """
+    Ключ на время одного запроса
+
+    async with lease() as api_key:
+        ...  # api_key.key, потом api_key.record_headers(...) / api_key.record_error(...)
+    """
+    api_key = _pick()
+    api_key.in_flight += 1
+    api_key.requests += 1
+    api_key.last_used = time.monotonic()
+    try:
+        yield api_key
+    finally:
+        api_key.in_flight -= 1
+
+
+def key_pool_stats() -> list[dict]:
+    """Статистика по всем ключам для логов и админки"""
+    now = time.monotonic()
+    return [k.snapshot(now) for k in _keys]
@@ -0,0 +1,159 @@
+"""
+Задержки моделей по нашему собственному трафику
+
+Для каждой модели хранятся последние замеры трех видов:
+- TTFT: время до первого токена (стрим)
+- TOTAL: полное время ответа
+- PER_TOKEN: время на один выходной токен после первого (стрим)
+
+Отдельно копятся замеры по провайдерам OpenRouter, которые реально
+обслужили запрос (модель@провайдер).
+
+По перцентилям замеров считаются таймауты запросов к модели (get_timeout,
+get_request_timeout) и отчет для админов (/latency). Замеры раз в LATENCY_PERSIST_INTERVAL
+сохраняются в БД и загружаются при старте, чтобы после перезапуска
+таймауты не откатывались к общему OPENROUTER_TIMEOUT.
+"""
+
+import asyncio
+from collections import deque
+
+from config import (
+    OPENROUTER_TIMEOUT, LATENCY_SAMPLES, LATENCY_MIN_SAMPLES, LATENCY_PERSIST_INTERVAL,
+    LATENCY_TIMEOUT_PERCENTILE, LATENCY_TIMEOUT_FACTOR, LATENCY_TIMEOUT_MIN, LATENCY_TIMEOUT_MAX
+)
+from database import load_latency_samples, save_latency_samples
+
+
+TTFT = "ttft"
+TOTAL = "total"
+PER_TOKEN = "per_token"
+
+REPORT_PERCENTILES = (0.5, 0.95, 0.99)
+
+_samples: dict[tuple[str, str], deque] = {}
+_dirty: set[tuple[str, str]] = set()   # серии, измененные после последнего сохранения
+
+
+def _series(model_key: str, provider: str = None) -> str:
+    """Замеры модели в целом или модели у конкретного провайдера"""
+    return f"{model_key}@{provider}" if provider else model_key
+
+
+def _get_samples(key: tuple[str, str]) -> deque:
+    samples = _samples.get(key)
+    if samples is None:
+        samples = deque(maxlen=LATENCY_SAMPLES)
+        _samples[key] = samples
+    return samples
+
+
+def _pick(ordered: list, q: float) -> float:
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def record(model_key: str, kind: str, seconds: float, provider: str = None):
+    """Запоминает замер задержки (и отдельно - для провайдера, если он известен)"""
+    for series in {_series(model_key), _series(model_key, provider)}:
+        _get_samples((series, kind)).append(seconds)
+        _dirty.add((series, kind))
+
+
+def percentile(model_key: str, kind: str, q: float, provider: str = None) -> float | None:
+    """
+    Перцентиль задержки модели (q от 0 до 1)
+
+    Returns:
+        float | None: секунд или None, если замеров пока слишком мало
+    """
+    samples = _samples.get((_series(model_key, provider), kind))
+    if not samples or len(samples) < LATENCY_MIN_SAMPLES:
+        return None
+    return _pick(sorted(samples), q)
+
+
+def providers(model_key: str) -> list[str]:
+    """Провайдеры, для которых есть замеры модели"""
+    prefix = f"{model_key}@"
+    return sorted({series[len(prefix):] for series, _ in _samples if series.startswith(prefix)})
+
+
+def get_timeout(model_key: str, kind: str) -> float:
+    """
+    Таймаут запроса к модели по ее наблюдаемой задержке
+
+    TOTAL - на весь ответ, TTFT - на ожидание первого токена в стриме
+    """
+    observed = percentile(model_key, kind, LATENCY_TIMEOUT_PERCENTILE)
+    if observed is None:
+        return OPENROUTER_TIMEOUT
+    return min(max(observed * LATENCY_TIMEOUT_FACTOR, LATENCY_TIMEOUT_MIN), LATENCY_TIMEOUT_MAX)
+
+
+def get_request_timeout(model_key: str, max_tokens: int) -> float:
+    """
+    Таймаут обычного (не потокового) запроса: ожидание первого токена + генерация max_tokens
+
+    Полное время ответа зависит от его длины, поэтому перцентиль TOTAL тут не годится:
+    длинный ответ после серии коротких оборвался бы. Пока нет замеров стрима - OPENROUTER_TIMEOUT.
+    """
+    per_token = percentile(model_key, PER_TOKEN, LATENCY_TIMEOUT_PERCENTILE)
+    if per_token is None or percentile(model_key, TTFT, LATENCY_TIMEOUT_PERCENTILE) is None:
+        return OPENROUTER_TIMEOUT
+    return get_timeout(model_key, TTFT) + max_tokens * per_token * LATENCY_TIMEOUT_FACTOR
+
+
+def latency_report() -> dict:
+    """
+    p50/p95/p99 по моделям (без разбивки по провайдерам)
+
+    Returns:
+        dict: {model_key: {kind: {"count": int, 0.5: сек, 0.95: сек, 0.99: сек}}}
+    """
+    report = {}
+    for (series, kind), samples in _samples.items():
+        if "@" in series or not samples:
+            continue
+        ordered = sorted(samples)
+        report.setdefault(series, {})[kind] = {
+            "count": len(ordered),
+            **{q: _pick(ordered, q) for q in REPORT_PERCENTILES},
+        }
+    return report
+
+
+async def load():
+    """Подгружает замеры, сохраненные прошлым запуском"""
+    try:
+        stored = await load_latency_samples()
+    except Exception as e:
+        print(f"⚠️ Замеры задержек не загружены: {e}")
+        return
+    for key, values in stored.items():
+        samples = _get_samples(key)
+        # Свежие замеры этого запуска (если уже есть) остаются в конце
+        fresh = list(samples)
+        samples.clear()
+        samples.extend(values)
+        samples.extend(fresh)
+    print(f"⏱ Загружены замеры задержек: {len(stored)} серий")
+
+
+async def persist():
+    """Сохраняет серии, изменившиеся после прошлого сохранения"""
+    if not _dirty:
+        return
+    changed = {key: list(_samples[key]) for key in _dirty}
+    _dirty.clear()
+    try:
+        await save_latency_samples(changed)
+    except Exception as e:
+        _dirty.update(changed)   # попробуем в следующий раз
+        print(f"⚠️ Замеры задержек не сохранены: {e}")
+
+
+async def run_persistence():
+    """Фоновая задача: периодически сохраняет замеры в БД"""
+    while True:
+        await asyncio.sleep(LATENCY_PERSIST_INTERVAL)
+        await persist()
@@ -1,21 +1,470 @@
-from openai import OpenAI
-from config import OPENROUTER_API_KEY, MODELS
+import asyncio
+import contextlib
+import importlib.util
 import time
+
+import httpx
+from openai import AsyncOpenAI
+
+from config import (
+    OPENROUTER_BASE_URL, OPENROUTER_TIMEOUT, MODELS, SUBSCRIPTION_TIERS,
+    HTTP_POOL_MAX_CONNECTIONS, HTTP_POOL_MAX_KEEPALIVE, HTTP_KEEPALIVE_EXPIRY,
+    HTTP2_ENABLED, HTTP_WARMUP_CONNECTIONS,
+    RETRY_MAX_ATTEMPTS, RETRY_MAX_DELAY, RETRY_TOTAL_BUDGET, COALESCE_ENABLED,
+    MAX_COMPLETION_TOKENS, MIN_COMPLETION_TOKENS
+)
 from pricing import calculate_cost, estimate_tokens, format_cost, is_free_model
+import response_cache
+import singleflight
+import key_pool
+import scheduler
+from scheduler import slot
+import latency
+import hedging
+import token_estimator
+import prompt_cache
+import reasoning
+from catalog import model_info
+from resilience import (
+    ModelCallError, EMPTY, TIMEOUT, CIRCUIT_OPEN, CONTEXT_TOO_LONG, HEALTH_FAILURES, OVERLOAD_FAILURES, KIND_NAMES,
+    classify_error, backoff_delay, get_breaker, get_model_health
+)
+
 
+# HTTP/2 работает только если установлен пакет h2
+_http2 = HTTP2_ENABLED and importlib.util.find_spec("h2") is not None
+if HTTP2_ENABLED and not _http2:
+    print("⚠️ HTTP/2 выключен: не установлен пакет h2 (pip install h2)")
 
-# Инициализация клиента с timeout
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=OPENROUTER_API_KEY,
-    timeout=60.0  # 60 секунд максимум
+# Общий пул соединений: keep-alive, чтобы не делать TLS-рукопожатие на каждый запрос
+http_client = httpx.AsyncClient(
+    http2=_http2,
+    limits=httpx.Limits(
+        max_connections=HTTP_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    ),
+    timeout=httpx.Timeout(OPENROUTER_TIMEOUT, connect=10.0),
 )
 
-async def send_message(model_key: str, messages: list) -> dict:
+# Асинхронный клиент: запрос к модели больше не блокирует event loop бота
+client = AsyncOpenAI(
+    base_url=OPENROUTER_BASE_URL,
+    api_key=key_pool.primary_key(),
+    timeout=OPENROUTER_TIMEOUT,  # 60 секунд максимум
+    http_client=http_client,
+    max_retries=0,  # повторы делаем сами (см. send_message), чтобы не умножать ожидание
+)
+
+# Клиенты для ключей из пула (общий пул соединений http_client)
+_clients: dict[str, AsyncOpenAI] = {}
+
+
+def _client_for(api_key: str) -> AsyncOpenAI:
+    """Клиент с нужным API-ключом"""
+    key_client = _clients.get(api_key)
+    if key_client is None:
+        key_client = client.with_options(api_key=api_key)
+        _clients[api_key] = key_client
+    return key_client
+
+async def warm_up():
+    """
+    Прогревает пул соединений при старте бота
+    
+    Открывает несколько соединений заранее, чтобы первые пользователи
+    не ждали DNS + TLS-рукопожатие
+    """
+    start_time = time.time()
+    connections = 1 if _http2 else HTTP_WARMUP_CONNECTIONS  # HTTP/2 мультиплексирует в одно соединение
+    
+    async def ping():
+        try:
+            await http_client.get(
+                f"{OPENROUTER_BASE_URL}/key",
+                headers={"Authorization": f"Bearer {key_pool.primary_key()}"},
+            )
+            return True
+        except Exception as e:
+            print(f"⚠️ Прогрев соединения не удался: {e}")
+            return False
+    
+    results = await asyncio.gather(*(ping() for _ in range(max(connections, 1))))
+    protocol = "HTTP/2" if _http2 else "HTTP/1.1"
+    print(f"✅ Пул OpenRouter прогрет ({protocol}): {sum(results)} соедин. за {time.time() - start_time:.2f}с")
+
+
+async def close():
+    """Закрывает пул соединений при остановке бота"""
+    await client.close()
+
+# Максимум токенов в ответе (реальный лимит на запрос - get_max_tokens)
+MAX_TOKENS = MAX_COMPLETION_TOKENS
+
+# Заголовки, по которым OpenRouter опознает наше приложение
+EXTRA_HEADERS = {
+    "HTTP-Referer": "https://t.me/your_bot",
+    "X-Title": "AI Multi Bot",
+}
+
+
+def _error_result(error: str, response_time: float = None, error_kind: str = None) -> dict:
+    """Результат неудачного запроса в формате send_message"""
+    return {
+        "success": False,
+        "response": None,
+        "tokens": None,
+        "input_tokens": None,
+        "output_tokens": None,
+        "response_time": response_time,
+        "error": error,
+        "error_kind": error_kind
+    }
+
+
+def _parse_usage(usage) -> tuple[int, int, int]:
+    """Достает (total, input, output) токены из usage ответа"""
+    if not usage:
+        return 0, 0, 0
+    
+    total_tokens = usage.total_tokens or 0
+    input_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    output_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    
+    # Если input/output не разделены - делаем примерную оценку
+    if input_tokens == 0 and output_tokens == 0:
+        # Примерно 70% на input, 30% на output
+        input_tokens = int(total_tokens * 0.7)
+        output_tokens = int(total_tokens * 0.3)
+    
+    return total_tokens, input_tokens, output_tokens
+
+
+def _reported_prompt_tokens(usage) -> int:
+    """prompt_tokens, присланные провайдером (без оценки из _parse_usage) - для калибровки"""
+    return (getattr(usage, "prompt_tokens", 0) or 0) if usage else 0
+
+
+def _log_request(model_id: str, messages: list):
+    """🔍 ОТЛАДКА: Показываем что отправляем в API"""
+    print(f"\n{'='*60}")
+    print(f"📤 Отправляем в {model_id}:")
+    print(f"📝 Количество сообщений: {len(messages)}")
+    for i, msg in enumerate(messages):
+        print(f"  {i+1}. [{msg['role']}]: {msg['content'][:80]}...")
+    print(f"{'='*60}\n")
+
+
+def get_fallback_chain(model_key: str, tier: str = "free") -> list[str]:
+    """
+    Цепочка моделей для запроса: выбранная модель + ее "fallback" из MODELS
+    
+    Запасные модели, недоступные на тарифе пользователя, пропускаются
+    """
+    tier_info = SUBSCRIPTION_TIERS.get(tier, SUBSCRIPTION_TIERS["free"])
+    allowed = tier_info["allowed_models"]
+    
+    chain = [model_key]
+    for key in MODELS[model_key].get("fallback", []):
+        if key in MODELS and key not in chain and (allowed == "all" or key in allowed):
+            chain.append(key)
+    return chain
+
+
+def is_chain_available(model_key: str, tier: str = "free") -> bool:
+    """Есть ли в цепочке модели хоть одна, не отключенная circuit breaker'ом"""
+    return any(get_breaker(key).available() for key in get_fallback_chain(model_key, tier))
+
+
+def _acquire_breaker(model_key: str):
+    """Circuit breaker модели; если он разомкнут - сразу ошибка без запроса"""
+    breaker = get_breaker(model_key)
+    if not breaker.allow_request():
+        raise ModelCallError(CIRCUIT_OPEN, f"{get_model_name(model_key)} временно недоступна (много ошибок подряд)")
+    return breaker
+
+
+def _record_success(model_key: str, breaker, latency: float, streamed: bool):
+    """
+    Учитывает успешный ответ в circuit breaker и адаптивном лимите модели
+
+    Адаптивный лимит сравнивает только TTFT стрима: полное время обычного
+    ответа зависит от его длины и признаком перегрузки не является
+    """
+    breaker.record_success(latency)
+    scheduler.record_success(model_key, latency if streamed else None)
+
+
+def _record_failure(model_key: str, breaker, error: ModelCallError, latency: float = None):
+    """Учитывает ошибку в circuit breaker (ошибки самого запроса модели не вредят) и лимите"""
+    if error.kind in HEALTH_FAILURES:
+        breaker.record_failure(latency)
+    else:
+        breaker.record_cancel()
+    
+    if error.kind in OVERLOAD_FAILURES:
+        scheduler.record_overload(model_key)
+
+
+def _record_error(model_key: str, breaker, api_key, error: ModelCallError, start_time: float = None):
+    """Раскладывает ошибку попытки по ключу, circuit breaker'у и адаптивному лимиту"""
+    if api_key is None:
+        # Запрос даже не ушел (например, все ключи в карантине) - модель не виновата
+        breaker.record_cancel()
+        return
+    
+    api_key.record_error(error)
+    _record_failure(model_key, breaker, error, time.time() - start_time if start_time else None)
+
+
+def get_busy_retry_after(model_key: str, tier: str = "free") -> int | None:
+    """
+    Перегружена ли модель для этого тарифа (сброс нагрузки)
+    
+    Returns:
+        int | None: через сколько секунд повторить или None, если можно отправлять
+    """
+    return scheduler.shed_retry_after(model_key, tier)
+
+
+def _retry_delay(error: ModelCallError, attempt: int, start_time: float) -> float | None:
+    """Пауза перед повтором к той же модели или None, если повторять не стоит"""
+    if not error.retryable or attempt >= RETRY_MAX_ATTEMPTS:
+        return None
+    
+    delay = backoff_delay(attempt, error.retry_after)
+    # Долгий Retry-After - быстрее уйти на запасную модель, чем ждать
+    if delay > RETRY_MAX_DELAY or time.time() - start_time + delay > RETRY_TOTAL_BUDGET:
+        return None
+    return delay
+
+
+def _can_fallback(error: ModelCallError, start_time: float) -> bool:
+    """Стоит ли пробовать следующую модель цепочки"""
+    return error.fallback_ok and time.time() - start_time < RETRY_TOTAL_BUDGET
+
+
+def _context_room(model_key: str, messages: list) -> int | None:
+    """Сколько токенов остается в окне контекста модели после промпта (None - окно неизвестно)"""
+    info = model_info(model_key)
+    if info is None or not info.context_length:
+        return None
+    return info.context_length - token_estimator.estimate_messages_tokens(messages, model_key)
+
+
+def _check_context(model_key: str, messages: list):
+    """Отклоняет запрос до отправки, если на ответ не остается даже MIN_COMPLETION_TOKENS"""
+    room = _context_room(model_key, messages)
+    if room is not None and room < MIN_COMPLETION_TOKENS:
+        raise ModelCallError(
+            CONTEXT_TOO_LONG,
+            f"Диалог слишком длинный для {get_model_name(model_key)} - начните новый чат (/new) или сократите сообщение"
+        )
+
+
+def get_max_tokens(model_key: str, messages: list, limit: int = None) -> int:
+    """
+    Сколько токенов разрешить модели в ответе
+    
+    Меньшее из: MAX_COMPLETION_TOKENS, лимита провайдера (top_provider.max_completion_tokens)
+    и limit (остаток лимита пользователя), но не меньше MIN_COMPLETION_TOKENS.
+    Место в окне контекста после промпта - жесткий потолок: его не превышаем
+    даже ради MIN_COMPLETION_TOKENS (иначе провайдер отклонит запрос, см. _check_context)
+    """
+    value = MAX_COMPLETION_TOKENS
+    if limit is not None:
+        value = min(value, limit)
+    
+    info = model_info(model_key)
+    if info is not None and info.max_completion_tokens:
+        value = min(value, info.max_completion_tokens)
+    value = max(value, MIN_COMPLETION_TOKENS)
+    
+    room = _context_room(model_key, messages)
+    if room is not None:
+        value = min(value, max(room, 1))
+    return value
+
+
+def get_provider_preferences(model_key: str, tier: str = "free") -> dict:
+    """Предпочтения маршрутизации по провайдерам: тарифа, поверх - модели (см. config.MODELS)"""
+    tier_prefs = SUBSCRIPTION_TIERS.get(tier, SUBSCRIPTION_TIERS["free"]).get("provider", {})
+    return {**tier_prefs, **MODELS[model_key].get("provider", {})}
+
+
+def _extra_body(model_key: str, tier: str) -> dict:
+    """Параметры OpenRouter сверх API OpenAI: маршрутизация по провайдерам и рассуждения"""
+    extra_body = {}
+    provider = get_provider_preferences(model_key, tier)
+    if provider:
+        extra_body["provider"] = provider
+    reasoning_options = reasoning.get_reasoning_options(model_key)
+    if reasoning_options:
+        extra_body["reasoning"] = reasoning_options
+    return extra_body
+
+
+def _request_options(model_key: str, messages: list, tier: str, max_tokens: int = None) -> dict:
+    """Общие параметры запроса к модели (обычного и потокового)"""
+    options = {
+        "extra_headers": EXTRA_HEADERS,
+        "model": MODELS[model_key]["id"],
+        "messages": prompt_cache.apply_markers(model_key, messages),
+        "max_tokens": get_max_tokens(model_key, messages, max_tokens),
+    }
+    extra_body = _extra_body(model_key, tier)
+    if extra_body:
+        options["extra_body"] = extra_body
+    return options
+
+
+async def _request_once(model_key: str, messages: list, tier: str = "free", user_id: int = None,
+                        max_tokens: int = None) -> dict:
+    """
+    Одна попытка запроса к модели
+    
+    Returns:
+        dict: успешный результат в формате send_message
+        
+    Raises:
+        ModelCallError: любая ошибка, уже классифицированная
+    """
+    _check_context(model_key, messages)
+    breaker = _acquire_breaker(model_key)
+    start_time = None
+    api_key = None
+    
+    try:
+        # Слот модели выдает планировщик (очередь с весами тарифов), ключ - пул ключей
+        async with slot(model_key, tier, user_id), key_pool.lease() as api_key:
+            start_time = time.time()  # ожидание слота не считаем задержкой модели
+            options = _request_options(model_key, messages, tier, max_tokens)
+            raw = await _client_for(api_key.key).chat.completions.with_raw_response.create(
+                **options,
+                timeout=latency.get_request_timeout(model_key, options["max_tokens"]),
+            )
+            api_key.record_headers(raw.headers)
+            response = raw.parse()
+    except asyncio.CancelledError:
+        breaker.record_cancel()
+        raise
+    except Exception as e:
+        error = classify_error(e)
+        _record_error(model_key, breaker, api_key, error, start_time)
+        raise error from e
+    
+    response_time = time.time() - start_time
+    
+    # Извлекаем ответ с проверкой (рассуждения <think> в ответ не входят)
+    answer = None
+    if response.choices and response.choices[0].message.content:
+        answer = reasoning.strip_thinking(response.choices[0].message.content)
+    if not answer:
+        breaker.record_failure(response_time)
+        raise ModelCallError(EMPTY, "Модель вернула пустой ответ (возможно таймаут)")
+    
+    # Какой провайдер OpenRouter обслужил запрос (поле provider в ответе)
+    provider = getattr(response, "provider", None)
+    
+    _record_success(model_key, breaker, response_time, streamed=False)
+    latency.record(model_key, latency.TOTAL, response_time, provider)
+    
+    # Извлекаем метрики токенов
+    total_tokens, input_tokens, output_tokens = _parse_usage(response.usage)
+    cached_tokens = prompt_cache.cached_tokens(response.usage)
+    cache_write_tokens = prompt_cache.cache_write_tokens(response.usage)
+    reasoning_tokens = reasoning.reasoning_tokens(response.usage)
+    api_key.tokens += total_tokens
+    token_estimator.observe(model_key, messages, _reported_prompt_tokens(response.usage))
+    prompt_cache.record(model_key, input_tokens, cached_tokens, cache_write_tokens)
+    reasoning.record(model_key, output_tokens, reasoning_tokens)
+    
+    print(f"✅ Ответ {model_key} ({provider or '?'}) получен за {response_time:.1f}с | Токены: {total_tokens} (in: {input_tokens}, out: {output_tokens})")
+    
+    return {
+        "success": True,
+        "response": answer,
+        "tokens": total_tokens,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cached_tokens": cached_tokens,
+        "cache_write_tokens": cache_write_tokens,
+        "reasoning_tokens": reasoning_tokens,
+        "response_time": response_time,
+        "model_key": model_key,
+        "provider": provider,
+        "error": None
+    }
+
+
+async def _send_with_fallback(model_key: str, messages: list, chain: list[str],
+                              tier: str = "free", user_id: int = None, max_tokens: int = None) -> dict:
+    """Повторы и переход по цепочке запасных моделей (см. send_message)"""
+    # Засекаем время
+    start_time = time.time()
+    last_error = None
+    
+    for candidate in chain:
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = await _request_once(candidate, messages, tier, user_id, max_tokens)
+            except ModelCallError as e:
+                last_error = e
+                print(f"❌ Ошибка OpenRouter ({candidate}, попытка {attempt}, {KIND_NAMES[e.kind]}): {e.message}")
+                
+                delay = _retry_delay(e, attempt, start_time)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+                continue
+            
+            result["response_time"] = time.time() - start_time
+            result["fallback_from"] = model_key if candidate != model_key else None
+            return result
+        
+        if not _can_fallback(last_error, start_time):
+            break
+    
+    return _error_result(last_error.message, time.time() - start_time, last_error.kind)
+
+
+async def _send_hedged(model_key: str, messages: list, chain: list[str],
+                       tier: str = "free", user_id: int = None, max_tokens: int = None) -> dict:
+    """_send_with_fallback с хеджем: если модель долго молчит - параллельно спрашиваем другую (см. hedging)"""
+    backup_key = hedging.pick_backup(model_key, chain, tier)
+    if backup_key is None:
+        return await _send_with_fallback(model_key, messages, chain, tier, user_id, max_tokens)
+    
+    result, winner = await hedging.race(
+        lambda: _send_with_fallback(model_key, messages, chain, tier, user_id, max_tokens),
+        lambda: _send_with_fallback(backup_key, messages, [backup_key], tier, user_id, max_tokens),
+        hedging.hedge_delay(model_key, latency.TOTAL),
+    )
+    if winner == hedging.BACKUP and result["success"]:
+        print(f"🏁 Хедж: {backup_key} ответила раньше {model_key}")
+        result["fallback_from"] = model_key
+        result["hedged"] = True
+    return result
+
+
+async def send_message(model_key: str, messages: list, tier: str = "free", use_cache: bool = False,
+                       user_id: int = None, max_tokens: int = None) -> dict:
     """
     Отправляет массив сообщений в выбранную модель
     
     messages: [{"role": "user", "content": "..."}, {"role": "assistant", "content": "..."}, ...]
+    tier: тариф пользователя - от него зависят запасные модели и место в очереди к модели
+    user_id: telegram_id - чтобы один пользователь не занимал все слоты модели
+    use_cache: искать ответ в кэше ответов (для запросов без контекста, см. response_cache)
+    max_tokens: потолок длины ответа (обычно остаток лимита пользователя), дальше
+                его урезают лимиты самой модели (см. get_max_tokens)
+    
+    Временные ошибки (429, 5xx, пустой ответ) повторяются с экспоненциальной паузой,
+    если модель так и не ответила - запрос уходит на следующую модель из "fallback".
+    Одинаковые одновременные запросы склеиваются в один (см. singleflight).
+    Для бесплатного тарифа медленный запрос может быть продублирован в другую модель (см. hedging).
     
     Возвращает:
     {
@@ -24,105 +473,287 @@ async def send_message(model_key: str, messages: list) -> dict:
         "tokens": int или None,
         "input_tokens": int или None,  # НОВОЕ
         "output_tokens": int или None,  # НОВОЕ
-        "response_time": float или None,  # НОВОЕ
-        "error": str или None
+        "cached_tokens": int,  # из input_tokens прочитано из кэша провайдера (дешевле, см. prompt_cache)
+        "cache_write_tokens": int,  # из input_tokens записано в кэш провайдера (дороже, см. pricing)
+        "reasoning_tokens": int,  # из output_tokens ушло на рассуждения (в response их нет)
+        "response_time": float или None,  # НОВОЕ (с учетом повторов)
+        "model_key": str,  # модель, которая реально ответила
+        "provider": str или None,  # провайдер OpenRouter, который ее обслужил
+        "fallback_from": str или None,  # выбранная модель, если ответила запасная
+        "error": str или None,
+        "error_kind": str или None,  # тип ошибки из resilience
+        "cached": bool,  # только если ответ взят из кэша
+        "coalesced": bool,  # только если ответ получен от такого же одновременного запроса
+        "hedged": bool  # только если ответила модель, спрошенная параллельно из-за медленной основной
     }
     """
-    try:
-        # Получаем ID модели из конфига
-        if model_key not in MODELS:
-            return {
-                "success": False,
-                "response": None,
-                "tokens": None,
-                "input_tokens": None,
-                "output_tokens": None,
-                "response_time": None,
-                "error": "Неизвестная модель"
-            }
-        
-        model_id = MODELS[model_key]["id"]
-
-        # 🔍 ОТЛАДКА: Показываем что отправляем в API
-        print(f"\n{'='*60}")
-        print(f"📤 Отправляем в {model_id}:")
-        print(f"📝 Количество сообщений: {len(messages)}")
-        for i, msg in enumerate(messages):
-            print(f"  {i+1}. [{msg['role']}]: {msg['content'][:80]}...")
-        print(f"{'='*60}\n")
-        
-        # Засекаем время
-        start_time = time.time()
-        
-        # Отправляем запрос с полной историей
-        response = client.chat.completions.create(
-            extra_headers={
-                "HTTP-Referer": "https://t.me/your_bot",
-                "X-Title": "AI Multi Bot",
-            },
-            model=model_id,
-            messages=messages,
-            max_tokens=16384,
-        )
-        
-        # Считаем время ответа
-        response_time = time.time() - start_time
-        
-        # Извлекаем ответ с проверкой
-        if not response.choices or not response.choices[0].message.content:
-            return {
-                "success": False,
-                "response": None,
-                "tokens": None,
-                "input_tokens": None,
-                "output_tokens": None,
-                "response_time": response_time,
-                "error": "Модель вернула пустой ответ (возможно таймаут)"
-            }
-        
-        answer = response.choices[0].message.content
-        
-        # Извлекаем метрики токенов
-        if response.usage:
-            total_tokens = response.usage.total_tokens
-            input_tokens = response.usage.prompt_tokens if hasattr(response.usage, 'prompt_tokens') else 0
-            output_tokens = response.usage.completion_tokens if hasattr(response.usage, 'completion_tokens') else 0
-            
-            # Если input/output не разделены - делаем примерную оценку
-            if input_tokens == 0 and output_tokens == 0:
-                # Примерно 70% на input, 30% на output
-                input_tokens = int(total_tokens * 0.7)
-                output_tokens = int(total_tokens * 0.3)
-        else:
-            total_tokens = 0
-            input_tokens = 0
-            output_tokens = 0
-        
-        print(f"✅ Ответ получен за {response_time:.1f}с | Токены: {total_tokens} (in: {input_tokens}, out: {output_tokens})")
-        
-        return {
-            "success": True,
-            "response": answer,
-            "tokens": total_tokens,
-            "input_tokens": input_tokens,
-            "output_tokens": output_tokens,
-            "response_time": response_time,
-            "error": None
-        }
+    # Получаем ID модели из конфига
+    if model_key not in MODELS:
+        return _error_result("Неизвестная модель")
+    
+    if max_tokens is not None:
+        max_tokens = max(max_tokens, MIN_COMPLETION_TOKENS)
+        if use_cache:
+            # Для кэша потолок округляем вниз до степени двойки - иначе у каждого пользователя свой ключ
+            max_tokens = 1 << (max_tokens.bit_length() - 1)
+    
+    # extra_body в ключе: от тарифа зависят провайдеры (а с ними квантизация и ответ) -
+    # тарифы с одинаковой маршрутизацией по-прежнему делят одну запись
+    cache_params = {"max_tokens": min(max_tokens or MAX_TOKENS, MAX_TOKENS), **_extra_body(model_key, tier)}
+    if use_cache:
+        cached = await response_cache.lookup(model_key, messages, cache_params)
+        if cached:
+            print(f"💾 Ответ {model_key} взят из кэша")
+            return cached
+    
+    _log_request(MODELS[model_key]["id"], messages)
+    
+    chain = get_fallback_chain(model_key, tier)
+    
+    send = _send_hedged if hedging.enabled_for(tier) else _send_with_fallback
+    
+    async def request():
+        result = await send(model_key, messages, chain, tier, user_id, max_tokens)
+        if use_cache:
+            await response_cache.store(model_key, messages, result, cache_params)
+        return result
+    
+    if not COALESCE_ENABLED:
+        return await request()
+    
+    # Такой же запрос уже летит (вирусный вопрос, повторные нажатия) - ждем его ответ.
+    # Цепочка в ключе: у тарифов разные запасные модели (провайдеры тарифа - уже в cache_params)
+    flight_key = response_cache.make_key(model_key, messages, dict(cache_params, chain=chain))
+    result, leader = await singleflight.do(flight_key, request)
+    if leader:
+        return dict(result)
+    
+    print(f"🔗 Запрос к {model_key} склеен с уже выполняющимся")
+    return dict(result, coalesced=True)
+
+
+async def _stream_once(model_key: str, messages: list, tier: str = "free", user_id: int = None,
+                       max_tokens: int = None):
+    """
+    Одна потоковая попытка запроса к модели
+    
+    Yields:
+        ("delta", str) - кусок текста
+        ("provider", str) - провайдер OpenRouter, обслуживший запрос (если известен)
+        ("usage", usage) - последним, если провайдер прислал usage
         
+    Raises:
+        ModelCallError: любая ошибка; EMPTY - если не пришло ни одного куска
+    """
+    _check_context(model_key, messages)
+    breaker = _acquire_breaker(model_key)
+    start_time = None
+    first_token_time = None
+    api_key = None
+    ttft_timeout = latency.get_timeout(model_key, latency.TTFT)
+    
+    try:
+        async with slot(model_key, tier, user_id), key_pool.lease() as api_key:
+            start_time = time.time()  # ожидание слота не считаем задержкой модели
+            raw = await _client_for(api_key.key).chat.completions.with_raw_response.create(
+                **_request_options(model_key, messages, tier, max_tokens),
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=latency.get_timeout(model_key, latency.TOTAL),
+            )
+            api_key.record_headers(raw.headers)
+            stream = raw.parse()
+            async with stream:
+                usage = None
+                provider = None
+                think = reasoning.ThinkFilter()  # <think>...</think> пользователю не показываем
+                chunks = aiter(stream)
+                while True:
+                    try:
+                        if first_token_time is None:
+                            # Первый токен ждем не дольше обычного для модели
+                            waited = time.time() - start_time
+                            chunk = await asyncio.wait_for(anext(chunks), max(ttft_timeout - waited, 0))
+                        else:
+                            chunk = await anext(chunks)
+                    except StopAsyncIteration:
+                        break
+                    except TimeoutError:
+                        raise ModelCallError(TIMEOUT, f"Модель не прислала первый токен за {ttft_timeout:.0f}с")
+                    
+                    # usage приходит в последнем чанке (обычно с пустым choices)
+                    if chunk.usage:
+                        usage = chunk.usage
+                    provider = provider or getattr(chunk, "provider", None)
+                    if not chunk.choices:
+                        continue
+                    
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        delta = think.feed(delta)
+                    if delta:
+                        if first_token_time is None:
+                            first_token_time = time.time() - start_time
+                        yield "delta", delta
+                
+                tail = think.flush()
+                if tail:
+                    first_token_time = first_token_time or time.time() - start_time
+                    yield "delta", tail
+    except (asyncio.CancelledError, GeneratorExit):
+        # Пользователь ушел / стрим закрыли снаружи - модель не виновата
+        breaker.record_cancel()
+        raise
     except Exception as e:
-        error_msg = str(e)
-        print(f"❌ Ошибка OpenRouter: {error_msg}")
+        error = classify_error(e)
+        _record_error(model_key, breaker, api_key, error, start_time)
+        raise error from e
+    
+    if first_token_time is None:
+        breaker.record_failure(time.time() - start_time)
+        raise ModelCallError(EMPTY, "Модель вернула пустой ответ (возможно таймаут)")
+    
+    # Для стрима здоровье модели меряем по времени до первого токена
+    _record_success(model_key, breaker, first_token_time, streamed=True)
+    response_time = time.time() - start_time
+    latency.record(model_key, latency.TTFT, first_token_time, provider)
+    latency.record(model_key, latency.TOTAL, response_time, provider)
+    total_tokens, input_tokens, output_tokens = _parse_usage(usage)
+    # Скорость генерации - для таймаутов обычных запросов (см. latency.get_request_timeout).
+    # Рассуждения идут до первого видимого токена - их не считаем
+    visible_tokens = (getattr(usage, "completion_tokens", 0) or 0) - reasoning.reasoning_tokens(usage) if usage else 0
+    if visible_tokens > 1:
+        latency.record(model_key, latency.PER_TOKEN,
+                       (response_time - first_token_time) / (visible_tokens - 1), provider)
+    api_key.tokens += total_tokens
+    token_estimator.observe(model_key, messages, _reported_prompt_tokens(usage))
+    prompt_cache.record(model_key, input_tokens, prompt_cache.cached_tokens(usage),
+                        prompt_cache.cache_write_tokens(usage))
+    reasoning.record(model_key, output_tokens, reasoning.reasoning_tokens(usage))
+    if provider:
+        yield "provider", provider
+    yield "usage", usage
+
+
+async def stream_message(model_key: str, messages: list, tier: str = "free", user_id: int = None,
+                         max_tokens: int = None):
+    """
+    Потоковая версия send_message: отдает ответ кусками по мере генерации
+    
+    Yields:
+        {"type": "delta", "content": str} - очередной кусок текста
+        {"type": "done", "result": dict}  - последний event, result в формате send_message
+                                            (+ "first_token_time" - секунд до первого куска)
+    
+    Повторы и запасные модели - как в send_message, но только пока пользователю
+    ничего не показано. Токены берутся из usage последнего чанка стрима.
+    Если первый токен долго не приходит, бесплатный запрос может быть продублирован
+    в другую модель - показывается тот ответ, что начался раньше (см. hedging).
+    """
+    if model_key not in MODELS:
+        yield {"type": "done", "result": _error_result("Неизвестная модель")}
+        return
+    
+    _log_request(MODELS[model_key]["id"], messages)
+    
+    chain = get_fallback_chain(model_key, tier)
+    backup_key = hedging.pick_backup(model_key, chain, tier) if hedging.enabled_for(tier) else None
+    
+    if backup_key is None:
+        events = _stream_with_fallback(model_key, messages, chain, tier, user_id, max_tokens)
+        async with contextlib.aclosing(events):
+            async for event in events:
+                yield event
+        return
+    
+    events = hedging.race_streams(
+        lambda: _stream_with_fallback(model_key, messages, chain, tier, user_id, max_tokens),
+        lambda: _stream_with_fallback(backup_key, messages, [backup_key], tier, user_id, max_tokens),
+        hedging.hedge_delay(model_key, latency.TTFT),
+    )
+    async with contextlib.aclosing(events):
+        async for winner, event in events:
+            if winner == hedging.BACKUP and event["type"] == "done" and event["result"]["success"]:
+                print(f"🏁 Хедж: {backup_key} начала отвечать раньше {model_key}")
+                event["result"]["fallback_from"] = model_key
+                event["result"]["hedged"] = True
+            yield event
+
+
+async def _stream_with_fallback(model_key: str, messages: list, chain: list[str],
+                                tier: str = "free", user_id: int = None, max_tokens: int = None):
+    """Повторы и переход по цепочке запасных моделей для стрима (см. stream_message)"""
+    start_time = time.time()
+    last_error = None
+    
+    for candidate in chain:
+        attempt = 0
+        while True:
+            attempt += 1
+            first_token_time = None
+            parts = []
+            usage = None
+            provider = None
+            
+            try:
+                # Закрыли нас - сразу закрываем и попытку (слот, ключ, HTTP-поток)
+                attempt_stream = _stream_once(candidate, messages, tier, user_id, max_tokens)
+                async with contextlib.aclosing(attempt_stream):
+                    async for kind, payload in attempt_stream:
+                        if kind == "usage":
+                            usage = payload
+                            continue
+                        if kind == "provider":
+                            provider = payload
+                            continue
+                        if first_token_time is None:
+                            first_token_time = time.time() - start_time
+                        parts.append(payload)
+                        yield {"type": "delta", "content": payload}
+            except ModelCallError as e:
+                last_error = e
+                print(f"❌ Ошибка OpenRouter (stream, {candidate}, попытка {attempt}, {KIND_NAMES[e.kind]}): {e.message}")
+                
+                if parts:
+                    # Часть ответа уже показана - повтор перемешал бы тексты
+                    result = _error_result(e.message, time.time() - start_time, e.kind)
+                    result["response"] = "".join(parts)  # то, что успели получить
+                    yield {"type": "done", "result": result}
+                    return
+                
+                delay = _retry_delay(e, attempt, start_time)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+                continue
+            
+            response_time = time.time() - start_time
+            total_tokens, input_tokens, output_tokens = _parse_usage(usage)
+            
+            print(f"✅ Стрим {candidate} ({provider or '?'}) завершен за {response_time:.1f}с (первый токен: {first_token_time:.1f}с) | Токены: {total_tokens} (in: {input_tokens}, out: {output_tokens})")
+            
+            yield {"type": "done", "result": {
+                "success": True,
+                "response": "".join(parts),
+                "tokens": total_tokens,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "cached_tokens": prompt_cache.cached_tokens(usage),
+                "cache_write_tokens": prompt_cache.cache_write_tokens(usage),
+                "reasoning_tokens": reasoning.reasoning_tokens(usage),
+                "response_time": response_time,
+                "first_token_time": first_token_time,
+                "model_key": candidate,
+                "provider": provider,
+                "fallback_from": model_key if candidate != model_key else None,
+                "error": None
+            }}
+            return
         
-        return {
-            "success": False,
-            "response": None,
-            "tokens": None,
-            "input_tokens": None,
-            "output_tokens": None,
-            "response_time": None,
-            "error": error_msg
-        }
+        if not _can_fallback(last_error, start_time):
+            break
+    
+    yield {"type": "done", "result": _error_result(last_error.message, time.time() - start_time, last_error.kind)}
 
 
 def get_model_name(model_key: str) -> str:
@@ -1,8 +1,23 @@
 """
 Модуль для подсчета стоимости запросов к AI моделям
+
+Цены берутся из каталога OpenRouter (catalog.py, USD за токен).
+MODEL_PRICING - запасной вариант для моделей, которых нет в каталоге.
+
+Для аудита и симуляции тарифов есть пакетный расчет calculate_costs:
+с NumPy (есть в requirements.txt) миллионы строк пересчитываются и суммируются
+по моделям векторными операциями, без NumPy - обычным циклом.
 """
 
-# Pricing в USD за 1 миллион токенов
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from catalog import model_info
+from token_estimator import estimate_text_tokens
+
+# Pricing в USD за 1 миллион токенов (если модели нет в каталоге)
 # Данные актуальны на январь 2025
 MODEL_PRICING = {
     "mimo": {
@@ -38,7 +53,31 @@ MODEL_PRICING = {
 }
 
 
-def calculate_cost(model_key: str, input_tokens: int, output_tokens: int) -> float:
+def get_prices(model_key: str) -> tuple[float, float, float, float] | None:
+    """
+    Цены модели в USD за один токен
+    
+    Returns:
+        tuple: (input, output, cache_read, cache_write) или None, если модель неизвестна.
+        cache_read - чтение из кэша провайдера, cache_write - запись в него
+        (Anthropic/Gemini берут за нее больше input); если отдельной цены нет - как input
+    """
+    info = model_info(model_key)
+    if info is not None:
+        cache_read = info.cache_read_price if info.cache_read_price is not None else info.prompt_price
+        cache_write = info.cache_write_price if info.cache_write_price is not None else info.prompt_price
+        return info.prompt_price, info.completion_price, cache_read, cache_write
+    
+    if model_key in MODEL_PRICING:
+        pricing = MODEL_PRICING[model_key]
+        input_price = pricing["input"] / 1_000_000
+        return input_price, pricing["output"] / 1_000_000, input_price, input_price
+    
+    return None
+
+
+def calculate_cost(model_key: str, input_tokens: int, output_tokens: int, cached_tokens: int = 0,
+                   cache_write_tokens: int = 0) -> float:
     """
     Рассчитывает стоимость запроса в USD
     
@@ -46,38 +85,167 @@ def calculate_cost(model_key: str, input_tokens: int, output_tokens: int) -> flo
         model_key: Ключ модели (mimo, claude, gpt4, etc.)
         input_tokens: Количество входных токенов
         output_tokens: Количество выходных токенов
+        cached_tokens: Сколько из входных прочитано из кэша провайдера (по цене input_cache_read)
+        cache_write_tokens: Сколько из входных записано в кэш провайдера (по цене input_cache_write)
         
     Returns:
         float: Стоимость в USD
     """
-    if model_key not in MODEL_PRICING:
+    prices = get_prices(model_key)
+    if prices is None:
         return 0.0
     
-    pricing = MODEL_PRICING[model_key]
+    input_price, output_price, cached_price, write_price = prices
+    cached_tokens = min(cached_tokens or 0, input_tokens)
+    cache_write_tokens = min(cache_write_tokens or 0, input_tokens - cached_tokens)
+    total_cost = (
+        (input_tokens - cached_tokens - cache_write_tokens) * input_price
+        + cached_tokens * cached_price
+        + cache_write_tokens * write_price
+        + output_tokens * output_price
+    )
     
-    # Стоимость = (input_tokens / 1_000_000) * input_price + (output_tokens / 1_000_000) * output_price
-    input_cost = (input_tokens / 1_000_000) * pricing["input"]
-    output_cost = (output_tokens / 1_000_000) * pricing["output"]
+    return round(total_cost, 6)  # Округляем до 6 знаков
+
+
+def _price_lookup(overrides: dict = None):
+    """
+    Функция model_key -> (input, output, cache_read, cache_write) в USD за токен, с учетом overrides
     
-    total_cost = input_cost + output_cost
+    У переопределенной модели цены кэша меняются в той же пропорции, что и input
+    """
+    overrides = overrides or {}
     
-    return round(total_cost, 6)  # Округляем до 6 знаков
+    def prices_for(model_key):
+        prices = get_prices(model_key) or (0.0, 0.0, 0.0, 0.0)
+        if model_key not in overrides:
+            return prices
+        input_price, output_price = (price / 1_000_000 for price in overrides[model_key])
+        scale = input_price / prices[0] if prices[0] else None
+        cache_read, cache_write = (price * scale for price in prices[2:]) if scale is not None else (input_price,) * 2
+        return input_price, output_price, cache_read, cache_write
+    
+    return prices_for
+
+
+def _encode_models(model_keys):
+    """Ключи моделей -> (уникальные ключи, номер уникального ключа для каждой строки)"""
+    keys = np.asarray(model_keys, dtype=object).astype(str)
+    return np.unique(keys, return_inverse=True)
+
+
+def _costs_by_index(unique_keys, index, input_tokens, output_tokens, overrides: dict = None,
+                    cached_tokens=None, cache_write_tokens=None):
+    """Векторный расчет: цены ищем один раз на каждую модель, дальше - одна операция на весь массив"""
+    prices_for = _price_lookup(overrides)
+    prices = np.array([prices_for(key) for key in unique_keys], dtype=np.float64).reshape(-1, 4)
+    tokens_in = np.nan_to_num(np.asarray(input_tokens, dtype=np.float64))
+    tokens_out = np.nan_to_num(np.asarray(output_tokens, dtype=np.float64))
+    cached = np.zeros_like(tokens_in) if cached_tokens is None else np.nan_to_num(np.asarray(cached_tokens, dtype=np.float64))
+    written = np.zeros_like(tokens_in) if cache_write_tokens is None else np.nan_to_num(np.asarray(cache_write_tokens, dtype=np.float64))
+    cached = np.minimum(cached, tokens_in)
+    written = np.minimum(written, tokens_in - cached)
+    return (
+        (tokens_in - cached - written) * prices[index, 0]
+        + tokens_out * prices[index, 1]
+        + cached * prices[index, 2]
+        + written * prices[index, 3]
+    )
 
 
-def estimate_tokens(text: str) -> int:
+def calculate_costs(model_keys, input_tokens, output_tokens, overrides: dict = None,
+                    cached_tokens=None, cache_write_tokens=None):
+    """
+    Стоимость сразу для многих запросов (строки таблицы messages) - как calculate_cost
+    
+    Args:
+        model_keys: последовательность ключей моделей
+        input_tokens, output_tokens: последовательности той же длины
+        overrides: {model_key: (input, output)} - свои цены в USD за 1M токенов,
+                   для симуляции тарифов ("а если бы claude стоил вдвое дешевле")
+        cached_tokens, cache_write_tokens: чтение из кэша провайдера и запись в него (None - не было)
+    
+    Returns:
+        numpy.ndarray (если установлен NumPy) или list[float] - стоимость каждой строки в USD
+    """
+    if np is None:
+        prices_for = _price_lookup(overrides)
+        table = {}
+        costs = []
+        rows = len(model_keys) if hasattr(model_keys, "__len__") else None
+        cached_tokens = cached_tokens if cached_tokens is not None else [0] * (rows or 0)
+        cache_write_tokens = cache_write_tokens if cache_write_tokens is not None else [0] * (rows or 0)
+        for model_key, tokens_in, tokens_out, cached, written in zip(
+            model_keys, input_tokens, output_tokens, cached_tokens, cache_write_tokens
+        ):
+            if model_key not in table:
+                table[model_key] = prices_for(model_key)
+            input_price, output_price, cached_price, write_price = table[model_key]
+            tokens_in = tokens_in or 0
+            cached = min(cached or 0, tokens_in)
+            written = min(written or 0, tokens_in - cached)
+            costs.append(
+                (tokens_in - cached - written) * input_price + (tokens_out or 0) * output_price
+                + cached * cached_price + written * write_price
+            )
+        return costs
+    
+    unique_keys, index = _encode_models(model_keys)
+    return _costs_by_index(unique_keys, index, input_tokens, output_tokens, overrides,
+                           cached_tokens, cache_write_tokens)
+
+
+def reprice_summary(model_keys, input_tokens, output_tokens, recorded_costs, overrides: dict = None,
+                    cached_tokens=None, cache_write_tokens=None) -> dict:
+    """
+    Аудит: сколько списали и сколько стоили бы запросы по текущим (или заданным) ценам
+    
+    С NumPy и пересчет, и суммы по моделям (np.bincount) - векторные операции
+    над всеми строками, без цикла Python по строкам.
+    
+    Returns:
+        dict: {model_key: {"rows": int, "recorded": float, "repriced": float}}
+    """
+    if np is None:
+        model_keys = list(model_keys)
+        repriced = calculate_costs(model_keys, input_tokens, output_tokens, overrides,
+                                   cached_tokens, cache_write_tokens)
+        summary = {}
+        for model_key, recorded, new_cost in zip(model_keys, recorded_costs, repriced):
+            row = summary.setdefault(model_key, {"rows": 0, "recorded": 0.0, "repriced": 0.0})
+            row["rows"] += 1
+            row["recorded"] += recorded or 0.0
+            row["repriced"] += new_cost
+        return summary
+    
+    unique_keys, index = _encode_models(model_keys)
+    repriced = _costs_by_index(unique_keys, index, input_tokens, output_tokens, overrides,
+                               cached_tokens, cache_write_tokens)
+    recorded = np.nan_to_num(np.asarray(recorded_costs, dtype=np.float64))
+    
+    size = len(unique_keys)
+    rows = np.bincount(index, minlength=size)
+    recorded_sums = np.bincount(index, weights=recorded, minlength=size)
+    repriced_sums = np.bincount(index, weights=repriced, minlength=size)
+    return {
+        str(model_key): {"rows": int(rows[i]), "recorded": float(recorded_sums[i]), "repriced": float(repriced_sums[i])}
+        for i, model_key in enumerate(unique_keys)
+    }
+
+
+def estimate_tokens(text: str, model_key: str = None) -> int:
     """
     Приблизительная оценка количества токенов в тексте
-    Правило: ~1 токен = 4 символа (для английского) или ~1 токен = 2 символа (для русского)
+    Считает токенизатором семейства модели (см. token_estimator)
     
     Args:
         text: Текст для оценки
+        model_key: Ключ модели (без него - усредненная оценка)
         
     Returns:
         int: Примерное количество токенов
     """
-    # Простая эвристика: считаем среднее между английским и русским
-    # 1 токен ≈ 3 символа
-    return len(text) // 3
+    return estimate_text_tokens(text, model_key)
 
 
 def is_free_model(model_key: str) -> bool:
@@ -90,11 +258,11 @@ def is_free_model(model_key: str) -> bool:
     Returns:
         bool: True если модель бесплатная
     """
-    if model_key not in MODEL_PRICING:
+    prices = get_prices(model_key)
+    if prices is None:
         return False
     
-    pricing = MODEL_PRICING[model_key]
-    return pricing["input"] == 0.0 and pricing["output"] == 0.0
+    return prices[0] == 0.0 and prices[1] == 0.0
 
 
 def format_cost(cost: float) -> str:
@@ -127,7 +295,8 @@ def get_model_info(model_key: str) -> dict:
     Returns:
         dict: Словарь с информацией о ценах
     """
-    if model_key not in MODEL_PRICING:
+    prices = get_prices(model_key)
+    if prices is None:
         return {
             "input": 0.0,
             "output": 0.0,
@@ -135,10 +304,16 @@ def get_model_info(model_key: str) -> dict:
             "is_free": True
         }
     
-    pricing = MODEL_PRICING[model_key]
+    info = model_info(model_key)
+    if info is not None:
+        description = info.name
+    else:
+        description = MODEL_PRICING[model_key]["description"]
+    
+    # Для показа - USD за 1M токенов, как в MODEL_PRICING
     return {
-        "input": pricing["input"],
-        "output": pricing["output"],
-        "description": pricing["description"],
+        "input": prices[0] * 1_000_000,
+        "output": prices[1] * 1_000_000,
+        "description": description,
         "is_free": is_free_model(model_key)
-    }
\ No newline at end of file
+    }
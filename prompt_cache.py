@@ -0,0 +1,107 @@
+"""
+Кэширование промпта у провайдера (prompt caching)
+
+Системный промпт и старая часть истории повторяются в каждом запросе чата.
+Провайдеры умеют кэшировать такой префикс и берут за его повторное чтение
+в разы меньше (input_cache_read в каталоге):
+- OpenAI, DeepSeek и др. кэшируют сами, нужно только не менять начало запроса;
+- Anthropic и Gemini кэшируют по явным меткам cache_control - их ставим сюда:
+  на конец блока системных сообщений и на последнее сообщение перед новым.
+
+Сколько prompt-токенов пришло из кэша, видно в usage ответа
+(prompt_tokens_details.cached_tokens); по этим числам ведется доля попаданий.
+Запись в кэш (prompt_tokens_details.cache_write_tokens) у Anthropic и Gemini
+стоит дороже обычного input - ее тоже считаем и оплачиваем отдельно (см. pricing).
+"""
+
+from config import PROMPT_CACHE_ENABLED, PROMPT_CACHE_MIN_TOKENS
+from catalog import model_info
+from token_estimator import estimate_text_tokens
+
+
+_EPHEMERAL = {"type": "ephemeral"}
+
+_stats: dict[str, dict] = {}
+
+
+def needs_markers(model_key: str) -> bool:
+    """Кэширует ли провайдер модели только по явным меткам (у таких в каталоге есть цена записи в кэш)"""
+    info = model_info(model_key)
+    return info is not None and info.cache_write_price is not None
+
+
+def _with_marker(message: dict) -> dict:
+    content = message["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [dict(part) for part in content]
+    content[-1]["cache_control"] = _EPHEMERAL
+    return {**message, "content": content}
+
+
+def apply_markers(model_key: str, messages: list) -> list:
+    """
+    Ставит метки cache_control на стабильный префикс запроса
+
+    Returns:
+        list: новые messages (исходные не меняются) или те же, если метки не нужны
+    """
+    if not PROMPT_CACHE_ENABLED or not needs_markers(model_key):
+        return messages
+
+    # Префикс - все, кроме нового сообщения; слишком короткий провайдер все равно не кэширует
+    prefix_end = len(messages) - 1
+    if prefix_end <= 0:
+        return messages
+    prefix_tokens = sum(estimate_text_tokens(m["content"], model_key)
+                        for m in messages[:prefix_end] if isinstance(m["content"], str))
+    if prefix_tokens < PROMPT_CACHE_MIN_TOKENS:
+        return messages
+
+    marks = {prefix_end - 1}
+    system_end = 0
+    while system_end < prefix_end and messages[system_end]["role"] == "system":
+        system_end += 1
+    if system_end:
+        # Системный промпт меняется реже истории - отдельная точка кэша
+        marks.add(system_end - 1)
+
+    return [_with_marker(m) if i in marks else m for i, m in enumerate(messages)]
+
+
+def cached_tokens(usage) -> int:
+    """Сколько prompt-токенов провайдер прочитал из кэша"""
+    details = getattr(usage, "prompt_tokens_details", None) if usage else None
+    return (getattr(details, "cached_tokens", 0) or 0) if details else 0
+
+
+def cache_write_tokens(usage) -> int:
+    """Сколько prompt-токенов провайдер записал в кэш (у Anthropic - cache_creation_input_tokens)"""
+    if not usage:
+        return 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    written = getattr(details, "cache_write_tokens", 0) if details else 0
+    return written or getattr(usage, "cache_creation_input_tokens", 0) or 0
+
+
+def record(model_key: str, prompt_tokens: int, cached: int, written: int = 0):
+    """Учитывает ответ в статистике попаданий (written - записано в кэш)"""
+    stats = _stats.setdefault(
+        model_key, {"requests": 0, "hits": 0, "prompt_tokens": 0, "cached_tokens": 0, "cache_write_tokens": 0}
+    )
+    stats["requests"] += 1
+    stats["hits"] += 1 if cached else 0
+    stats["prompt_tokens"] += prompt_tokens
+    stats["cached_tokens"] += cached
+    stats["cache_write_tokens"] += written
+
+
+def prompt_cache_stats() -> dict:
+    """Доля закэшированных prompt-токенов по моделям"""
+    return {
+        model_key: dict(
+            stats,
+            hit_ratio=stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0,
+        )
+        for model_key, stats in _stats.items()
+    }
@@ -0,0 +1,125 @@
+"""
+Рассуждения (reasoning) у reasoning-моделей
+
+Такие модели (DeepSeek R1 и производные, Gemini 2.5 и др.) перед ответом
+"думают" и тратят на это выходные токены. Здесь:
+- параметры reasoning для запроса: effort (сколько думать) и exclude
+  (не присылать сами рассуждения) - только из настроек модели: моделям,
+  которые думают лишь по запросу (Claude, Gemini), мышление не включаем;
+- вырезание рассуждений, которые модель все же вставила в текст ответа
+  тегами <think>...</think>: в историю и в Telegram идет только ответ;
+- учет reasoning-токенов отдельно от обычных выходных.
+"""
+
+import re
+
+from config import MODELS
+from catalog import model_info
+
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+_THINK_BLOCK = re.compile(r"<think>.*?(</think>|$)", re.DOTALL)
+
+_stats: dict[str, dict] = {}
+
+
+def get_reasoning_options(model_key: str) -> dict | None:
+    """
+    Параметр reasoning для запроса - из "reasoning" модели в MODELS
+
+    Тариф его не задает: для Claude/Gemini reasoning не ограничивает, а включает
+    мышление, которое дорожает и требует бюджет больше max_tokens
+
+    Returns:
+        dict | None: {"effort": ..., "exclude": ...} или None, если для модели не задан или она reasoning не принимает
+    """
+    options = MODELS[model_key].get("reasoning")
+    if not options:
+        return None
+    info = model_info(model_key)
+    if info is None or not info.supports("reasoning"):
+        return None
+    return dict(options)
+
+
+def strip_thinking(text: str) -> str:
+    """Убирает из ответа блоки <think>...</think> (и незакрытый хвост <think>...)"""
+    if THINK_OPEN not in text:
+        return text
+    return _THINK_BLOCK.sub("", text).strip()
+
+
+def _partial_tag(text: str, tag: str) -> int:
+    """Длина хвоста text, который может оказаться началом tag (тег разрезан между чанками)"""
+    for size in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:size]):
+            return size
+    return 0
+
+
+class ThinkFilter:
+    """Вырезает <think>...</think> из потока кусков текста"""
+
+    def __init__(self):
+        self.inside = False
+        self.pending = ""
+        self.started = False   # видимый текст уже был (начальные пробелы после </think> не нужны)
+
+    def feed(self, chunk: str) -> str:
+        text = self.pending + chunk
+        self.pending = ""
+        visible = []
+
+        while text:
+            tag = THINK_CLOSE if self.inside else THINK_OPEN
+            index = text.find(tag)
+            if index == -1:
+                keep = _partial_tag(text, tag)
+                if not self.inside:
+                    visible.append(text[:len(text) - keep])
+                self.pending = text[len(text) - keep:]
+                break
+            if not self.inside:
+                visible.append(text[:index])
+            text = text[index + len(tag):]
+            self.inside = not self.inside
+
+        return self._visible("".join(visible))
+
+    def flush(self) -> str:
+        """Остаток в конце стрима (обрывок, оказавшийся не тегом)"""
+        text, self.pending = ("" if self.inside else self.pending), ""
+        return self._visible(text)
+
+    def _visible(self, text: str) -> str:
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        return text
+
+
+def reasoning_tokens(usage) -> int:
+    """Сколько выходных токенов ушло на рассуждения"""
+    details = getattr(usage, "completion_tokens_details", None) if usage else None
+    return (getattr(details, "reasoning_tokens", 0) or 0) if details else 0
+
+
+def record(model_key: str, output_tokens: int, reasoning: int):
+    """Учитывает ответ в статистике рассуждений"""
+    stats = _stats.setdefault(model_key, {"requests": 0, "output_tokens": 0, "reasoning_tokens": 0})
+    stats["requests"] += 1
+    stats["output_tokens"] += output_tokens
+    stats["reasoning_tokens"] += reasoning
+
+
+def reasoning_stats() -> dict:
+    """Доля выходных токенов, ушедших на рассуждения, по моделям"""
+    return {
+        model_key: dict(
+            stats,
+            reasoning_share=stats["reasoning_tokens"] / stats["output_tokens"] if stats["output_tokens"] else 0.0,
+        )
+        for model_key, stats in _stats.items()
+    }
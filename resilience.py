@@ -0,0 +1,327 @@
+"""
+Устойчивость запросов к OpenRouter: классификация ошибок, backoff
+и circuit breaker для каждой модели
+"""
+
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import httpx
+import openai
+
+from config import (
+    RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+    BREAKER_WINDOW_SECONDS, BREAKER_MIN_REQUESTS, BREAKER_ERROR_RATE,
+    BREAKER_SLOW_CALL, BREAKER_OPEN_SECONDS, BREAKER_HALF_OPEN_MAX
+)
+
+
+# Типы ошибок
+RATE_LIMIT = "rate_limit"     # 429 - модель/ключ перегружены
+UPSTREAM = "upstream"         # 5xx и обрывы соединения у провайдера
+TIMEOUT = "timeout"           # не дождались ответа
+EMPTY = "empty"               # 200, но без текста
+UNAVAILABLE = "unavailable"   # 402/403/404 - эта модель сейчас недоступна нам
+CLIENT = "client"             # 400/401 и прочее - проблема в самом запросе
+CIRCUIT_OPEN = "circuit_open" # модель отключена circuit breaker'ом, запрос не отправлялся
+CONTEXT_TOO_LONG = "context_too_long"  # промпт не оставляет места для ответа в окне модели, запрос не отправлялся
+
+# Повторяем запрос к той же модели
+RETRYABLE = {RATE_LIMIT, UPSTREAM, EMPTY}
+# Переходим на следующую модель цепочки (таймаут не повторяем на той же модели -
+# второй раз она скорее всего тоже не успеет; у запасной окно контекста может быть больше)
+FALLBACK_OK = RETRYABLE | {TIMEOUT, UNAVAILABLE, CIRCUIT_OPEN, CONTEXT_TOO_LONG}
+# Ошибки, которые говорят о здоровье модели (CLIENT - проблема запроса, не модели)
+HEALTH_FAILURES = {RATE_LIMIT, UPSTREAM, TIMEOUT, EMPTY, UNAVAILABLE}
+# Ошибки перегрузки - по ним снижается лимит одновременных запросов (см. scheduler)
+OVERLOAD_FAILURES = {RATE_LIMIT, UPSTREAM, TIMEOUT}
+
+# Человекочитаемые названия для логов и сообщений пользователю
+KIND_NAMES = {
+    RATE_LIMIT: "лимит запросов",
+    UPSTREAM: "ошибка провайдера",
+    TIMEOUT: "таймаут",
+    EMPTY: "пустой ответ",
+    UNAVAILABLE: "модель недоступна",
+    CLIENT: "ошибка запроса",
+    CIRCUIT_OPEN: "модель временно отключена",
+    CONTEXT_TOO_LONG: "слишком длинный контекст",
+}
+
+
+class ModelCallError(Exception):
+    """Ошибка запроса к модели с типом и (опционально) Retry-After"""
+
+    def __init__(self, kind: str, message: str, retry_after: float = None, status: int = None):
+        super().__init__(message)
+        self.kind = kind
+        self.message = message
+        self.retry_after = retry_after
+        self.status = status
+
+    @property
+    def retryable(self) -> bool:
+        return self.kind in RETRYABLE
+
+    @property
+    def fallback_ok(self) -> bool:
+        return self.kind in FALLBACK_OK
+
+
+def _parse_retry_after(headers) -> float | None:
+    """
+    Сколько секунд ждать по заголовкам ответа
+
+    Retry-After бывает числом секунд или HTTP-датой, OpenRouter еще
+    присылает X-RateLimit-Reset (unix-время в миллисекундах)
+    """
+    if headers is None:
+        return None
+
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+
+    reset = headers.get("x-ratelimit-reset")
+    if reset:
+        try:
+            return max(float(reset) / 1000 - time.time(), 0.0)
+        except ValueError:
+            pass
+
+    return None
+
+
+def _status_kind(status: int) -> str:
+    """Тип ошибки по HTTP-статусу (или числовому коду ошибки в теле)"""
+    if status == 429:
+        return RATE_LIMIT
+    if status in (408, 504):
+        return TIMEOUT
+    if status >= 500:
+        return UPSTREAM
+    if status in (402, 403, 404):
+        return UNAVAILABLE
+    return CLIENT
+
+
+def _body_status(body) -> int | None:
+    """Код ошибки из тела: OpenRouter шлет {"code": 429, ...} и в середине стрима (SSE-чанк с error)"""
+    code = body.get("code") if isinstance(body, dict) else None
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(exc: Exception) -> ModelCallError:
+    """Превращает исключение клиента OpenAI/httpx в ModelCallError"""
+    if isinstance(exc, ModelCallError):
+        return exc
+
+    if isinstance(exc, openai.APITimeoutError):
+        return ModelCallError(TIMEOUT, "Модель не ответила вовремя (таймаут)")
+
+    if isinstance(exc, openai.APIConnectionError):
+        return ModelCallError(UPSTREAM, f"Ошибка соединения: {exc}")
+
+    if isinstance(exc, openai.APIStatusError):
+        status = exc.status_code
+        retry_after = _parse_retry_after(exc.response.headers)
+        return ModelCallError(_status_kind(status), str(exc), retry_after=retry_after, status=status)
+
+    # Ошибки при чтении стрима: httpx не оборачивается в ошибки openai
+    if isinstance(exc, httpx.TimeoutException):
+        return ModelCallError(TIMEOUT, f"Модель не ответила вовремя (таймаут): {exc!r}")
+
+    if isinstance(exc, httpx.TransportError):
+        return ModelCallError(UPSTREAM, f"Ошибка соединения: {exc!r}")
+
+    if isinstance(exc, openai.APIError):
+        # Ошибка пришла чанком стрима после 200 - статус только в теле
+        status = _body_status(exc.body)
+        if status is not None:
+            return ModelCallError(_status_kind(status), str(exc), status=status)
+
+    return ModelCallError(CLIENT, str(exc))
+
+
+def backoff_delay(attempt: int, retry_after: float = None) -> float:
+    """
+    Пауза перед повтором номер attempt (с 1)
+
+    Экспоненциальный рост с "full jitter", чтобы повторы разных
+    пользователей не били в API одновременно. Retry-After от сервера
+    важнее нашей оценки.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, RETRY_BASE_DELAY)
+
+    ceiling = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+    return random.uniform(0, ceiling)
+
+
+# ===== CIRCUIT BREAKER =====
+
+# Состояния
+CLOSED = "closed"        # все хорошо, запросы идут
+OPEN = "open"            # модель сбоит, запросы сразу отклоняются
+HALF_OPEN = "half_open"  # пробуем пару запросов, чтобы понять, ожила ли модель
+
+# Здоровье модели для интерфейса
+HEALTHY = "healthy"
+DEGRADED = "degraded"
+DOWN = "down"
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker одной модели
+
+    Помнит исходы запросов за последние BREAKER_WINDOW_SECONDS. Если доля ошибок
+    (медленные ответы тоже считаются ошибкой) превысила BREAKER_ERROR_RATE -
+    размыкается на BREAKER_OPEN_SECONDS, и запросы к модели сразу уходят на
+    запасные вместо 60-секундного ожидания. Потом пропускает до
+    BREAKER_HALF_OPEN_MAX пробных запросов: успех замыкает цепь, ошибка
+    снова размыкает.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.half_open_in_flight = 0
+        self.outcomes = deque()  # (время, успех, латентность)
+
+    def _trim(self, now: float):
+        while self.outcomes and now - self.outcomes[0][0] > BREAKER_WINDOW_SECONDS:
+            self.outcomes.popleft()
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        self.half_open_in_flight = 0
+        print(f"⛔ Circuit breaker {self.name}: разомкнут на {BREAKER_OPEN_SECONDS:.0f}с (ошибок: {self.error_rate():.0%})")
+
+    def _close(self):
+        self.state = CLOSED
+        self.half_open_in_flight = 0
+        self.outcomes.clear()
+        print(f"✅ Circuit breaker {self.name}: модель снова в строю")
+
+    def available(self) -> bool:
+        """Можно ли сейчас отправить запрос (без резервирования пробного слота)"""
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= BREAKER_OPEN_SECONDS
+        if self.state == HALF_OPEN:
+            return self.half_open_in_flight < BREAKER_HALF_OPEN_MAX
+        return True
+
+    def allow_request(self) -> bool:
+        """Пропустить ли запрос; в half-open занимает пробный слот"""
+        now = time.monotonic()
+
+        if self.state == OPEN:
+            if now - self.opened_at < BREAKER_OPEN_SECONDS:
+                return False
+            self.state = HALF_OPEN
+            self.half_open_in_flight = 0
+
+        if self.state == HALF_OPEN:
+            if self.half_open_in_flight >= BREAKER_HALF_OPEN_MAX:
+                return False
+            self.half_open_in_flight += 1
+
+        return True
+
+    def record_success(self, latency: float):
+        """Запрос успешен; latency - время ответа (для стрима - до первого токена)"""
+        now = time.monotonic()
+        ok = latency < BREAKER_SLOW_CALL
+
+        if self.state == HALF_OPEN:
+            self.half_open_in_flight = max(self.half_open_in_flight - 1, 0)
+            if ok:
+                self._close()
+            else:
+                self._open(now)
+            return
+
+        self.outcomes.append((now, ok, latency))
+        self._check(now)
+
+    def record_failure(self, latency: float = None):
+        """Запрос упал по вине модели"""
+        now = time.monotonic()
+
+        if self.state == HALF_OPEN:
+            self._open(now)
+            return
+
+        self.outcomes.append((now, False, latency))
+        self._check(now)
+
+    def record_cancel(self):
+        """Запрос отменен до результата - освобождаем пробный слот"""
+        if self.state == HALF_OPEN:
+            self.half_open_in_flight = max(self.half_open_in_flight - 1, 0)
+
+    def _check(self, now: float):
+        self._trim(now)
+        if self.state == CLOSED and len(self.outcomes) >= BREAKER_MIN_REQUESTS:
+            if self.error_rate() >= BREAKER_ERROR_RATE:
+                self._open(now)
+
+    def error_rate(self) -> float:
+        """Доля неудачных (и слишком медленных) запросов в окне"""
+        if not self.outcomes:
+            return 0.0
+        failures = sum(1 for _, ok, _ in self.outcomes if not ok)
+        return failures / len(self.outcomes)
+
+    def health(self) -> str:
+        """healthy / degraded / down - для отображения пользователю"""
+        self._trim(time.monotonic())
+        if self.state == OPEN:
+            return DOWN
+        if self.state == HALF_OPEN or self.error_rate() >= BREAKER_ERROR_RATE / 2:
+            return DEGRADED
+        return HEALTHY
+
+    def snapshot(self) -> dict:
+        """Состояние для логов и админки"""
+        self._trim(time.monotonic())
+        latencies = sorted(l for _, _, l in self.outcomes if l is not None)
+        return {
+            "state": self.state,
+            "health": self.health(),
+            "requests": len(self.outcomes),
+            "error_rate": self.error_rate(),
+            "avg_latency": sum(latencies) / len(latencies) if latencies else None,
+            "max_latency": latencies[-1] if latencies else None,
+        }
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(model_key: str) -> CircuitBreaker:
+    """Circuit breaker модели (создается при первом обращении)"""
+    breaker = _breakers.get(model_key)
+    if breaker is None:
+        breaker = CircuitBreaker(model_key)
+        _breakers[model_key] = breaker
+    return breaker
+
+
+def get_model_health(model_key: str) -> str:
+    """Здоровье модели: healthy / degraded / down"""
+    return get_breaker(model_key).health()
@@ -0,0 +1,198 @@
+"""
+Кэш ответов моделей для разовых запросов (/ask)
+
+Два уровня:
+- в памяти: LRU с ограничением по числу записей и объему текста
+- в SQLite (таблица response_cache): переживает перезапуск бота, включается в config
+
+Ключ - sha256 от ID модели, нормализованных сообщений и параметров запроса
+(включая маршрутизацию по провайдерам из тарифа), поэтому одинаковые вопросы
+разных пользователей попадают в одну запись.
+Ошибки БД постоянного кэша считаются промахом и запрос не прерывают.
+"""
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from config import (
+    MODELS,
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_PERSISTENT, RESPONSE_CACHE_PERSISTENT_MAX_ENTRIES,
+    RESPONSE_CACHE_HIT_CHARGE
+)
+from database import get_cached_response, save_cached_response, purge_response_cache
+
+
+# Чистим постоянный кэш раз в столько сохранений
+_PURGE_EVERY = 200
+
+# Память: ключ -> (истекает_в, размер_в_байтах, результат)
+_memory: OrderedDict[str, tuple[float, int, dict]] = OrderedDict()
+_memory_bytes = 0
+_stores_since_purge = 0
+
+_stats = {
+    "hits_memory": 0,
+    "hits_persistent": 0,
+    "misses": 0,
+    "stores": 0,
+    "evictions": 0,
+    "errors": 0,      # ошибки БД постоянного кэша (считаются промахом)
+}
+
+
+def _normalize(messages: list) -> list:
+    """
+    Одинаковые по смыслу запросы -> одинаковый ключ (регистр роли, пробелы по краям)
+
+    Пробелы внутри текста не трогаем: в коде и таблицах отступы и переносы
+    меняют смысл, такие запросы должны получать разные ответы
+    """
+    return [
+        {"role": msg["role"].lower(), "content": msg["content"].strip()}
+        for msg in messages
+    ]
+
+
+def make_key(model_key: str, messages: list, params: dict = None) -> str:
+    """Ключ кэша: ID модели + нормализованные сообщения + параметры запроса"""
+    payload = json.dumps(
+        {
+            "model": MODELS[model_key]["id"],
+            "messages": _normalize(messages),
+            "params": params or {},
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _evict_memory():
+    """Выкидывает самые давно использованные записи, пока не влезем в лимиты"""
+    global _memory_bytes
+    while _memory and (len(_memory) > RESPONSE_CACHE_MAX_ENTRIES or _memory_bytes > RESPONSE_CACHE_MAX_BYTES):
+        _, (_, size, _) = _memory.popitem(last=False)
+        _memory_bytes -= size
+        _stats["evictions"] += 1
+
+
+def _remember(key: str, result: dict, expires_at: float):
+    """Кладет результат в память"""
+    global _memory_bytes
+    _forget(key)
+
+    size = len(result["response"].encode("utf-8"))
+    _memory[key] = (expires_at, size, result)
+    _memory_bytes += size
+    _evict_memory()
+
+
+def _forget(key: str):
+    """Удаляет запись из памяти"""
+    global _memory_bytes
+    entry = _memory.pop(key, None)
+    if entry:
+        _memory_bytes -= entry[1]
+
+
+async def lookup(model_key: str, messages: list, params: dict = None) -> dict | None:
+    """
+    Ищет ответ в кэше
+
+    Returns:
+        dict: результат в формате send_message с "cached": True, или None
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+
+    key = make_key(model_key, messages, params)
+    now = time.time()
+
+    entry = _memory.get(key)
+    if entry:
+        expires_at, _, result = entry
+        if expires_at > now:
+            _memory.move_to_end(key)
+            _stats["hits_memory"] += 1
+            return dict(result, cached=True, response_time=0.0)
+        # Просрочено
+        _forget(key)
+
+    if RESPONSE_CACHE_PERSISTENT:
+        try:
+            stored = await get_cached_response(key)
+        except Exception as e:
+            # Кэш - только ускорение: сбой БД не должен ронять запрос (и склеенные с ним, см. singleflight)
+            _stats["errors"] += 1
+            print(f"⚠️ Постоянный кэш ответов недоступен: {e}")
+            stored = None
+        if stored:
+            result = {
+                "success": True,
+                "response": stored.response,
+                "tokens": stored.tokens_used,
+                "input_tokens": stored.input_tokens,
+                "output_tokens": stored.output_tokens,
+                "response_time": 0.0,
+                "model_key": stored.model_used,
+                "fallback_from": None,
+                "error": None,
+            }
+            # Поднимаем в память до конца TTL записи
+            _remember(key, result, now + (stored.expires_at - datetime.utcnow()).total_seconds())
+            _stats["hits_persistent"] += 1
+            return dict(result, cached=True)
+
+    _stats["misses"] += 1
+    return None
+
+
+async def store(model_key: str, messages: list, result: dict, params: dict = None):
+    """
+    Кладет успешный ответ в кэш
+
+    Ответы запасных моделей не кэшируем: иначе на вопрос к gpt4 весь TTL
+    отвечала бы модель, которую пользователь не выбирал
+    """
+    global _stores_since_purge
+    if not RESPONSE_CACHE_ENABLED or not result.get("success") or result.get("fallback_from"):
+        return
+
+    key = make_key(model_key, messages, params)
+    cached = {k: v for k, v in result.items() if k != "cached"}
+    _remember(key, cached, time.time() + RESPONSE_CACHE_TTL)
+    _stats["stores"] += 1
+
+    if RESPONSE_CACHE_PERSISTENT:
+        try:
+            await save_cached_response(key, model_key, cached, RESPONSE_CACHE_TTL)
+            _stores_since_purge += 1
+            if _stores_since_purge >= _PURGE_EVERY:
+                _stores_since_purge = 0
+                removed = await purge_response_cache(RESPONSE_CACHE_PERSISTENT_MAX_ENTRIES)
+                _stats["evictions"] += removed
+        except Exception as e:
+            # Ответ уже получен и лежит в памяти - сбой БД его не отменяет
+            _stats["errors"] += 1
+            print(f"⚠️ Ответ не сохранен в постоянный кэш: {e}")
+
+
+def hit_charge(tokens: int, cost: float) -> tuple[int, float]:
+    """Сколько токенов и денег списать за ответ из кэша (RESPONSE_CACHE_HIT_CHARGE от полной цены)"""
+    return int(tokens * RESPONSE_CACHE_HIT_CHARGE), round(cost * RESPONSE_CACHE_HIT_CHARGE, 6)
+
+
+def cache_stats() -> dict:
+    """Счетчики кэша для логов и админки"""
+    hits = _stats["hits_memory"] + _stats["hits_persistent"]
+    total = hits + _stats["misses"]
+    return dict(
+        _stats,
+        entries=len(_memory),
+        bytes=_memory_bytes,
+        hit_ratio=hits / total if total else 0.0,
+    )
@@ -0,0 +1,378 @@
+"""
+Планировщик запросов к моделям: честная очередь с весами тарифов
+
+Все запросы к OpenRouter получают слот через slot(). У каждой модели свой
+лимит одновременных запросов; когда слотов не хватает, запросы ждут в очереди:
+- между тарифами - взвешенная честная очередь (weighted fair queuing):
+  тариф с весом 4 получает в 4 раза больше слотов, чем тариф с весом 1,
+  но и бесплатные запросы не стоят вечно;
+- внутри тарифа - по кругу между пользователями, и у одного пользователя
+  не больше SCHEDULER_MAX_PER_USER запросов к модели одновременно.
+
+Лимит модели подстраивается под нагрузку (AdaptiveLimit), а для дешевых
+тарифов есть сброс нагрузки: если очередь слишком длинная, запрос сразу
+отклоняется с подсказкой "повторите через N секунд" (см. shed_retry_after).
+"""
+
+import asyncio
+import math
+import time
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
+
+from config import (
+    MODELS, SUBSCRIPTION_TIERS, DEFAULT_MODEL_CONCURRENCY, SCHEDULER_MAX_PER_USER,
+    ADAPTIVE_CONCURRENCY_ENABLED, ADAPTIVE_MIN_CONCURRENCY, ADAPTIVE_BACKOFF,
+    ADAPTIVE_LATENCY_TOLERANCE, ADAPTIVE_DECREASE_COOLDOWN,
+    SHED_TIERS, SHED_MAX_WAIT
+)
+
+
+# Сколько последних ожиданий помнить для перцентилей
+_WAIT_SAMPLES = 1000
+
+
+def _tier_weight(tier: str) -> float:
+    """Вес тарифа в очереди (scheduler_weight из SUBSCRIPTION_TIERS)"""
+    tier_info = SUBSCRIPTION_TIERS.get(tier, SUBSCRIPTION_TIERS["free"])
+    return float(tier_info.get("scheduler_weight", 1))
+
+
+class AdaptiveLimit:
+    """
+    Адаптивный лимит одновременных запросов к модели (AIMD + градиент задержки)
+
+    Пока задержка держится около базовой и слоты реально заняты - лимит растет
+    на 1 за каждые limit успешных ответов. При 429/5xx/таймаутах или когда
+    задержка выросла в ADAPTIVE_LATENCY_TOLERANCE раз от базовой - лимит
+    умножается на ADAPTIVE_BACKOFF (не чаще раза в ADAPTIVE_DECREASE_COOLDOWN).
+    Базовая задержка - скользящий минимум, медленно ползущий вверх.
+
+    Задержка - только время до первого токена (стрим): полное время ответа
+    растет с длиной ответа и с TTFT несравнимо, такие ответы (latency=None)
+    лишь считаются успехами.
+    """
+
+    def __init__(self, name: str, max_limit: int):
+        self.name = name
+        self.min_limit = min(ADAPTIVE_MIN_CONCURRENCY, max_limit)
+        self.max_limit = max_limit
+        self.limit = float(max(self.min_limit, max_limit // 2))
+        self.baseline = None     # "нормальная" задержка модели
+        self.recent = None       # короткая EWMA задержки
+        self.successes = 0
+        self.last_decrease = 0.0
+
+    def on_success(self, latency: float | None, in_flight: int):
+        if latency is not None:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += (latency - self.baseline) * 0.01
+            self.recent = latency if self.recent is None else self.recent + (latency - self.recent) * 0.2
+
+            if self.recent > self.baseline * ADAPTIVE_LATENCY_TOLERANCE:
+                self.on_overload()
+                return
+
+        # Растем, только если упираемся в лимит - иначе рост ничего не проверяет
+        if in_flight + 1 >= int(self.limit):
+            self.successes += 1
+            if self.successes >= self.limit:
+                self.successes = 0
+                self.limit = min(self.limit + 1, self.max_limit)
+
+    def on_overload(self):
+        now = time.monotonic()
+        if now - self.last_decrease < ADAPTIVE_DECREASE_COOLDOWN:
+            return
+        self.last_decrease = now
+        self.successes = 0
+        self.limit = max(self.limit * ADAPTIVE_BACKOFF, self.min_limit)
+        print(f"📉 {self.name}: лимит одновременных запросов снижен до {int(self.limit)}")
+
+
+class _TierQueue:
+    """Очередь одного тарифа: отдельная очередь на каждого пользователя, обход по кругу"""
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.virtual_time = 0.0  # сколько "обслужено" с учетом веса
+        self.users: OrderedDict[object, deque] = OrderedDict()
+
+    def __len__(self):
+        # Отмененные ожидания (пользователь ушел) очередь не удлиняют
+        return sum(1 for queue in self.users.values() for waiter in queue if not waiter.done())
+
+    def push(self, user_id, waiter: asyncio.Future):
+        self.users.setdefault(user_id, deque()).append(waiter)
+
+    def discard(self, user_id, waiter: asyncio.Future):
+        """Убирает ожидание, которое отменили до выдачи слота"""
+        queue = self.users.get(user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+        if not queue:
+            del self.users[user_id]
+
+    def pop(self, can_run) -> tuple[object, asyncio.Future] | None:
+        """Следующий ожидающий: первый по кругу пользователь, которому можно еще слот"""
+        for user_id in list(self.users):
+            queue = self.users[user_id]
+            # Отмененные ожидания выкидываем по пути
+            while queue and queue[0].done():
+                queue.popleft()
+            if not queue:
+                del self.users[user_id]
+                continue
+            if not can_run(user_id):
+                continue
+
+            waiter = queue.popleft()
+            # Пользователь уходит в конец круга
+            del self.users[user_id]
+            if queue:
+                self.users[user_id] = queue
+            return user_id, waiter
+        return None
+
+
+class ModelScheduler:
+    """Слоты одной модели"""
+
+    def __init__(self, model_key: str, limit: int):
+        self.model_key = model_key
+        self.adaptive = AdaptiveLimit(model_key, limit) if ADAPTIVE_CONCURRENCY_ENABLED else None
+        self.fixed_limit = limit
+        self.hold_time = None  # EWMA времени, которое запрос держит слот
+        self.in_flight = 0
+        self.user_in_flight: dict[object, int] = {}
+        self.tiers: dict[str, _TierQueue] = {}
+        self.virtual_clock = 0.0
+        self.waits: dict[str, deque] = {}
+        self.dispatched: dict[str, int] = {}
+        self.shed: dict[str, int] = {}  # сколько запросов тарифа отклонено сбросом нагрузки
+
+    @property
+    def limit(self) -> int:
+        if self.adaptive:
+            return int(self.adaptive.limit)
+        return self.fixed_limit
+
+    def record_success(self, latency: float | None):
+        """Ответ получен: кормим адаптивный лимит (latency - TTFT или None)"""
+        if self.adaptive:
+            before = self.limit
+            self.adaptive.on_success(latency, self.in_flight)
+            if self.limit > before:
+                self._dispatch()
+
+    def record_overload(self):
+        """429 / 5xx / таймаут: модель (или провайдер) перегружена"""
+        if self.adaptive:
+            self.adaptive.on_overload()
+
+    def record_hold(self, seconds: float):
+        """Сколько запрос держал слот - для оценки времени ожидания в очереди"""
+        if self.hold_time is None:
+            self.hold_time = seconds
+        else:
+            self.hold_time += (seconds - self.hold_time) * 0.1
+
+    def queued_ahead(self, tier: str) -> int:
+        """Сколько запросов будет впереди нового запроса этого тарифа"""
+        weight = _tier_weight(tier)
+        # Тарифы с большим весом пропускаем вперед целиком, с меньшим - частично
+        return sum(
+            len(q) if q.weight >= weight else math.ceil(len(q) * q.weight / weight)
+            for q in self.tiers.values()
+        )
+
+    def estimated_wait(self, tier: str) -> float:
+        """Примерное ожидание слота для нового запроса, секунд"""
+        ahead = self.queued_ahead(tier)
+        if self.in_flight < self.limit and ahead == 0:
+            return 0.0
+        hold = self.hold_time or 10.0
+        return (ahead + 1) * hold / max(self.limit, 1)
+
+    def _tier_queue(self, tier: str) -> _TierQueue:
+        queue = self.tiers.get(tier)
+        if queue is None:
+            queue = _TierQueue(_tier_weight(tier))
+            self.tiers[tier] = queue
+        return queue
+
+    def _can_run(self, user_id) -> bool:
+        return user_id is None or self.user_in_flight.get(user_id, 0) < SCHEDULER_MAX_PER_USER
+
+    def _take(self, user_id):
+        self.in_flight += 1
+        if user_id is not None:
+            self.user_in_flight[user_id] = self.user_in_flight.get(user_id, 0) + 1
+
+    def release(self, user_id):
+        """Освобождает слот и отдает его следующему в очереди"""
+        self.in_flight -= 1
+        if user_id is not None:
+            left = self.user_in_flight.get(user_id, 1) - 1
+            if left > 0:
+                self.user_in_flight[user_id] = left
+            else:
+                self.user_in_flight.pop(user_id, None)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Раздает свободные слоты: тариф с наименьшим виртуальным временем идет первым"""
+        while self.in_flight < self.limit:
+            candidates = sorted(
+                (q for q in self.tiers.values() if q.users),
+                key=lambda q: q.virtual_time,
+            )
+            for tier_queue in candidates:
+                picked = tier_queue.pop(self._can_run)
+                if picked:
+                    break
+            else:
+                return
+
+            user_id, waiter = picked
+            # Каждый слот "стоит" 1/вес - тяжелые тарифы продвигаются медленнее
+            self.virtual_clock = max(self.virtual_clock, tier_queue.virtual_time)
+            tier_queue.virtual_time += 1 / tier_queue.weight
+            self._take(user_id)
+            waiter.set_result(True)
+
+    async def acquire(self, tier: str, user_id) -> float:
+        """
+        Ждет слот модели
+
+        Returns:
+            float: сколько секунд простояли в очереди
+        """
+        start = time.monotonic()
+        tier_queue = self._tier_queue(tier)
+
+        queue_empty = not any(q.users for q in self.tiers.values())
+        if queue_empty and self.in_flight < self.limit and self._can_run(user_id):
+            # Очереди нет - сразу в работу
+            self._take(user_id)
+        else:
+            if not tier_queue.users:
+                # Тариф только что появился в очереди - без накопленного за простой "кредита"
+                tier_queue.virtual_time = max(tier_queue.virtual_time, self.virtual_clock)
+            waiter = asyncio.get_running_loop().create_future()
+            tier_queue.push(user_id, waiter)
+            self._dispatch()
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Слот уже выдали, а ждущий ушел - возвращаем
+                    self.release(user_id)
+                else:
+                    waiter.cancel()
+                    tier_queue.discard(user_id, waiter)
+                raise
+
+        waited = time.monotonic() - start
+        self.waits.setdefault(tier, deque(maxlen=_WAIT_SAMPLES)).append(waited)
+        self.dispatched[tier] = self.dispatched.get(tier, 0) + 1
+        return waited
+
+    def snapshot(self) -> dict:
+        """Состояние очереди и перцентили ожидания по тарифам"""
+        waits = {}
+        for tier, samples in self.waits.items():
+            ordered = sorted(samples)
+            waits[tier] = {
+                "count": self.dispatched.get(tier, 0),
+                "p50": _percentile(ordered, 0.50),
+                "p99": _percentile(ordered, 0.99),
+            }
+        return {
+            "limit": self.limit,
+            "max_limit": self.fixed_limit,
+            "in_flight": self.in_flight,
+            "hold_time": self.hold_time,
+            "queued": {tier: len(q) for tier, q in self.tiers.items() if q.users},
+            "wait": waits,
+            "shed": dict(self.shed),
+        }
+
+
+def _percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+_schedulers: dict[str, ModelScheduler] = {}
+
+
+def get_scheduler(model_key: str) -> ModelScheduler:
+    """Планировщик модели (создается при первом обращении)"""
+    scheduler = _schedulers.get(model_key)
+    if scheduler is None:
+        limit = MODELS[model_key].get("max_concurrency", DEFAULT_MODEL_CONCURRENCY)
+        scheduler = ModelScheduler(model_key, limit)
+        _schedulers[model_key] = scheduler
+    return scheduler
+
+
+@asynccontextmanager
+async def slot(model_key: str, tier: str = "free", user_id=None):
+    """
+    Слот для запроса к модели
+
+    async with slot("mimo", tier, user_id) as waited:
+        ...  # waited - секунд в очереди
+    """
+    scheduler = get_scheduler(model_key)
+    waited = await scheduler.acquire(tier, user_id)
+    start = time.monotonic()
+    try:
+        yield waited
+    finally:
+        scheduler.record_hold(time.monotonic() - start)
+        scheduler.release(user_id)
+
+
+def record_success(model_key: str, latency: float = None):
+    """Успешный ответ модели (latency - время до первого токена стрима, для обычного запроса None)"""
+    get_scheduler(model_key).record_success(latency)
+
+
+def record_overload(model_key: str):
+    """Признак перегрузки модели: 429, 5xx, таймаут"""
+    get_scheduler(model_key).record_overload()
+
+
+def shed_retry_after(model_key: str, tier: str) -> int | None:
+    """
+    Сброс нагрузки: отклонять ли запрос сразу вместо постановки в очередь
+
+    Касается только тарифов из SHED_TIERS. Если ожидание слота больше
+    SHED_MAX_WAIT - возвращает, через сколько секунд стоит повторить.
+
+    Returns:
+        int | None: секунд до повтора или None (запрос можно ставить в очередь)
+    """
+    if tier not in SHED_TIERS:
+        return None
+
+    scheduler = get_scheduler(model_key)
+    wait = scheduler.estimated_wait(tier)
+    if wait <= SHED_MAX_WAIT:
+        return None
+    scheduler.shed[tier] = scheduler.shed.get(tier, 0) + 1
+    return math.ceil(wait)
+
+
+def scheduler_stats() -> dict:
+    """Снимок всех планировщиков для логов и админки"""
+    return {key: scheduler.snapshot() for key, scheduler in _schedulers.items()}
@@ -0,0 +1,83 @@
+"""
+Склейка одинаковых одновременных запросов (single-flight)
+
+Если такой же запрос (модель + сообщения + параметры) уже выполняется,
+новый вызов не идет в API, а ждет результат первого ("лидера").
+Работа лидера идет в отдельной задаче: если пользователь-лидер ушел
+(его хендлер отменили), ответ все равно дойдет до остальных. Задача
+отменяется, только когда результат не ждет уже никто.
+"""
+
+import asyncio
+
+
+class _Flight:
+    """Один выполняющийся запрос и число тех, кто его ждет"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+_inflight: dict[str, _Flight] = {}
+
+_stats = {
+    "leaders": 0,     # реально отправленных запросов
+    "followers": 0,   # запросов, получивших чужой результат
+    "abandoned": 0,   # запросов, отмененных потому что их больше никто не ждет
+}
+
+
+async def do(key: str, factory) -> tuple[object, bool]:
+    """
+    Выполняет factory() один раз на все одновременные вызовы с тем же key
+
+    Args:
+        key: ключ запроса
+        factory: функция без аргументов, возвращающая корутину
+
+    Returns:
+        tuple: (результат, был_ли_этот_вызов_лидером)
+    """
+    flight = _inflight.get(key)
+    leader = flight is None
+
+    if leader:
+        flight = _Flight(asyncio.create_task(factory()))
+        _inflight[key] = flight
+        _stats["leaders"] += 1
+
+        def _done(_task, key=key, flight=flight):
+            if _inflight.get(key) is flight:
+                del _inflight[key]
+
+        flight.task.add_done_callback(_done)
+    else:
+        _stats["followers"] += 1
+
+    flight.waiters += 1
+    try:
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        result = await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # Сразу убираем из списка, чтобы новый вызов не подцепился к отмененной задаче
+            if _inflight.get(key) is flight:
+                del _inflight[key]
+            flight.task.cancel()
+            _stats["abandoned"] += 1
+        raise
+
+    flight.waiters -= 1
+    return result, leader
+
+
+def inflight_count() -> int:
+    """Сколько разных запросов выполняется прямо сейчас"""
+    return len(_inflight)
+
+
+def singleflight_stats() -> dict:
+    """Счетчики для логов и админки"""
+    return dict(_stats, inflight=len(_inflight))
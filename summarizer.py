@@ -0,0 +1,130 @@
+"""
+Сжатие старой части длинных чатов (rolling summary)
+
+Длинный чат на каждом сообщении заново отправляет в модель всю историю.
+Когда еще не сжатая часть чата перерастает SUMMARY_TRIGGER_TOKENS, старые
+сообщения (все, кроме последних ~SUMMARY_KEEP_TOKENS) пересказываются
+дешевой бесплатной моделью и дописываются в summary чата. В запрос
+(см. context_builder) дальше идет summary + свежие сообщения.
+
+Summary обновляется инкрементально: модели отдается прошлый конспект и
+только новые сообщения - не больше SUMMARY_FOLD_MAX_TOKENS за раз, самые
+старые (старый длинный чат сжимается по частям за несколько ходов). Работает
+в фоне, после ответа пользователю, и не списывается с лимита пользователя.
+
+Пора ли сжимать, обычно решается по кэшу истории чата в памяти
+(RequestContext.unsummarized_tokens) - ход диалога в БД за этим не ходит.
+"""
+
+import asyncio
+
+from config import (
+    SUMMARY_ENABLED, SUMMARY_MODEL, SUMMARY_TRIGGER_TOKENS, SUMMARY_KEEP_TOKENS, SUMMARY_FOLD_MAX_TOKENS,
+    SUMMARY_MAX_WORDS, SUMMARY_MESSAGE_MAX_CHARS
+)
+from database import RequestContext, get_unsummarized_messages, save_session_summary
+
+
+# С этой строки summary начинается в запросе к модели
+SUMMARY_PREFIX = "Краткое содержание предыдущей части разговора:"
+
+_ROLE_NAMES = {"user": "Пользователь", "assistant": "Ассистент"}
+
+_running: set[str] = set()     # чаты, для которых summary уже обновляется
+_tasks: set[asyncio.Task] = set()
+
+
+def _build_prompt(summary: str | None, messages: list) -> list:
+    lines = []
+    for message in messages:
+        content = message.content
+        if len(content) > SUMMARY_MESSAGE_MAX_CHARS:
+            content = content[:SUMMARY_MESSAGE_MAX_CHARS] + "…"
+        lines.append(f"{_ROLE_NAMES.get(message.role, message.role)}: {content}")
+
+    return [
+        {
+            "role": "system",
+            "content": (
+                "Ты ведешь краткий конспект диалога пользователя с ассистентом. "
+                "Дополни конспект новыми сообщениями: сохрани факты о пользователе, задачи, "
+                "принятые решения, важные детали (имена, числа, фрагменты кода). "
+                f"Пиши на языке диалога, не больше {SUMMARY_MAX_WORDS} слов. "
+                "Верни только обновленный конспект."
+            ),
+        },
+        {
+            "role": "user",
+            "content": f"Текущий конспект:\n{summary or '(пусто)'}\n\nНовые сообщения:\n" + "\n\n".join(lines),
+        },
+    ]
+
+
+async def summarize_session(session_id: str) -> bool:
+    """
+    Дописывает в summary чата старые сообщения, если их накопилось много
+
+    Returns:
+        bool: обновлено ли summary
+    """
+    from openrouter import send_message
+
+    # Из БД - только самые старые сообщения в пределах SUMMARY_FOLD_MAX_TOKENS
+    summary, until_id, messages, total = await get_unsummarized_messages(session_id, SUMMARY_FOLD_MAX_TOKENS)
+    if total < SUMMARY_TRIGGER_TOKENS:
+        return False
+
+    # Последние ~SUMMARY_KEEP_TOKENS оставляем как есть
+    cut = 0
+    folded = 0
+    while cut < len(messages) and folded + messages[cut].tokens <= total - SUMMARY_KEEP_TOKENS:
+        folded += messages[cut].tokens
+        cut += 1
+    # Вопрос без ответа в конспект не отправляем - пусть остается рядом с ответом
+    while cut > 0 and messages[cut - 1].role == "user":
+        cut -= 1
+    if cut == 0:
+        return False
+
+    to_fold = messages[:cut]
+    # ~3 токена на слово с запасом: конспект не должен разрастаться
+    result = await send_message(
+        SUMMARY_MODEL, _build_prompt(summary, to_fold), tier="free", max_tokens=SUMMARY_MAX_WORDS * 3
+    )
+    if not result["success"]:
+        print(f"⚠️ Summary чата {session_id} не обновлено: {result['error']}")
+        return False
+
+    saved = await save_session_summary(session_id, result["response"].strip(), to_fold[-1].id, until_id)
+    if saved:
+        print(f"🗜 Summary чата {session_id}: +{len(to_fold)} сообщений "
+              f"({sum(m.tokens for m in to_fold)} из {total} токенов)")
+    return saved
+
+
+async def _run(session_id: str):
+    try:
+        await summarize_session(session_id)
+    except Exception as e:
+        print(f"⚠️ Ошибка summary чата {session_id}: {e}")
+    finally:
+        _running.discard(session_id)
+
+
+def schedule(context: RequestContext):
+    """
+    Запускает обновление summary текущего чата в фоне (если оно еще не идет)
+
+    Если кэш истории чата в памяти - короткий чат отсеивается без запросов к БД
+    """
+    session_id = context.session_id
+    if not SUMMARY_ENABLED or not session_id or session_id in _running:
+        return
+    pending = context.unsummarized_tokens()
+    if pending is not None and pending < SUMMARY_TRIGGER_TOKENS:
+        return
+    _running.add(session_id)
+    task = asyncio.create_task(_run(session_id))
+    # Держим ссылку, иначе задачу может собрать сборщик мусора
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
@@ -0,0 +1,97 @@
+"""
+Функции database.py не держат два соединения пула одновременно
+
+Вложенная сессия (функция БД вызывает другую функцию БД, пока ее сессия
+держит соединение) при ограниченном пуле (SQLITE_PROFILES["wal"]) под
+нагрузкой выбирает все соединения, и запросы падают с TimeoutError.
+Здесь пул - одно соединение: любая вложенная сессия сразу упадет.
+
+Запуск: python -m pytest -q test_db_pool.py
+"""
+
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+import config
+import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    profile = {
+        "pragmas": config.SQLITE_PROFILES["wal"]["pragmas"],
+        "pool": {"pool_size": 1, "max_overflow": 0, "pool_timeout": 2},
+    }
+    monkeypatch.setitem(config.SQLITE_PROFILES, "single", profile)
+    engine = database.make_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", "single")
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "async_session", async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False))
+    # С пустыми кэшами функции чаще идут в БД - больше шансов поймать вложенную сессию
+    monkeypatch.setattr(database._user_cache, "enabled", False)
+    monkeypatch.setattr(database._history_cache, "enabled", False)
+
+    asyncio.run(database.init_db())
+    yield
+    asyncio.run(engine.dispose())
+
+
+async def _turn(telegram_id: int):
+    context = await database.load_request_context(telegram_id)
+    context.add_message("user", "вопрос")
+    context.auto_title("вопрос")
+    context.add_message("assistant", "ответ", model_used="mimo", usage={"tokens_used": 10})
+    context.add_token_usage(10, 0.001)
+    await context.commit()
+
+
+def test_new_users_burst(db):
+    async def run():
+        await asyncio.gather(*(_turn(telegram_id) for telegram_id in range(1, 9)))
+        return [await database.get_user_info(telegram_id) for telegram_id in range(1, 9)]
+
+    users = asyncio.run(run())
+    assert all(user and user.current_session_id for user in users)
+
+
+def test_delete_current_session(db):
+    async def run():
+        await database.get_or_create_user(1)
+        first = await database.create_new_session(1, "Первый")
+        second = await database.create_new_session(1, "Второй")
+        deleted = await database.delete_session(1, second)
+        user = await database.get_user_info(1)
+        return first, deleted, user.current_session_id
+
+    first, deleted, current = asyncio.run(run())
+    assert deleted == (True, "Чат удален")
+    assert current == first
+
+
+OPERATIONS = {
+    "save_message": lambda: database.save_message(1, "user", "привет"),
+    "get_conversation_history": lambda: database.get_conversation_history(1, 15),
+    "get_context_history": lambda: database.get_context_history(1, 10_000),
+    "auto_title_session": lambda: database.auto_title_session(1, "привет"),
+    "rename_session": lambda: database.rename_session(1, "Новое имя"),
+    "clear_conversation_history": lambda: database.clear_conversation_history(1),
+    "check_token_limit": lambda: database.check_token_limit(1, 100),
+    "update_token_usage": lambda: database.update_token_usage(1, 100, 0.01),
+    "get_user_stats": lambda: database.get_user_stats(1),
+    "get_current_session": lambda: database.get_current_session(1),
+}
+
+
+@pytest.mark.parametrize("name", OPERATIONS)
+def test_single_connection_is_enough(db, name):
+    async def run():
+        await database.get_or_create_user(1)
+        await asyncio.wait_for(OPERATIONS[name](), 10)
+
+    asyncio.run(run())
@@ -0,0 +1,168 @@
+"""
+Хеджирование: гонка основного и запасного запроса (race, race_streams)
+
+Запросы - фейковые корутины и async-генераторы, без сети. Каждая гонка
+ограничена таймаутом: зависший потребитель - это ошибка, а не долгий тест.
+
+Запуск: python -m pytest -q test_hedging.py
+"""
+
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+
+import hedging
+
+
+DELAY = 0.01
+RACE_TIMEOUT = 2.0
+
+
+@pytest.fixture(autouse=True)
+def budget(monkeypatch):
+    """Полный бюджет хеджей в каждом тесте"""
+    monkeypatch.setattr(hedging, "_budget", hedging._HedgeBudget())
+    monkeypatch.setattr(hedging, "_stats", dict.fromkeys(hedging._stats, 0))
+
+
+def _result(name: str, success: bool = True) -> dict:
+    return {"success": success, "response": name if success else None, "error": None if success else name}
+
+
+class _Call:
+    """Фейковый запрос: отвечает через delay секунд, помнит, что его отменили"""
+
+    def __init__(self, name: str, delay: float, success: bool = True, error: Exception = None):
+        self.name = name
+        self.delay = delay
+        self.success = success
+        self.error = error
+        self.started = False
+        self.cancelled = False
+
+    async def request(self) -> dict:
+        self.started = True
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error:
+            raise self.error
+        return _result(self.name, self.success)
+
+    async def stream(self):
+        self.started = True
+        try:
+            await asyncio.sleep(self.delay)
+            if self.error:
+                raise self.error
+            if not self.success:
+                yield {"type": "done", "result": _result(self.name, False)}
+                return
+            for part in ("a", "b"):
+                yield {"type": "delta", "content": f"{self.name}:{part}"}
+                await asyncio.sleep(self.delay)
+            yield {"type": "done", "result": _result(self.name)}
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled = True
+            raise
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def _collect(primary: _Call, backup: _Call) -> list:
+    events = []
+    async for winner, event in hedging.race_streams(primary.stream, backup.stream, DELAY):
+        events.append((winner, event))
+    await _settle()
+    return events
+
+
+# ===== race =====
+
+def test_race_fast_primary_does_not_hedge():
+    primary, backup = _Call("primary", 0), _Call("backup", 0)
+    result, winner = asyncio.run(asyncio.wait_for(hedging.race(primary.request, backup.request, 1.0), RACE_TIMEOUT))
+    assert winner == hedging.PRIMARY
+    assert result["response"] == "primary"
+    assert not backup.started
+
+
+def test_race_backup_wins_and_primary_is_cancelled():
+    primary, backup = _Call("primary", 10), _Call("backup", DELAY)
+
+    async def run():
+        result = await asyncio.wait_for(hedging.race(primary.request, backup.request, DELAY), RACE_TIMEOUT)
+        await _settle()
+        return result
+
+    result, winner = asyncio.run(run())
+    assert winner == hedging.BACKUP
+    assert result["response"] == "backup"
+    assert primary.cancelled
+    assert hedging._stats["backup_won"] == 1
+
+
+def test_race_both_fail_returns_first_failure():
+    primary, backup = _Call("primary", DELAY * 2, success=False), _Call("backup", DELAY * 5, success=False)
+    result, winner = asyncio.run(asyncio.wait_for(hedging.race(primary.request, backup.request, DELAY), RACE_TIMEOUT))
+    assert winner == hedging.PRIMARY
+    assert not result["success"]
+
+
+def test_race_unexpected_error_is_raised_and_loser_cancelled():
+    primary, backup = _Call("primary", DELAY * 2, error=RuntimeError("boom")), _Call("backup", 10)
+
+    async def run():
+        try:
+            await asyncio.wait_for(hedging.race(primary.request, backup.request, DELAY), RACE_TIMEOUT)
+        finally:
+            await _settle()
+
+    with pytest.raises(RuntimeError, match="boom"):
+        asyncio.run(run())
+    assert backup.cancelled
+
+
+# ===== race_streams =====
+
+def test_race_streams_fast_primary_does_not_hedge():
+    primary, backup = _Call("primary", 0), _Call("backup", 0)
+    events = asyncio.run(asyncio.wait_for(_collect(primary, backup), RACE_TIMEOUT))
+    assert {winner for winner, _ in events} == {hedging.PRIMARY}
+    assert events[-1][1]["type"] == "done"
+    assert not backup.started
+
+
+def test_race_streams_first_text_wins_and_loser_is_cancelled():
+    primary, backup = _Call("primary", 10), _Call("backup", DELAY)
+    events = asyncio.run(asyncio.wait_for(_collect(primary, backup), RACE_TIMEOUT))
+    assert {winner for winner, _ in events} == {hedging.BACKUP}
+    assert [e["content"] for _, e in events if e["type"] == "delta"] == ["backup:a", "backup:b"]
+    assert primary.cancelled
+
+
+def test_race_streams_both_fail_yields_primary_failure():
+    primary, backup = _Call("primary", DELAY * 2, success=False), _Call("backup", DELAY * 3, success=False)
+    events = asyncio.run(asyncio.wait_for(_collect(primary, backup), RACE_TIMEOUT))
+    assert len(events) == 1
+    winner, event = events[0]
+    assert winner == hedging.PRIMARY
+    assert event["result"]["error"] == "primary"
+
+
+def test_race_streams_unexpected_error_is_raised_and_loser_cancelled():
+    primary, backup = _Call("primary", DELAY * 2, error=RuntimeError("boom")), _Call("backup", 10)
+
+    with pytest.raises(RuntimeError, match="boom"):
+        asyncio.run(asyncio.wait_for(_collect(primary, backup), RACE_TIMEOUT))
+    assert backup.started
+    assert backup.cancelled
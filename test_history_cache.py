@@ -0,0 +1,50 @@
+"""
+Кольцевой буфер истории чата (database._SessionHistory)
+
+Буфер держит не больше HISTORY_CACHE_MESSAGES последних сообщений и должен
+честно сказать, когда его не хватает и историю нужно дочитать из БД.
+
+Запуск: python -m pytest -q test_history_cache.py
+"""
+
+import os
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+
+import database
+
+
+def test_history_ring_buffer_evicts_oldest(monkeypatch):
+    monkeypatch.setattr(database, "HISTORY_CACHE_MESSAGES", 3)
+    history = database._SessionHistory([(1, "user", "a", 1), (2, "assistant", "b", 1)], complete=True)
+
+    history.append(3, "user", "c", 1)
+    assert history.complete
+    history.append(4, "assistant", "dd", 2)
+
+    assert [row[0] for row in history.messages] == [2, 3, 4]
+    assert not history.complete
+    assert history.size == sum(len(content.encode("utf-8")) + database._HISTORY_ENTRY_OVERHEAD
+                               for content in ("b", "c", "dd"))
+
+
+def test_history_ring_buffer_pick(monkeypatch):
+    monkeypatch.setattr(database, "HISTORY_CACHE_MESSAGES", 3)
+    rows = [(i, "user" if i % 2 else "assistant", f"m{i}", 10) for i in range(1, 5)]
+    history = database._SessionHistory(rows, complete=False)
+
+    # Бюджет кончился внутри буфера - ответ полный
+    picked, tokens = history.pick(budget_tokens=20, max_messages=10, after_id=0)
+    assert [m["content"] for m in picked] == ["m3", "m4"]
+    assert tokens == 20
+
+    # Буфер кончился раньше бюджета, а в БД есть еще - нужен запрос в БД
+    assert history.pick(budget_tokens=1000, max_messages=10, after_id=0) is None
+
+    # Все старше after_id уже в summary - буфера хватает
+    picked, tokens = history.pick(budget_tokens=1000, max_messages=10, after_id=2)
+    assert [m["content"] for m in picked] == ["m3", "m4"]
+
+    assert history.last(2) == [{"role": "user", "content": "m3"}, {"role": "assistant", "content": "m4"}]
+    assert history.last(5) is None
@@ -0,0 +1,197 @@
+"""
+Горячие запросы database.py должны идти по индексам
+
+На большой базе (тысячи юзеров, сотни тысяч сообщений) вызываются функции
+database.py, все выполненные ими SQL-запросы перехватываются, и для каждого
+проверяется EXPLAIN QUERY PLAN: ни одна таблица не должна читаться целиком
+(SCAN). Новый запрос без подходящего индекса сломает этот тест.
+
+Запуск: python -m pytest -q test_query_plans.py
+"""
+
+import asyncio
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+
+import database
+
+
+USERS = 2_000
+CHATS_PER_USER = 5
+MESSAGES_PER_CHAT = 20
+
+TABLES = {"users", "messages", "chat_sessions", "response_cache", "latency_samples"}
+
+
+def _seed(path: str):
+    """Схема из моделей (с их индексами) + данные пачками через sqlite3"""
+    sync_engine = create_engine(f"sqlite:///{path}")
+    database.Base.metadata.create_all(sync_engine)
+    sync_engine.dispose()
+
+    random.seed(42)
+    start = datetime(2026, 1, 1)
+    users, chats, messages = [], [], []
+    message_id = 0
+    for telegram_id in range(1, USERS + 1):
+        sessions = [f"s-{telegram_id}-{n}" for n in range(CHATS_PER_USER)]
+        users.append((telegram_id, f"user{telegram_id}", "mimo", sessions[0], start, "free", 0, 100_000, start, 0.0, 0, start))
+        for n, session_id in enumerate(sessions):
+            updated = start + timedelta(minutes=random.randint(0, 500_000))
+            chats.append((telegram_id, session_id, f"Чат {n}", start, updated, True))
+            for i in range(MESSAGES_PER_CHAT):
+                message_id += 1
+                content = "слово " * random.randint(1, 60)
+                messages.append((
+                    message_id, telegram_id, "user" if i % 2 == 0 else "assistant", content, "mimo",
+                    session_id, updated + timedelta(seconds=i), len(content) // 4,
+                ))
+
+    with sqlite3.connect(path) as conn:
+        conn.executemany(
+            "INSERT INTO users (telegram_id, username, selected_model, current_session_id, created_at,"
+            " subscription_tier, tokens_used_month, tokens_limit_month, last_token_reset, total_spent_usd,"
+            " requests_today, last_request_date) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+            users,
+        )
+        conn.executemany(
+            "INSERT INTO chat_sessions (user_id, session_id, title, created_at, updated_at, is_auto_titled)"
+            " VALUES (?,?,?,?,?,?)",
+            chats,
+        )
+        conn.executemany(
+            "INSERT INTO messages (id, telegram_id, role, content, model_used, session_id, created_at, token_count)"
+            " VALUES (?,?,?,?,?,?,?,?)",
+            messages,
+        )
+        # Статистика для планировщика - как на живой базе после ANALYZE
+        conn.execute("ANALYZE")
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("plans") / "plans.db")
+    _seed(path)
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    captured = []
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            captured.append((statement, parameters))
+
+    saved = database.engine, database.async_session, database._user_cache.enabled, database._history_cache.enabled
+    database.engine = engine
+    database.async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    # Кэши в памяти спрятали бы запросы - проверяем сами запросы
+    database._user_cache.enabled = False
+    database._history_cache.enabled = False
+
+    yield path, captured
+
+    database.engine, database.async_session, database._user_cache.enabled, database._history_cache.enabled = saved
+    asyncio.run(engine.dispose())
+
+
+def _full_scans(path: str, captured: list) -> list:
+    """Запросы, план которых читает таблицу целиком"""
+    problems = []
+    with sqlite3.connect(path) as conn:
+        for statement, parameters in captured:
+            if not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "WITH")):
+                continue
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {statement}", parameters or ()).fetchall()
+            for row in plan:
+                words = row[3].split()
+                if len(words) < 2 or words[1] not in TABLES:
+                    continue
+                # Диапазон по первичному ключу (id > ?) при малом ? - тот же полный проход
+                rowid_range = "PRIMARY KEY (rowid>" in row[3] or "PRIMARY KEY (rowid<" in row[3]
+                if words[0] == "SCAN" or rowid_range:
+                    problems.append(f"{row[3]}\n    в запросе: {' '.join(statement.split())}")
+    return problems
+
+
+async def _load_history():
+    context = await database.load_request_context(7)
+    await context.load_history(10_000, 200)
+
+
+async def _load_history_buffer():
+    # Загрузка кольцевого буфера истории - отдельный запрос
+    database._history_cache.enabled = True
+    try:
+        database._history_cache.drop("s-7-0")
+        await database.prewarm_history("s-7-0")
+    finally:
+        database._history_cache.enabled = False
+
+
+async def _commit_turn():
+    context = await database.load_request_context(8)
+    context.add_message("user", "вопрос")
+    context.auto_title("вопрос")
+    context.add_message("assistant", "ответ", model_used="mimo", usage={"tokens_used": 10})
+    context.add_token_usage(10, 0.001)
+    await context.commit()
+
+
+HOT_QUERIES = {
+    "get_user_info": lambda: database.get_user_info(7, fresh=True),
+    "get_or_create_user": lambda: database.get_or_create_user(7),
+    "load_request_context": lambda: database.load_request_context(7),
+    "load_history": _load_history,
+    "load_history_buffer": _load_history_buffer,
+    "get_context_history": lambda: database.get_context_history(7, 10_000),
+    "get_conversation_history": lambda: database.get_conversation_history(7, 15),
+    "get_user_sessions": lambda: database.get_user_sessions(7),
+    "get_current_session": lambda: database.get_current_session(7),
+    "get_unsummarized_messages": lambda: database.get_unsummarized_messages("s-7-0"),
+    "get_unsummarized_messages_capped": lambda: database.get_unsummarized_messages("s-7-0", 12_000),
+    "save_session_summary": lambda: database.save_session_summary("s-7-1", "summary", 1, None),
+    "save_message": lambda: database.save_message(7, "user", "привет"),
+    "auto_title_session": lambda: database.auto_title_session(7, "привет"),
+    "commit_turn": _commit_turn,
+    "check_token_limit": lambda: database.check_token_limit(7, 100),
+    "check_model_access": lambda: database.check_model_access(7, "mimo"),
+    "update_token_usage": lambda: database.update_token_usage(7, 100, 0.01),
+    "update_selected_model": lambda: database.update_selected_model(7, "gemini"),
+    "set_system_prompt": lambda: database.set_system_prompt(7, "Ты помощник"),
+    "switch_session": lambda: database.switch_session(7, "s-7-2"),
+    "save_previous_session": lambda: database.save_previous_session(7, "s-7-3"),
+    "rename_session": lambda: database.rename_session(7, "Новое имя"),
+    "get_user_stats": lambda: database.get_user_stats(7),
+    "clear_conversation_history": lambda: database.clear_conversation_history(9),
+    "delete_session": lambda: database.delete_session(10, "s-10-4"),
+    "get_cached_response": lambda: database.get_cached_response("missing"),
+}
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES)
+def test_hot_query_uses_index(db, name):
+    path, captured = db
+    captured.clear()
+
+    asyncio.run(HOT_QUERIES[name]())
+
+    assert captured, f"{name} не выполнил ни одного запроса"
+    problems = _full_scans(path, captured)
+    assert not problems, f"{name}: полный проход по таблице\n" + "\n".join(problems)
+
+
+def test_indexes_exist(db):
+    path, _ = db
+    with sqlite3.connect(path) as conn:
+        names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"ix_messages_session_id_created_at", "ix_chat_sessions_user_id_updated_at"} <= names
@@ -0,0 +1,30 @@
+"""
+Рассуждения моделей: вырезание <think>...</think> из стрима
+
+Теги приходят разрезанными между кусками стрима - фильтр должен их
+собрать, не потеряв текст, который только похож на начало тега.
+
+Запуск: python -m pytest -q test_reasoning.py
+"""
+
+from reasoning import ThinkFilter
+
+
+def test_think_filter_tags_split_between_chunks():
+    think = ThinkFilter()
+    visible = [think.feed(chunk) for chunk in ("<thi", "nk>план ответа</th", "ink>\n\nПривет", ", мир")]
+    assert "".join(visible) + think.flush() == "Привет, мир"
+
+
+def test_think_filter_keeps_text_that_only_looks_like_tag():
+    think = ThinkFilter()
+    assert think.feed("a <") == "a "
+    assert think.feed("b") == "<b"
+    assert think.feed(" <thin") == " "
+    assert think.flush() == "<thin"
+
+
+def test_think_filter_drops_unclosed_reasoning():
+    think = ThinkFilter()
+    assert think.feed("<think>рассуждение без конца") == ""
+    assert think.flush() == ""
@@ -0,0 +1,110 @@
+"""
+Устойчивость запросов: классификация ошибок OpenAI/httpx и circuit breaker
+
+Ошибка стрима (SSE-чанк с error, обрыв или таймаут httpx при чтении)
+должна получить тот же тип, что и такая же ошибка обычного запроса -
+от типа зависят повтор, переход на запасную модель и circuit breaker.
+
+Запуск: python -m pytest -q test_resilience.py
+"""
+
+import os
+
+import httpx
+import openai
+import pytest
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+
+import resilience
+
+
+REQUEST = httpx.Request("POST", "https://openrouter.ai/api/v1/chat/completions")
+
+
+def _stream_error(code) -> openai.APIError:
+    """Как openai поднимает SSE-чанк {"error": {...}} посреди стрима"""
+    return openai.APIError("Provider returned error", REQUEST, body={"message": "Provider returned error", "code": code})
+
+
+@pytest.mark.parametrize("exc, kind", [
+    (httpx.ReadTimeout("read timed out", request=REQUEST), resilience.TIMEOUT),
+    (httpx.ConnectTimeout("connect timed out", request=REQUEST), resilience.TIMEOUT),
+    (httpx.RemoteProtocolError("peer closed connection", request=REQUEST), resilience.UPSTREAM),
+    (httpx.ReadError("connection reset", request=REQUEST), resilience.UPSTREAM),
+    (_stream_error(429), resilience.RATE_LIMIT),
+    (_stream_error("429"), resilience.RATE_LIMIT),
+    (_stream_error(502), resilience.UPSTREAM),
+    (_stream_error(504), resilience.TIMEOUT),
+    (_stream_error(400), resilience.CLIENT),
+    (_stream_error(None), resilience.CLIENT),
+])
+def test_stream_errors(exc, kind):
+    error = resilience.classify_error(exc)
+    assert error.kind == kind
+
+
+@pytest.mark.parametrize("exc", [
+    httpx.ReadTimeout("read timed out", request=REQUEST),
+    httpx.RemoteProtocolError("peer closed connection", request=REQUEST),
+    _stream_error(429),
+    _stream_error(503),
+])
+def test_transient_stream_errors_fall_back_and_hit_health(exc):
+    error = resilience.classify_error(exc)
+    assert error.fallback_ok
+    assert error.kind in resilience.HEALTH_FAILURES
+    assert error.kind in resilience.OVERLOAD_FAILURES
+
+
+def test_status_errors_unchanged():
+    response = httpx.Response(429, headers={"retry-after": "3"}, request=REQUEST)
+    error = resilience.classify_error(openai.RateLimitError("rate limited", response=response, body=None))
+    assert error.kind == resilience.RATE_LIMIT
+    assert error.status == 429
+    assert error.retry_after == 3.0
+
+    error = resilience.classify_error(openai.APITimeoutError(REQUEST))
+    assert error.kind == resilience.TIMEOUT
+
+
+# ===== CIRCUIT BREAKER =====
+
+def test_breaker_opens_and_recovers_through_half_open():
+    breaker = resilience.CircuitBreaker("test")
+    for _ in range(resilience.BREAKER_MIN_REQUESTS):
+        assert breaker.allow_request()
+        breaker.record_failure(1.0)
+    assert breaker.state == resilience.OPEN
+    assert not breaker.allow_request()
+
+    breaker.opened_at -= resilience.BREAKER_OPEN_SECONDS
+    assert breaker.allow_request()
+    assert breaker.state == resilience.HALF_OPEN
+    # Пробных запросов не больше BREAKER_HALF_OPEN_MAX
+    for _ in range(resilience.BREAKER_HALF_OPEN_MAX - 1):
+        assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+    breaker.record_success(1.0)
+    assert breaker.state == resilience.CLOSED
+
+
+def test_breaker_slow_calls_count_as_failures():
+    breaker = resilience.CircuitBreaker("test")
+    for _ in range(resilience.BREAKER_MIN_REQUESTS):
+        breaker.record_success(resilience.BREAKER_SLOW_CALL + 1)
+    assert breaker.state == resilience.OPEN
+
+
+def test_breaker_cancel_frees_probe_slot():
+    breaker = resilience.CircuitBreaker("test")
+    for _ in range(resilience.BREAKER_MIN_REQUESTS):
+        breaker.record_failure(1.0)
+    breaker.opened_at -= resilience.BREAKER_OPEN_SECONDS
+    for _ in range(resilience.BREAKER_HALF_OPEN_MAX):
+        assert breaker.allow_request()
+
+    breaker.record_cancel()
+    assert breaker.allow_request()
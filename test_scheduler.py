@@ -0,0 +1,236 @@
+"""
+Планировщик слотов к моделям и адаптивный лимит одновременных запросов
+
+Все проверки - в памяти, без сети и без БД.
+
+Запуск: python -m pytest -q test_scheduler.py
+"""
+
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+
+import scheduler
+
+
+async def _settle():
+    """Дать проснуться задачам, которым только что выдали слот"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def _wait_slot(model: scheduler.ModelScheduler, tier: str, user_id, order: list):
+    await model.acquire(tier, user_id)
+    order.append((tier, user_id))
+
+
+@pytest.fixture
+def fixed_limit(monkeypatch):
+    """Планировщик без адаптивного лимита - ровно столько слотов, сколько задали"""
+    monkeypatch.setattr(scheduler, "ADAPTIVE_CONCURRENCY_ENABLED", False)
+
+
+# ===== ПЛАНИРОВЩИК =====
+
+def test_weighted_admission_order(fixed_limit):
+    async def run():
+        model = scheduler.ModelScheduler("test", 1)
+        await model.acquire("free", "holder")
+        order = []
+        tasks = [asyncio.create_task(_wait_slot(model, "free", f"free-{i}", order)) for i in range(5)]
+        tasks += [asyncio.create_task(_wait_slot(model, "pro", f"pro-{i}", order)) for i in range(5)]
+        await _settle()
+
+        running = "holder"
+        for _ in range(10):
+            model.release(running)
+            await _settle()
+            running = order[-1][1]
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(run())
+    # Вес pro - 4, free - 1: из первых пяти слотов четыре у pro, но и free не стоит вечно
+    assert [tier for tier, _ in order[:5]].count("pro") == 4
+    assert [tier for tier, _ in order[:6]].count("free") == 2
+    # Внутри тарифа - в порядке прихода
+    assert [user for tier, user in order if tier == "free"] == [f"free-{i}" for i in range(5)]
+
+
+def test_round_robin_between_users(fixed_limit, monkeypatch):
+    monkeypatch.setattr(scheduler, "SCHEDULER_MAX_PER_USER", 1)
+
+    async def run():
+        model = scheduler.ModelScheduler("test", 1)
+        await model.acquire("free", "holder")
+        order = []
+        tasks = [asyncio.create_task(_wait_slot(model, "free", "heavy", order)) for _ in range(3)]
+        tasks.append(asyncio.create_task(_wait_slot(model, "free", "light", order)))
+        await _settle()
+
+        running = "holder"
+        for _ in range(4):
+            model.release(running)
+            await _settle()
+            running = order[-1][1]
+        await asyncio.gather(*tasks)
+        return [user for _, user in order]
+
+    # Пользователь с тремя запросами не занимает очередь перед тем, у кого один
+    assert asyncio.run(run()) == ["heavy", "light", "heavy", "heavy"]
+
+
+def test_per_user_limit(fixed_limit, monkeypatch):
+    monkeypatch.setattr(scheduler, "SCHEDULER_MAX_PER_USER", 2)
+
+    async def run():
+        model = scheduler.ModelScheduler("test", 10)
+        order = []
+        tasks = [asyncio.create_task(_wait_slot(model, "free", "user", order)) for _ in range(3)]
+        await _settle()
+        granted = len(order)
+        model.release("user")
+        await _settle()
+        await asyncio.gather(*tasks)
+        return granted, model.in_flight
+
+    granted, in_flight = asyncio.run(run())
+    assert granted == 2
+    assert in_flight == 2
+
+
+def test_cancelled_waiters_not_counted(fixed_limit):
+    async def run():
+        model = scheduler.ModelScheduler("test", 1)
+        await model.acquire("free", "holder")
+        order = []
+        tasks = [asyncio.create_task(_wait_slot(model, "free", f"user-{i}", order)) for i in range(3)]
+        await _settle()
+        before = model.queued_ahead("free")
+
+        for task in tasks[:2]:
+            task.cancel()
+        await asyncio.gather(*tasks[:2], return_exceptions=True)
+        after = model.queued_ahead("free"), len(model.tiers["free"])
+
+        model.release("holder")
+        await _settle()
+        await tasks[2]
+        return before, after, order, model.in_flight
+
+    before, after, order, in_flight = asyncio.run(run())
+    assert before == 3
+    assert after == (1, 1)
+    assert order == [("free", "user-2")]
+    assert in_flight == 1
+
+
+def test_cancel_after_slot_granted_returns_slot(fixed_limit):
+    async def run():
+        model = scheduler.ModelScheduler("test", 1)
+        await model.acquire("free", "holder")
+        order = []
+        task = asyncio.create_task(_wait_slot(model, "free", "user", order))
+        await _settle()
+
+        # Слот выдан, но задача еще не проснулась - и ее отменили
+        model.release("holder")
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return order, model.in_flight, model.user_in_flight
+
+    order, in_flight, user_in_flight = asyncio.run(run())
+    assert order == []
+    assert in_flight == 0
+    assert user_in_flight == {}
+
+
+def test_shed_only_cheap_tiers_when_wait_is_long(fixed_limit, monkeypatch):
+    monkeypatch.setattr(scheduler, "_schedulers", {})
+    model_key = next(iter(scheduler.MODELS))
+    model = scheduler.ModelScheduler(model_key, 1)
+    scheduler._schedulers[model_key] = model
+
+    asyncio.run(model.acquire("pro", None))
+    model.hold_time = scheduler.SHED_MAX_WAIT / 2
+    assert scheduler.shed_retry_after(model_key, "free") is None
+
+    model.hold_time = scheduler.SHED_MAX_WAIT * 2
+    assert scheduler.shed_retry_after(model_key, "free") == int(scheduler.SHED_MAX_WAIT * 2)
+    assert scheduler.shed_retry_after(model_key, "pro") is None
+    assert scheduler.scheduler_stats()[model_key]["shed"] == {"free": 1}
+
+
+# ===== АДАПТИВНЫЙ ЛИМИТ =====
+
+def test_adaptive_limit_grows_only_when_saturated():
+    limit = scheduler.AdaptiveLimit("test", 10)
+    start = limit.limit
+
+    for _ in range(20):
+        limit.on_success(None, in_flight=0)
+    assert limit.limit == start
+
+    for _ in range(int(start)):
+        limit.on_success(None, in_flight=int(start) - 1)
+    assert limit.limit == start + 1
+
+
+def test_adaptive_limit_backs_off_with_cooldown():
+    limit = scheduler.AdaptiveLimit("test", 10)
+    start = limit.limit
+
+    limit.on_overload()
+    assert limit.limit == pytest.approx(start * scheduler.ADAPTIVE_BACKOFF)
+    # Второй сигнал сразу за первым - та же перегрузка, лимит не режем дважды
+    limit.on_overload()
+    assert limit.limit == pytest.approx(start * scheduler.ADAPTIVE_BACKOFF)
+
+    limit.last_decrease -= scheduler.ADAPTIVE_DECREASE_COOLDOWN
+    for _ in range(10):
+        limit.on_overload()
+        limit.last_decrease -= scheduler.ADAPTIVE_DECREASE_COOLDOWN
+    assert limit.limit == limit.min_limit
+
+
+def test_adaptive_limit_latency_gradient():
+    limit = scheduler.AdaptiveLimit("test", 10)
+    start = limit.limit
+
+    limit.on_success(1.0, in_flight=0)
+    # Полное время ответа (None) не сравнивается с TTFT
+    limit.on_success(None, in_flight=0)
+    assert limit.baseline == 1.0
+
+    for _ in range(20):
+        limit.on_success(1.0 * scheduler.ADAPTIVE_LATENCY_TOLERANCE * 5, in_flight=0)
+    assert limit.limit < start
+
+
+def test_limit_increase_admits_waiters(monkeypatch):
+    monkeypatch.setattr(scheduler, "ADAPTIVE_CONCURRENCY_ENABLED", True)
+
+    async def run():
+        model = scheduler.ModelScheduler("test", 4)   # адаптивный лимит стартует с 2
+        start = model.limit
+        for _ in range(start):
+            await model.acquire("pro", None)
+        order = []
+        task = asyncio.create_task(_wait_slot(model, "pro", None, order))
+        await _settle()
+        waiting = len(order)
+
+        for _ in range(start):
+            model.record_success(None)
+        await _settle()
+        await task
+        return start, waiting, model.limit, order
+
+    start, waiting, limit, order = asyncio.run(run())
+    assert waiting == 0
+    assert limit == start + 1
+    assert order == [("pro", None)]
@@ -0,0 +1,76 @@
+"""
+Склейка одинаковых одновременных запросов (single-flight)
+
+Ошибка лидера доходит до всех ожидающих и не оставляет "зависший" ключ;
+общий запрос отменяется, только когда его больше никто не ждет.
+
+Запуск: python -m pytest -q test_singleflight.py
+"""
+
+import asyncio
+
+import singleflight
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_singleflight_leader_failure_reaches_followers(monkeypatch):
+    monkeypatch.setattr(singleflight, "_inflight", {})
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream down")
+
+    async def succeeding():
+        calls.append(1)
+        return "ok"
+
+    async def run():
+        results = await asyncio.gather(
+            *(singleflight.do("key", failing) for _ in range(3)), return_exceptions=True
+        )
+        # Упавший запрос не остается в списке - следующий вызов идет заново
+        again = await singleflight.do("key", succeeding)
+        return results, again
+
+    results, again = asyncio.run(run())
+    assert len(calls) == 2
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert again == ("ok", True)
+    assert singleflight.inflight_count() == 0
+
+
+def test_singleflight_cancel_last_waiter_cancels_work(monkeypatch):
+    monkeypatch.setattr(singleflight, "_inflight", {})
+    state = {}
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    async def run():
+        leader = asyncio.create_task(singleflight.do("key", slow))
+        follower = asyncio.create_task(singleflight.do("key", slow))
+        await _settle()
+
+        # Ушел лидер - запрос продолжается для оставшегося
+        leader.cancel()
+        await _settle()
+        alive = singleflight.inflight_count()
+
+        follower.cancel()
+        await asyncio.gather(leader, follower, return_exceptions=True)
+        await _settle()
+        return alive
+
+    assert asyncio.run(run()) == 1
+    assert state.get("cancelled")
+    assert singleflight.inflight_count() == 0
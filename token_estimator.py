@@ -0,0 +1,180 @@
+"""
+Оценка числа токенов до отправки запроса
+
+Токенизатор выбирается по семейству модели (architecture.tokenizer в каталоге):
+- GPT: точный подсчет через tiktoken (в requirements.txt). Словарь o200k_base
+  загружается при старте (load_tokenizers, при первом запуске - скачивается);
+  пока он не загружен или недоступен - эвристика;
+- остальные: только эвристика по классам символов (латиница, кириллица, CJK,
+  пунктуация, пробелы) со своей "ценой" символа для семейства. Локальных
+  токенизаторов Claude и Gemini нет, а словари открытых моделей пришлось бы
+  скачивать с HuggingFace для каждого семейства.
+
+Эвристика подстраивается под реальность: после каждого ответа число
+prompt-токенов из usage сравнивается с оценкой, и поправочный коэффициент
+семейства плавно сдвигается к фактическому (только если провайдер прислал
+prompt_tokens - искусственное деление total_tokens калибровку бы испортило).
+
+Подсчет для одного текста запоминается (LRU), поэтому история диалога
+не пересчитывается заново на каждом сообщении.
+"""
+
+import re
+from functools import lru_cache
+
+from config import TOKEN_ESTIMATE_CACHE_SIZE, TOKEN_CALIBRATION_WEIGHT
+from catalog import model_info
+
+
+# Служебные токены на каждое сообщение (роль, разделители) и на начало ответа
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+# Символов на токен для каждого класса символов
+_BASE_RATES = {
+    "latin": 4.0,     # латиница и цифры
+    "cyrillic": 2.2,
+    "cjk": 1.0,
+    "space": 5.0,     # пробелы и переводы строк (отступы в коде склеиваются)
+    "other": 1.5,     # пунктуация, скобки, эмодзи
+}
+
+# Насколько хорошо словарь семейства знает кириллицу (символов на токен)
+_CYRILLIC_RATES = {
+    "GPT": 3.0,
+    "Gemini": 3.2,
+    "Claude": 2.0,
+    "Llama3": 2.6,
+    "Llama4": 2.8,
+    "Qwen": 2.4,
+    "Qwen3": 2.4,
+    "DeepSeek": 2.0,
+    "Mistral": 2.3,
+    "Grok": 2.6,
+}
+
+_CLASSES = (
+    ("cyrillic", re.compile(r"[\u0400-\u04FF]")),
+    ("cjk", re.compile(r"[\u3040-\u30FF\u3400-\u9FFF\uAC00-\uD7AF]")),
+    ("latin", re.compile(r"[A-Za-z0-9]")),
+    ("space", re.compile(r"\s")),
+)
+
+# Поправочный коэффициент семейства: фактические токены / оценка
+_calibration: dict[str, float] = {}
+
+_tiktoken_encoding = None
+_tiktoken_failed = False
+
+
+def get_family(model_key: str) -> str:
+    """Семейство токенизатора модели ("GPT", "Claude", ... или "Other")"""
+    info = model_info(model_key)
+    return info.tokenizer if info is not None else "Other"
+
+
+def load_tokenizers():
+    """
+    Загружает словарь tiktoken для GPT (блокирующий вызов - при старте, в отдельном потоке)
+
+    Returns:
+        bool: загружен ли
+    """
+    global _tiktoken_encoding, _tiktoken_failed
+    if _tiktoken_encoding is None and not _tiktoken_failed:
+        try:
+            import tiktoken
+            _tiktoken_encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # Не установлен или нет доступа к словарю - считаем эвристикой
+            _tiktoken_failed = True
+            print(f"⚠️ tiktoken недоступен, токены GPT считаются эвристикой: {e}")
+        else:
+            # Тексты, посчитанные эвристикой до загрузки, пересчитаем точно
+            _count.cache_clear()
+    return _tiktoken_encoding is not None
+
+
+def _heuristic(family: str, text: str) -> float:
+    counted = 0
+    tokens = 0.0
+    for name, pattern in _CLASSES:
+        count = len(pattern.findall(text))
+        counted += count
+        rate = _CYRILLIC_RATES.get(family, _BASE_RATES["cyrillic"]) if name == "cyrillic" else _BASE_RATES[name]
+        tokens += count / rate
+    return tokens + (len(text) - counted) / _BASE_RATES["other"]
+
+
+@lru_cache(maxsize=TOKEN_ESTIMATE_CACHE_SIZE)
+def _count(family: str, text: str) -> tuple[float, bool]:
+    """
+    Токены текста без поправки
+
+    Returns:
+        tuple: (токены, точный_ли_подсчет)
+    """
+    # Словарь здесь не загружаем: скачивание заблокировало бы event loop (см. load_tokenizers)
+    if family == "GPT" and _tiktoken_encoding is not None:
+        return float(len(_tiktoken_encoding.encode(text, disallowed_special=()))), True
+    return _heuristic(family, text), False
+
+
+def _estimate(family: str, text: str) -> float:
+    tokens, exact = _count(family, text)
+    if exact:
+        return tokens
+    return tokens * _calibration.get(family, 1.0)
+
+
+def estimate_text_tokens(text: str, model_key: str = None) -> int:
+    """Токены одного текста"""
+    if not text:
+        return 0
+    return max(round(_estimate(get_family(model_key), text)), 1)
+
+
+def estimate_messages_tokens(messages: list, model_key: str = None) -> int:
+    """Токены всего запроса (сообщения + служебные токены чата)"""
+    family = get_family(model_key)
+    total = REPLY_OVERHEAD
+    for message in messages:
+        total += MESSAGE_OVERHEAD + _estimate(family, message.get("content") or "")
+    return round(total)
+
+
+def observe(model_key: str, messages: list, prompt_tokens: int):
+    """
+    Подстраивает эвристику по фактическим prompt-токенам из usage ответа
+
+    prompt_tokens - ровно то, что прислал провайдер (0 - не прислал, калибровки нет)
+    """
+    if not prompt_tokens or not messages:
+        return
+    family = get_family(model_key)
+
+    raw = REPLY_OVERHEAD + MESSAGE_OVERHEAD * len(messages)
+    exact = True
+    for message in messages:
+        tokens, is_exact = _count(family, message.get("content") or "")
+        raw += tokens
+        exact = exact and is_exact
+    if exact or raw <= 0:
+        return
+
+    # Скользящее среднее отношения факт/оценка (без поправки), с защитой от выбросов
+    ratio = min(max(prompt_tokens / raw, 0.3), 3.0)
+    current = _calibration.get(family, 1.0)
+    _calibration[family] = current + TOKEN_CALIBRATION_WEIGHT * (ratio - current)
+
+
+def estimator_stats() -> dict:
+    """Коэффициенты калибровки и работа кэша подсчетов"""
+    info = _count.cache_info()
+    return {
+        "calibration": {family: round(factor, 3) for family, factor in _calibration.items()},
+        "tiktoken": _tiktoken_encoding is not None,
+        "cache_hits": info.hits,
+        "cache_misses": info.misses,
+        "cache_size": info.currsize,
+    }